@@ -0,0 +1,53 @@
+"""
+Rebuild the daily mood rollups from stored chat histories.
+
+    python backfill_mood_rollups.py [--until 2024-06-01] [--batch-size 100] [--dry-run]
+
+Days before --until (today by default) are recomputed from chat_histories and
+replace their rollup documents. Today and later are left to the incremental
+updates made while messages are saved, so the backfill can run next to a live chat.
+"""
+import argparse
+from datetime import date
+
+import terminal_chat
+from mood_rollups import ROLLUP_INDEXES, backfill
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Backfill mood_rollups from chat_histories")
+    parser.add_argument('--until', default=date.today().isoformat(),
+                        help="Rebuild days before this date (YYYY-MM-DD; default today)")
+    parser.add_argument('--all-days', action='store_true',
+                        help="Also rebuild today, e.g. before mood rollups are enabled in the chat")
+    parser.add_argument('--default-cohort', default=terminal_chat.MOOD_DEFAULT_COHORT,
+                        help="Cohort of users without a cohort field")
+    parser.add_argument('--batch-size', type=int, default=100, help="Documents per cursor batch and bulk write")
+    parser.add_argument('--limit', type=int, default=0,
+                        help="Stop after this many users (0 for all); cohort days are then not rewritten")
+    parser.add_argument('--dry-run', action='store_true', help="Compute the rollups without writing them")
+    parser.add_argument('--uri', default=None, help="MongoDB URI (defaults to MONGO_CONNECTION_STRING)")
+    args = parser.parse_args(argv)
+
+    db = terminal_chat.get_mongo_client(args.uri)['chatbot_db']
+    rollups = db['mood_rollups']
+    if not args.dry_run:
+        terminal_chat.ensure_indexes(rollups, ROLLUP_INDEXES)
+    stats = backfill(
+        db['chat_histories'], rollups, args.default_cohort,
+        until=None if args.all_days else args.until,
+        batch_size=args.batch_size, limit=args.limit, dry_run=args.dry_run
+    )
+
+    print(f"users:       {stats['users']} ({stats['messages']} messages, {stats['counted']} with emotions)")
+    print(f"user days:   {stats['user_days']}")
+    if stats['partial']:
+        print(f"cohort days: {stats['cohort_days']} (not written: --limit read only part of the users)")
+    else:
+        print(f"cohort days: {stats['cohort_days']}")
+    if args.dry_run:
+        print("dry run: nothing written")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,1551 @@
+"""
+Offline benchmarks for the chat backend.
+
+Run with `python benchmark_chat.py <benchmark>`. Nothing here talks to Gemini or
+a real MongoDB: the collection and detectors are replaced with in-process fakes.
+"""
+import os
+import sys
+import time
+import asyncio
+import random
+import argparse
+import importlib.util
+import json
+import resource
+import statistics
+import subprocess
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import bson
+import mongomock
+from langchain_core.messages import AIMessage, AIMessageChunk
+from langchain_core.runnables import RunnableGenerator, RunnableLambda
+
+import terminal_chat
+from terminal_chat import UserChatManager
+from session_registry import ChatSession, SessionRegistry
+from inference_batcher import BatchedPipeline
+from response_cache import ResponseCache
+import inference_backend
+from inference_backend import BACKENDS, apply_backend, batch_pipelines
+from crisis_triage import CrisisTriage
+from message_codec import EMOTION_LABELS, decode_messages, encode_messages, zstandard
+from stage_metrics import StageMetrics
+from write_behind import WriteBehindQueue, merge_updates
+import mood_rollups
+
+
+class RecordingCollection:
+    """Collection stand-in that only records the BSON size of each write."""
+
+    def __init__(self):
+        self.bytes_written = 0
+        self.writes = 0
+
+    def update_one(self, filter, update, upsert=False):
+        self.writes += 1
+        self.bytes_written += len(bson.encode(filter)) + len(bson.encode(update))
+
+    def find_one(self, filter, projection=None):
+        return None
+
+    def reset(self):
+        self.bytes_written = 0
+        self.writes = 0
+
+
+class SlowCollection:
+    """Wraps a collection, adding a fixed round-trip time to every call and counting the calls."""
+
+    def __init__(self, collection, latency=0.0):
+        self.inner = collection
+        self.latency = latency
+        self.round_trips = 0
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        attr = getattr(self.inner, name)
+        if name not in ('find_one', 'update_one', 'bulk_write', 'aggregate', 'insert_one'):
+            return attr
+
+        def call(*args, **kwargs):
+            with self._lock:
+                self.round_trips += 1
+            time.sleep(self.latency)
+            return attr(*args, **kwargs)
+        return call
+
+
+class LockedCollection:
+    """Serializes every call on a collection; mongomock is not safe to use from several threads."""
+
+    def __init__(self, collection, lock):
+        self.inner = collection
+        self._lock = lock
+
+    def __getattr__(self, name):
+        attr = getattr(self.inner, name)
+        if not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            with self._lock:
+                return attr(*args, **kwargs)
+        return call
+
+
+class FakeEmotionDetector:
+    """Returns a fixed emotion result, optionally after a simulated inference delay."""
+
+    emotion_history = {}
+
+    def __init__(self, latency=0.0, crisis_words=()):
+        self.latency = latency
+        self.crisis_words = crisis_words
+
+    def detect_emotion(self, text, user_id=None):
+        if self.latency:
+            time.sleep(self.latency)
+        is_crisis = any(word in text.lower() for word in self.crisis_words)
+        return {
+            'emotions': {'joy': 0.1, 'sadness': 0.6, 'anger': 0.05, 'fear': 0.2, 'neutral': 0.05},
+            'dominant_emotion': 'sadness',
+            'crisis_info': {'is_crisis': is_crisis, 'risk_level': 'high' if is_crisis else 'low'}
+        }
+
+    def get_emotion_history(self, user_id):
+        return []
+
+
+class StubLLM:
+    """Deterministic LLM stand-in that records prompt sizes (4 characters ~ 1 token)."""
+
+    REPLY = "I hear you. What has been weighing on you the most?"
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = 0
+        self.prompt_chars = 0
+        self.runnable = RunnableLambda(self._respond, afunc=self._arespond)
+        self._lock = threading.Lock()
+
+    def _record(self, prompt):
+        messages = prompt.to_messages() if hasattr(prompt, 'to_messages') else prompt
+        chars = sum(len(str(m.content)) for m in messages)
+        with self._lock:
+            self.calls += 1
+            self.prompt_chars += chars
+        return chars
+
+    def _reply(self, chars):
+        input_tokens, output_tokens = chars // 4, len(self.REPLY) // 4
+        return AIMessage(content=self.REPLY, usage_metadata={
+            'input_tokens': input_tokens,
+            'output_tokens': output_tokens,
+            'total_tokens': input_tokens + output_tokens
+        })
+
+    def _respond(self, prompt):
+        chars = self._record(prompt)
+        # Simulated provider latency scales with prompt length
+        if self.latency:
+            time.sleep(self.latency * chars / 1000)
+        return self._reply(chars)
+
+    async def _arespond(self, prompt):
+        chars = self._record(prompt)
+        if self.latency:
+            await asyncio.sleep(self.latency * chars / 1000)
+        return self._reply(chars)
+
+    @property
+    def prompt_tokens(self):
+        return self.prompt_chars // 4
+
+    def reset(self):
+        self.calls = 0
+        self.prompt_chars = 0
+
+
+class StreamingStubLLM:
+    """LLM stand-in that emits its reply word by word after a fixed time-to-first-token."""
+
+    REPLY = ("I hear you, and it makes sense that exams feel overwhelming right now. "
+             "What part of the preparation worries you the most?")
+
+    def __init__(self, first_token_latency=0.5, token_latency=0.02):
+        self.first_token_latency = first_token_latency
+        self.token_latency = token_latency
+        self.runnable = RunnableGenerator(self._transform, self._atransform)
+
+    def _transform(self, prompts):
+        for _ in prompts:
+            pass
+        time.sleep(self.first_token_latency)
+        for i, word in enumerate(self.REPLY.split(' ')):
+            if i:
+                time.sleep(self.token_latency)
+            yield AIMessageChunk(content=word + ' ')
+
+    async def _atransform(self, prompts):
+        async for _ in prompts:
+            pass
+        await asyncio.sleep(self.first_token_latency)
+        for i, word in enumerate(self.REPLY.split(' ')):
+            if i:
+                await asyncio.sleep(self.token_latency)
+            yield AIMessageChunk(content=word + ' ')
+
+
+class FakeClassifierPipeline:
+    """
+    text-classification pipeline stand-in with the output shapes of transformers.
+
+    Every call holds one shared "CPU" for a fixed cost plus a smaller cost per text,
+    the way a padded forward pass costs little more for a few extra rows.
+    """
+
+    task = 'text-classification'
+    _cpu = threading.Lock()
+
+    def __init__(self, call_cost=0.008, item_cost=0.001):
+        self.call_cost = call_cost
+        self.item_cost = item_cost
+        self.calls = 0
+
+    def _classify(self, text):
+        weights = [1 + (hash((text, label)) % 97) for label in EMOTION_LABELS]
+        ranked = [{'label': label, 'score': w / sum(weights)} for label, w in zip(EMOTION_LABELS, weights)]
+        return sorted(ranked, key=lambda r: r['score'], reverse=True)
+
+    def __call__(self, inputs, top_k=1, batch_size=1):
+        texts = [inputs] if isinstance(inputs, str) else list(inputs)
+        with self._cpu:
+            self.calls += 1
+            time.sleep(self.call_cost + self.item_cost * len(texts))
+        outputs = [self._classify(text) if top_k is None else self._classify(text)[:top_k] for text in texts]
+        if isinstance(inputs, str):
+            return outputs[0]
+        # A list input gets one dict per text with top_k=1, one list per text otherwise
+        return [output[0] for output in outputs] if top_k == 1 else outputs
+
+
+class PipelineEmotionDetector:
+    """Emotion detector shaped like the real one: post-processing around a text-classification pipeline."""
+
+    def __init__(self, pipeline):
+        self.classifier = pipeline
+
+    def detect_emotion(self, text, user_id=None):
+        scores = {result['label']: result['score'] for result in self.classifier(text, top_k=None)}
+        return {
+            'emotions': scores,
+            'dominant_emotion': max(scores, key=scores.get),
+            'crisis_info': {'is_crisis': False, 'risk_level': 'low'}
+        }
+
+
+class FakeCrisisDetector:
+    """Flags messages containing any of `crisis_words` as high risk."""
+
+    def __init__(self, latency=0.0, crisis_words=()):
+        self.latency = latency
+        self.crisis_words = crisis_words
+
+    def detect_crisis(self, text):
+        if self.latency:
+            time.sleep(self.latency)
+        if any(word in text.lower() for word in self.crisis_words):
+            return {'is_crisis': True, 'risk_level': 'high'}
+        return {'is_crisis': False, 'risk_level': 'low'}
+
+
+def _bare_manager(collection, llm=None, **registry_limits):
+    """Build a UserChatManager without the real LLM, detectors or Mongo connection."""
+    manager = UserChatManager.__new__(UserChatManager)
+    manager.history_window = terminal_chat.HISTORY_WINDOW_MESSAGES
+    manager.sessions = SessionRegistry(on_evict=manager._on_session_evicted, **registry_limits)
+    manager._local = threading.local()
+    manager._executor = ThreadPoolExecutor(max_workers=terminal_chat.DETECTOR_WORKERS)
+    manager._background_tasks = set()
+    manager.token_usage = {'turns': 0, 'input_tokens': 0, 'output_tokens': 0}
+    manager._usage_lock = threading.Lock()
+    manager.write_queue = None
+    manager.rollup_queue = None
+    manager.rollup_collection = mongomock.MongoClient()['chatbot_db']['mood_rollups']
+    manager.prefix_cache = None
+    manager.response_cache = None
+    manager.collection = collection
+    manager.async_collection = None
+    manager.crisis_detector = FakeCrisisDetector()
+    if llm is not None:
+        manager.llm = llm.runnable
+        manager._build_chain()
+    return manager
+
+
+def _install_offline_backends(manager, real_models=False):
+    """Swap a fully constructed manager's LLM and MongoDB (and the detectors, unless `real_models`) for fakes."""
+    db = mongomock.MongoClient()['chatbot_db']
+    # Request threads and the write-behind and rollup queues share the database
+    lock = threading.Lock()
+    manager.collection = LockedCollection(db['chat_histories'], lock)
+    # The queues flush at exit; keep that offline too
+    manager.rollup_collection = LockedCollection(db['mood_rollups'], lock)
+    manager.async_collection = None
+    manager.llm = StubLLM().runnable
+    if not real_models:
+        terminal_chat.emotion_detector = FakeEmotionDetector()
+        manager.crisis_detector = FakeCrisisDetector()
+
+
+def _synthetic_history(length):
+    history = []
+    for i in range(length):
+        role = 'user' if i % 2 == 0 else 'assistant'
+        history.append({
+            'role': role,
+            'content': f"Synthetic message number {i} about exams, family and sleep.",
+            'timestamp': str(datetime.now())
+        })
+    return history
+
+
+def bench_write_bytes(args):
+    """Write bytes per turn (user + assistant message) as stored history grows."""
+    terminal_chat.emotion_detector = FakeEmotionDetector()
+    collection = RecordingCollection()
+    manager = _bare_manager(collection)
+
+    print(f"{'history':>8} | {'append bytes/turn':>18} | {'full rewrite bytes/turn':>24}")
+    for length in args.lengths:
+        session = ChatSession('bench-user', {
+            'user_id': 'bench-user',
+            'created_at': str(datetime.now()),
+            'chat_history': _synthetic_history(length)
+        })
+
+        collection.reset()
+        manager.add_to_history('user', "I'm stressed about my exams", session)
+        manager.add_to_history('assistant', "That sounds hard. What worries you most?", session)
+        manager.flush_user_updates(session)
+        append_bytes = collection.bytes_written
+
+        # The previous behaviour: one full-document $set per message plus a final save
+        collection.reset()
+        for _ in range(3):
+            collection.update_one({'user_id': 'bench-user'}, {'$set': {
+                **session.user_data, 'chat_history': terminal_chat.encode_for_storage(session.user_data['chat_history'])
+            }}, upsert=True)
+        rewrite_bytes = collection.bytes_written
+
+        print(f"{length:>8} | {append_bytes:>18} | {rewrite_bytes:>24}")
+
+
+def bench_hydration(args):
+    """Prompt tokens and latency per turn with full vs. windowed history hydration."""
+    terminal_chat.emotion_detector = FakeEmotionDetector()
+
+    print(f"{'history':>8} | {'mode':>8} | {'prompt tokens/turn':>18} | {'reported':>8} | {'ms/turn':>8}")
+    for length in args.lengths:
+        for window in (0, terminal_chat.HISTORY_WINDOW_MESSAGES):
+            collection = mongomock.MongoClient()['chatbot_db']['chat_histories']
+            collection.insert_one({
+                'user_id': 'bench-user',
+                'created_at': str(datetime.now()),
+                'chat_history': _synthetic_history(length),
+                'message_count': length
+            })
+            llm = StubLLM(latency=args.llm_latency)
+            manager = _bare_manager(collection, llm)
+            manager.history_window = window
+            manager.initialize_conversation('bench-user')
+
+            llm.reset()
+            start = time.perf_counter()
+            for _ in range(args.turns):
+                manager.get_response("I'm stressed about my exams")
+            elapsed = (time.perf_counter() - start) / args.turns
+
+            mode = f"last {window}" if window else "full"
+            tokens = llm.prompt_tokens // max(llm.calls, 1)
+            # Chat turns only, as reported through usage_metadata (summary calls excluded)
+            reported = manager.get_token_usage()['avg_input_tokens']
+            print(f"{length:>8} | {mode:>8} | {tokens:>18} | {reported:>8.0f} | {elapsed * 1000:>8.1f}")
+
+
+def _paged_history(length, start):
+    """`length` messages a minute apart from `start`; the older half legacy (string timestamps), the rest compact."""
+    history = [
+        {'role': 'user' if i % 2 == 0 else 'assistant', 'content': f"message {i}",
+         'timestamp': str(start + timedelta(minutes=i))}
+        for i in range(length)
+    ]
+    half = length // 2
+    return history[:half] + encode_messages(history[half:])
+
+
+def bench_pages(args):
+    """
+    Payload and latency of history pages vs. the full document, checking every cursor.
+
+    The stored documents predate message_count, the way old users' documents do, and
+    each user has one turn before paging, so a counter started by $inc would show.
+    """
+    terminal_chat.emotion_detector = FakeEmotionDetector()
+    start = datetime(2024, 5, 1, 9)
+    limit = 10
+    failures = []
+
+    def check(label, ok):
+        if not ok:
+            failures.append(label)
+
+    print(f"{'history':>8} | {'window':>6} | {'page bytes':>10} | {'full bytes':>10} | {'page ms':>7}")
+    for length in args.lengths:
+        for window in (0, terminal_chat.HISTORY_WINDOW_MESSAGES):
+            collection = mongomock.MongoClient()['chatbot_db']['chat_histories']
+            collection.insert_one({
+                'user_id': 'bench-user', 'created_at': str(start), 'chat_history': _paged_history(length, start)
+            })
+            manager = _bare_manager(collection, StubLLM())
+            manager.history_window = window
+            manager.initialize_conversation('bench-user')
+            manager.get_response("I'm stressed about my exams")
+            total = length + 2
+
+            def get_page(**cursor):
+                # None (a failed read) counts as an empty, mismatching page
+                return manager.get_history_page('bench-user', limit=limit, **cursor) or {
+                    'total': None, 'messages': [], 'next_cursor': None, 'etag': None, 'not_modified': False
+                }
+
+            began = time.perf_counter()
+            page = get_page()
+            elapsed = time.perf_counter() - began
+            seqs = [msg['seq'] for msg in page['messages']]
+            label = f"history={length} window={window}"
+            check(f"{label}: newest page", page['total'] == total and seqs == list(range(total - limit, total)))
+
+            older = get_page(before_seq=page['next_cursor'])
+            check(f"{label}: before_seq", [msg['content'] for msg in older['messages']] ==
+                  [f"message {i}" for i in range(max(0, total - 2 * limit), total - limit)])
+
+            # Message 7 (legacy) and the one in the middle of the compact half
+            for cut in {min(7, length - 1), length * 3 // 4}:
+                before = get_page(before=start + timedelta(minutes=cut))
+                check(f"{label}: before message {cut}", [msg['seq'] for msg in before['messages']] ==
+                      list(range(max(0, cut - limit), cut)))
+
+            cached = get_page(if_none_match=page['etag'])
+            check(f"{label}: if_none_match", cached['not_modified'] and not cached['messages'])
+            manager.get_response("still stressed")
+            changed = get_page(if_none_match=page['etag'])
+            check(f"{label}: etag after a new turn", not changed['not_modified'] and changed['etag'] != page['etag'])
+
+            page_bytes = len(bson.encode({'messages': page['messages']}))
+            full_bytes = len(bson.encode(collection.find_one({'user_id': 'bench-user'}, {'_id': 0})))
+            print(f"{length:>8} | {window:>6} | {page_bytes:>10} | {full_bytes:>10} | {elapsed * 1000:>7.2f}")
+
+    for label in failures:
+        print(f"  FAILED: {label}")
+    if failures:
+        sys.exit(1)
+
+
+def _percentile(samples, pct):
+    ordered = sorted(samples)
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+def bench_sessions(args):
+    """Load test: many simulated users sharing one manager across worker threads."""
+    terminal_chat.emotion_detector = FakeEmotionDetector()
+    collection = mongomock.MongoClient()['chatbot_db']['chat_histories']
+    llm = StubLLM(latency=args.llm_latency)
+    manager = _bare_manager(
+        collection, llm,
+        max_sessions=args.max_sessions,
+        ttl_seconds=args.session_ttl
+    )
+
+    user_ids = [f"user-{i}" for i in range(args.users)]
+    for user_id in user_ids:
+        manager.get_or_create_user(user_id)
+
+    messages = ["hi", "I'm stressed about my exams", "my parents keep pressuring me",
+                "I can't sleep before the test", "thanks, that helps"]
+    latencies = []
+    latency_lock = threading.Lock()
+
+    def turn(user_id):
+        start = time.perf_counter()
+        manager.get_response(random.choice(messages), user_id=user_id)
+        elapsed = time.perf_counter() - start
+        with latency_lock:
+            latencies.append(elapsed)
+
+    workload = [user_id for _ in range(args.turns) for user_id in user_ids]
+    random.shuffle(workload)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        list(pool.map(turn, workload))
+    wall = time.perf_counter() - start
+
+    print(f"users={args.users} turns/user={args.turns} concurrency={args.concurrency}")
+    print(f"throughput:      {len(workload) / wall:.1f} turns/s")
+    print(f"latency p50/p99: {_percentile(latencies, 50) * 1000:.1f} / {_percentile(latencies, 99) * 1000:.1f} ms")
+    print(f"live sessions:   {len(manager.sessions)} (cap {args.max_sessions})")
+    print(f"session bytes:   {manager.sessions.total_bytes / 1024:.0f} KiB (estimated)")
+    print(f"max RSS:         {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.0f} MiB")
+
+
+def bench_async(args):
+    """Turn latency of get_response on threads vs. aget_response on one event loop."""
+    messages = ["hi", "I'm stressed about my exams", "my parents keep pressuring me"]
+
+    def setup():
+        terminal_chat.emotion_detector = FakeEmotionDetector(args.detector_latency)
+        collection = mongomock.MongoClient()['chatbot_db']['chat_histories']
+        manager = _bare_manager(collection, StubLLM(latency=args.llm_latency))
+        manager.crisis_detector = FakeCrisisDetector(args.detector_latency)
+        user_ids = [f"user-{i}" for i in range(args.users)]
+        for user_id in user_ids:
+            manager.get_or_create_user(user_id)
+        return manager, [u for _ in range(args.turns) for u in user_ids]
+
+    def report(name, latencies, wall):
+        print(f"{name:>14} | {len(latencies) / wall:>9.1f} | "
+              f"{_percentile(latencies, 50) * 1000:>8.1f} | {_percentile(latencies, 99) * 1000:>8.1f}")
+
+    print(f"{'path':>14} | {'turns/s':>9} | {'p50 ms':>8} | {'p99 ms':>8}")
+
+    manager, workload = setup()
+    latencies = []
+
+    def sync_turn(user_id):
+        start = time.perf_counter()
+        manager.get_response(random.choice(messages), user_id=user_id)
+        latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        list(pool.map(sync_turn, workload))
+    report('get_response', latencies, time.perf_counter() - start)
+
+    manager, workload = setup()
+    latencies = []
+
+    async def run_async():
+        limit = asyncio.Semaphore(args.concurrency)
+
+        async def async_turn(user_id):
+            async with limit:
+                start = time.perf_counter()
+                await manager.aget_response(random.choice(messages), user_id=user_id)
+                latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(async_turn(u) for u in workload))
+        wall = time.perf_counter() - start
+        await manager.aflush()
+        return wall
+
+    report('aget_response', latencies, asyncio.run(run_async()))
+
+    # Sync and async turns for one user, with the window folding into the summary
+    # while background writes drain the pending fields: the stored document must
+    # end up with every message and the session's summary state
+    manager, _ = setup()
+    manager.history_window = 4
+    user_id = 'user-0'
+
+    async def run_mixed():
+        loop = asyncio.get_running_loop()
+        turns = []
+        for _ in range(args.turns * 5):
+            turns.append(manager.aget_response(random.choice(messages), user_id=user_id))
+            turns.append(loop.run_in_executor(None, lambda: manager.get_response(random.choice(messages), user_id=user_id)))
+        await asyncio.gather(*turns)
+        await manager.aflush()
+
+    asyncio.run(run_mixed())
+    session = manager.sessions.peek(user_id)
+    manager.flush_user_updates(session)
+    stored = manager.collection.find_one({'user_id': user_id})
+    checks = {
+        'messages stored': stored['message_count'] == len(stored['chat_history']) == args.turns * 20,
+        'summarized_count stored': stored.get('summarized_count') == session.user_data.get('summarized_count'),
+        'history_summary stored': stored.get('history_summary') == session.user_data.get('history_summary'),
+        'window folded': 0 < session.user_data.get('summarized_count', 0)
+    }
+    for name, ok in checks.items():
+        print(f"mixed sync/async turns, {name}: {'ok' if ok else 'MISMATCH'}")
+    if not all(checks.values()):
+        sys.exit(1)
+
+
+def bench_streaming(args):
+    """Time to first byte and to full reply for get_response vs. stream_response."""
+    terminal_chat.emotion_detector = FakeEmotionDetector(args.detector_latency, crisis_words=('hopeless',))
+    collection = mongomock.MongoClient()['chatbot_db']['chat_histories']
+    llm = StreamingStubLLM(args.first_token_latency, args.token_latency)
+    manager = _bare_manager(collection)
+    manager.llm = llm.runnable
+    manager._build_chain()
+    manager.crisis_detector = FakeCrisisDetector(args.detector_latency, crisis_words=('hopeless',))
+    manager.get_or_create_user('bench-user')
+
+    print(f"{'path':>16} | {'message':>8} | {'TTFB ms':>8} | {'total ms':>8}")
+    for label, text in (('normal', "I'm stressed about my exams"), ('crisis', "I feel hopeless")):
+        start = time.perf_counter()
+        manager.get_response(text, user_id='bench-user')
+        total = (time.perf_counter() - start) * 1000
+        print(f"{'get_response':>16} | {label:>8} | {total:>8.1f} | {total:>8.1f}")
+
+        start = time.perf_counter()
+        first = None
+        for _ in manager.stream_response(text, user_id='bench-user'):
+            if first is None:
+                first = (time.perf_counter() - start) * 1000
+        total = (time.perf_counter() - start) * 1000
+        print(f"{'stream_response':>16} | {label:>8} | {first:>8.1f} | {total:>8.1f}")
+
+
+def bench_batching(args):
+    """
+    Emotion detection throughput: one forward pass per message vs. pipelines wrapped by batch_pipelines.
+
+    Uses a pipeline-shaped fake detector whose calls share one CPU by default, and
+    the real emotion detector with --real-models. Batched results must match the
+    single-message ones (dominant emotion, scores within 1e-3).
+    """
+    if args.real_models:
+        try:
+            from emotion_detector import emotion_detector as detector
+        except ImportError as e:
+            print(f"skipped: the emotion detector module is not available ({e})")
+            return
+        apply_backend(detector, terminal_chat.INFERENCE_BACKEND, terminal_chat.ONNX_CACHE_DIR)
+    else:
+        detector = PipelineEmotionDetector(FakeClassifierPipeline())
+    samples = ["I'm stressed about my exams", "my parents keep pressuring me",
+               "I can't sleep before the test", "thanks, that really helped",
+               "I feel so alone in this new city", "I got placed today!"]
+    workload = [(samples[i % len(samples)], f"user-{i % args.users}") for i in range(args.messages)]
+
+    def run():
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            results = list(pool.map(lambda item: detector.detect_emotion(*item), workload))
+        return len(workload) / (time.perf_counter() - start), results
+
+    # Warm the model up so neither side pays for lazy initialisation
+    detector.detect_emotion(samples[0], 'warmup')
+    single, expected = run()
+    if not batch_pipelines(detector, args.batch_size, args.batch_wait_ms):
+        print("skipped: the emotion detector holds no text-classification pipeline to batch")
+        return
+    batched, results = run()
+    batchers = [value.batcher for _, _, value, _ in inference_backend._members(detector)
+                if isinstance(value, BatchedPipeline)]
+
+    mismatches = sum(
+        got['dominant_emotion'] != want['dominant_emotion'] or
+        max(abs(got['emotions'][label] - score) for label, score in want['emotions'].items()) > 1e-3
+        for got, want in zip(results, expected)
+    )
+    average = statistics.mean(batcher.average_batch_size for batcher in batchers)
+    print(f"detector={'real' if args.real_models else 'fake'} messages={len(workload)} "
+          f"concurrency={args.concurrency} batch_size={args.batch_size} wait={args.batch_wait_ms}ms")
+    print(f"single-message: {single:>8.1f} msg/s")
+    print(f"micro-batched:  {batched:>8.1f} msg/s (avg batch {average:.1f})")
+    print(f"results differing from single-message inference: {mismatches}")
+    for batcher in batchers:
+        batcher.close()
+    if mismatches:
+        sys.exit(1)
+
+
+# (message, topics it must map to): inflections match, longer words starting with a keyword do not
+TOPIC_CASES = [
+    ("I had a moment of calm today", set()),
+    ("we kept our momentum going", set()),
+    ("his illness was diagnosed in Illinois", set()),
+    ("उसकी माँग पूरी नहीं हुई", set()),
+    ("my mom called", {'family'}),
+    ("माँ ने फोन किया", {'family'}),
+    ("exams are next week", {'studies'}),
+    ("I was stressed and felt ill", {'stress', 'health'}),
+]
+
+
+def _check_topic_cases(matcher):
+    failures = [(text, expected, set(matcher.match(text))) for text, expected in TOPIC_CASES
+                if set(matcher.match(text)) != expected]
+    for text, expected, found in failures:
+        print(f"  topic mismatch: {text!r}: expected {sorted(expected)}, found {sorted(found)}")
+    return not failures
+
+
+def bench_topics(args):
+    """Topic detection over a 10-message window per turn: nested keyword scan vs. compiled matcher."""
+    from keyword_matcher import KeywordMatcher
+
+    def legacy_topics(messages):
+        topic_counts = {topic: 0 for topic in terminal_chat.TOPIC_KEYWORDS}
+        for msg in messages:
+            content = msg.get('content', '').lower()
+            for topic, keywords in terminal_chat.TOPIC_KEYWORDS.items():
+                if any(keyword in content for keyword in keywords):
+                    topic_counts[topic] += 1
+        return [topic for topic, count in topic_counts.items() if count >= 2]
+
+    manager = _bare_manager(None)
+    history = _synthetic_history(args.turns + 10)
+    windows = [history[i:i + 10] for i in range(args.turns)]
+
+    def timed(fn):
+        start = time.perf_counter()
+        for window in windows:
+            fn(window)
+        return (time.perf_counter() - start) / len(windows) * 1e6
+
+    legacy = timed(legacy_topics)
+    terminal_chat.TOPIC_MATCHER = KeywordMatcher(terminal_chat.TOPIC_KEYWORDS, cache_size=0)
+    uncached = timed(manager._identify_conversation_topics)
+    terminal_chat.TOPIC_MATCHER = KeywordMatcher(terminal_chat.TOPIC_KEYWORDS)
+    cached = timed(manager._identify_conversation_topics)
+
+    keywords = sum(len(k) for k in terminal_chat.TOPIC_KEYWORDS.values())
+    print(f"turns={len(windows)} topics={len(terminal_chat.TOPIC_KEYWORDS)} keywords={keywords}")
+    print(f"nested scan:               {legacy:>8.1f} us/turn")
+    print(f"compiled matcher:          {uncached:>8.1f} us/turn")
+    print(f"compiled matcher + cache:  {cached:>8.1f} us/turn")
+    if not _check_topic_cases(terminal_chat.TOPIC_MATCHER):
+        sys.exit(1)
+
+
+def bench_context(args):
+    """Context-block build time per turn as stored history grows."""
+    terminal_chat.emotion_detector = FakeEmotionDetector()
+    manager = _bare_manager(RecordingCollection())
+
+    print(f"{'history':>8} | {'us/turn':>8}")
+    for length in args.lengths:
+        session = ChatSession('bench-user', {
+            'user_id': 'bench-user',
+            'chat_history': _synthetic_history(length)
+        })
+        manager._reset_context_window(session)
+
+        elapsed = 0.0
+        for i in range(args.turns):
+            manager._record_message(session, 'user', f"I'm stressed about exam number {i}")
+            start = time.perf_counter()
+            manager._get_conversation_context(session)
+            elapsed += time.perf_counter() - start
+            manager._record_message(session, 'assistant', "That sounds hard. What worries you most?")
+        print(f"{length:>8} | {elapsed / args.turns * 1e6:>8.1f}")
+
+
+def bench_cache(args):
+    """Model calls and opening-turn latency for new users with and without the response cache."""
+    terminal_chat.emotion_detector = FakeEmotionDetector(crisis_words=('hopeless',))
+    openers = ["hi", "Hi!", "hello", "I'm stressed about my exams", "i'm stressed about my exams...",
+               "I can't sleep", "my parents keep pressuring me", "I feel hopeless"]
+
+    print(f"{'cache':>6} | {'model calls':>11} | {'hit ratio':>9} | {'ms/turn':>8}")
+    for cache_size in (0, 1024):
+        llm = StubLLM(latency=args.llm_latency)
+        manager = _bare_manager(mongomock.MongoClient()['chatbot_db']['chat_histories'], llm)
+        if cache_size:
+            manager.response_cache = ResponseCache(cache_size)
+
+        start = time.perf_counter()
+        for i in range(args.users):
+            user_id = f"user-{cache_size}-{i}"
+            manager.get_or_create_user(user_id)
+            manager.get_response(random.choice(openers), user_id=user_id)
+        elapsed = time.perf_counter() - start
+
+        stats = manager.get_cache_stats()['response_cache'] or {'hit_ratio': 0.0}
+        label = 'on' if cache_size else 'off'
+        print(f"{label:>6} | {llm.calls:>11} | {stats['hit_ratio']:>9.2f} | {elapsed / args.users * 1000:>8.2f}")
+
+
+def bench_lookups(args):
+    """
+    find_one latency by user_id as the user count grows, before and after ensure_indexes.
+
+    Needs a real mongod: mongomock scans documents in Python whether or not an index
+    exists. Writes only to the chatbot_benchmark database.
+    """
+    uri = args.mongo_uri or terminal_chat.MONGO_CONNECTION_STRING
+    if not uri:
+        print("skipped: index lookups need a real MongoDB; pass --mongo-uri or set MONGO_CONNECTION_STRING")
+        return
+    collection = terminal_chat.get_mongo_client(uri)['chatbot_benchmark']['chat_histories']
+
+    print(f"{'users':>8} | {'no index us':>11} | {'indexed us':>10}")
+    for count in args.user_counts:
+        collection.drop()
+        terminal_chat._indexed_collections.discard(collection.full_name)
+        collection.insert_many([
+            {'user_id': f"user-{i}", 'created_at': str(datetime.now()), 'chat_history': _synthetic_history(4)}
+            for i in range(count)
+        ])
+        user_ids = [f"user-{random.randrange(count)}" for _ in range(args.messages)]
+
+        timings = []
+        for indexed in (False, True):
+            if indexed:
+                terminal_chat.ensure_indexes(collection)
+            start = time.perf_counter()
+            for user_id in user_ids:
+                collection.find_one({'user_id': user_id}, {'chat_history': {'$slice': -20}})
+            timings.append((time.perf_counter() - start) / len(user_ids) * 1e6)
+        print(f"{count:>8} | {timings[0]:>11.1f} | {timings[1]:>10.1f}")
+    collection.drop()
+
+
+# Runs in a fresh interpreter per measurement; prints import, ready and first-reply
+# times in seconds since the start of `import terminal_chat`
+STARTUP_PROBE = '''
+import sys, time
+start = time.perf_counter()
+import terminal_chat
+imported = time.perf_counter()
+manager = terminal_chat.UserChatManager()
+
+# Installing the offline fakes is not part of startup
+setup = time.perf_counter()
+import benchmark_chat
+benchmark_chat._install_offline_backends(manager, real_models=sys.argv[2] == '1')
+setup = time.perf_counter() - setup
+
+if sys.argv[1] == 'eager':
+    manager.warm_up(background=False)
+elif sys.argv[1] == 'background':
+    manager.warm_up()
+ready = time.perf_counter() - setup
+
+manager.get_or_create_user('startup-user')
+manager.get_response("hi, I'm stressed about my exams", user_id='startup-user')
+first = time.perf_counter() - setup
+print('startup', imported - start, ready - start, first - start)
+'''
+
+
+def bench_startup(args):
+    """Import time, time until the manager can accept requests, and time to first reply per warm-up mode."""
+    here = os.path.dirname(os.path.abspath(__file__))
+    print(f"{'mode':>10} | {'import ms':>9} | {'ready ms':>8} | {'first reply ms':>14}")
+    for mode in ('eager', 'lazy', 'background'):
+        runs = []
+        for _ in range(args.startup_runs):
+            result = subprocess.run(
+                [sys.executable, '-c', STARTUP_PROBE, mode, '1' if args.real_models else '0'],
+                cwd=here, capture_output=True, text=True, check=True
+            )
+            line = next(line for line in reversed(result.stdout.splitlines()) if line.startswith('startup '))
+            runs.append([float(value) for value in line.split()[1:]])
+        imported, ready, first = (statistics.median(column) * 1000 for column in zip(*runs))
+        print(f"{mode:>10} | {imported:>9.0f} | {ready:>8.0f} | {first:>14.0f}")
+
+
+# Messages the backends must agree on: everyday stress, mixed Hinglish, and crisis language
+PARITY_TEXTS = [
+    "I'm so happy, I finally cleared my exams!",
+    "I'm stressed about my exams and can't sleep",
+    "my parents keep pressuring me to become a doctor",
+    "I feel so lonely in this new city",
+    "I'm really angry at my roommate",
+    "I'm scared I will fail the entrance test",
+    "yaar bahut tension ho rahi hai exams ki",
+    "thanks, that actually helps",
+    "I feel hopeless, nothing will ever get better",
+    "I don't want to live anymore",
+    "I have been thinking about ending my life",
+    "sometimes I wish I could just disappear",
+]
+
+# Runs each backend in a fresh interpreter so latency and RSS are not shared; prints one JSON line
+BACKEND_PROBE = '''
+import json, resource, sys, time
+import terminal_chat
+texts = json.loads(sys.stdin.read())
+emotion_detector = terminal_chat.get_emotion_detector()
+crisis_detector = terminal_chat.UserChatManager().crisis_detector
+loaded_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+emotions, crises, latencies = [], [], []
+for text in texts:
+    start = time.perf_counter()
+    emotions.append(emotion_detector.detect_emotion(text, 'parity-user'))
+    crises.append(crisis_detector.detect_crisis(text))
+    latencies.append(time.perf_counter() - start)
+print(json.dumps({
+    'emotion': emotions,
+    'crisis': crises,
+    'latencies': latencies,
+    'loaded_rss_mb': loaded_rss,
+    'max_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+}, default=float))
+'''
+
+
+# Modules holding the real models, imported by BACKEND_PROBE
+DETECTOR_MODULES = ('emotion_detector', 'advanced_crisis_detector')
+
+
+def _run_backend(backend, texts):
+    """Detector results under `backend` from a fresh process, or None (with the reason printed) if it failed."""
+    env = dict(os.environ, INFERENCE_BACKEND=backend)
+    result = subprocess.run(
+        [sys.executable, '-c', BACKEND_PROBE],
+        input=json.dumps(texts), cwd=os.path.dirname(os.path.abspath(__file__)),
+        env=env, capture_output=True, text=True
+    )
+    if result.returncode:
+        error = (result.stderr.strip().splitlines() or ['no output'])[-1]
+        print(f"{backend:>10} | failed: {error}")
+        return None
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def _check_tiny_backends(args):
+    """
+    apply_backend on a detector holding two tiny randomly initialised BERT classifiers.
+
+    Runs offline: both models (an attribute and a dict entry) must be found and
+    converted, and each backend's predictions must agree with torch's on random
+    token ids. Returns False on a failure, True otherwise (including when skipped).
+    """
+    try:
+        import torch
+        from transformers import BertConfig, BertForSequenceClassification
+    except ImportError as e:
+        print(f"skipped offline backend check: {e}")
+        return True
+    config = BertConfig(vocab_size=256, hidden_size=32, num_hidden_layers=2, num_attention_heads=2,
+                        intermediate_size=64, num_labels=len(EMOTION_LABELS))
+    generator = torch.Generator().manual_seed(0)
+    input_ids = torch.randint(0, config.vocab_size, (64, 16), generator=generator)
+    inputs = {'input_ids': input_ids, 'attention_mask': torch.ones_like(input_ids),
+              'token_type_ids': torch.zeros_like(input_ids)}
+
+    def detector():
+        # Same seed, same weights: every backend starts from identical models
+        torch.manual_seed(0)
+        return SimpleNamespace(
+            model=BertForSequenceClassification(config).eval(),
+            models={'crisis': BertForSequenceClassification(config).eval()}
+        )
+
+    def predict(held):
+        with torch.no_grad():
+            return torch.cat([model(**inputs).logits.argmax(-1) for model in (held.model, held.models['crisis'])])
+
+    reference = predict(detector())
+    ok = True
+    with tempfile.TemporaryDirectory() as cache_dir:
+        for backend in BACKENDS[1:]:
+            if backend == 'onnx-int8' and importlib.util.find_spec('optimum') is None:
+                print(f"{'tiny ' + backend:>16} | skipped: optimum is not installed")
+                continue
+            held = detector()
+            converted = apply_backend(held, backend, cache_dir)
+            agreement = (predict(held) == reference).float().mean().item()
+            passed = converted == 2 and agreement >= args.parity_threshold
+            ok = ok and passed
+            print(f"{'tiny ' + backend:>16} | converted {converted}/2 | agreement {agreement:.2f}"
+                  f"{'' if passed else '  PARITY FAILED'}")
+    return ok
+
+
+def _parity(reference, candidate):
+    """Agreement of a backend's detector results with the torch backend's."""
+    pairs = list(zip(reference['emotion'], candidate['emotion']))
+    score_delta = max(
+        abs(ref['emotions'][label] - cand['emotions'].get(label, 0.0))
+        for ref, cand in pairs for label in ref['emotions']
+    )
+    return {
+        'dominant': sum(ref['dominant_emotion'] == cand['dominant_emotion'] for ref, cand in pairs) / len(pairs),
+        'score_delta': score_delta,
+        'risk': sum(
+            ref['risk_level'] == cand['risk_level'] and ref['is_crisis'] == cand['is_crisis']
+            for ref, cand in zip(reference['crisis'], candidate['crisis'])
+        ) / len(pairs)
+    }
+
+
+def bench_backends(args):
+    """
+    Prediction parity of the quantized backends against torch.
+
+    apply_backend is first checked offline on tiny random classifiers; latency, RSS
+    and parity of the real models follow when the detector modules are available.
+    """
+    failed = not _check_tiny_backends(args)
+    missing = [module for module in DETECTOR_MODULES if importlib.util.find_spec(module) is None]
+    if missing:
+        print(f"skipped real-model parity: {', '.join(missing)} not available")
+        if failed:
+            sys.exit(1)
+        return
+
+    texts = PARITY_TEXTS * max(1, args.messages // len(PARITY_TEXTS))
+    print(f"{'backend':>10} | {'p50 ms':>7} | {'p99 ms':>7} | {'RSS MiB':>7} | "
+          f"{'dominant':>8} | {'max delta':>9} | {'risk':>5}")
+    reference = _run_backend('torch', texts)
+    if reference is None:
+        sys.exit(1)
+    for backend in BACKENDS:
+        result = reference if backend == 'torch' else _run_backend(backend, texts)
+        if result is None:
+            failed = True
+            continue
+        parity = _parity(reference, result)
+        # The crisis decision must not change; the dominant emotion may flip on near-ties
+        ok = parity['risk'] == 1.0 and parity['dominant'] >= args.parity_threshold
+        failed = failed or not ok
+        latencies = result['latencies']
+        print(f"{backend:>10} | {_percentile(latencies, 50) * 1000:>7.1f} | {_percentile(latencies, 99) * 1000:>7.1f} | "
+              f"{result['max_rss_mb']:>7.0f} | {parity['dominant']:>8.2f} | {parity['score_delta']:>9.3f} | "
+              f"{parity['risk']:>5.2f}{'' if ok else '  PARITY FAILED'}")
+    if failed:
+        sys.exit(1)
+
+
+def _load_crisis_fixtures(name='crisis_fixtures.jsonl'):
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), name)
+    with open(path, encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def bench_triage(args):
+    """
+    Pre-filter recall at --triage-threshold and crisis model calls saved on a mostly benign workload.
+
+    crisis_fixtures.jsonl was written alongside the keyword lists; crisis_heldout.jsonl
+    was not, and is the one that decides whether the threshold is safe to enable.
+    """
+    fixtures = _load_crisis_fixtures()
+    crisis = [f['text'] for f in fixtures if f['crisis']]
+    benign = [f['text'] for f in fixtures if not f['crisis']]
+
+    def triage(threshold):
+        detector = FakeCrisisDetector(args.detector_latency)
+        return CrisisTriage(
+            terminal_chat.CRISIS_TRIAGE_KEYWORDS,
+            terminal_chat.CRISIS_TRIAGE_WEIGHTS,
+            detector.detect_crisis,
+            threshold=threshold,
+            sample_every=terminal_chat.CRISIS_SAMPLE_EVERY
+        )
+
+    scorer = triage(args.triage_threshold)
+
+    def evaluate(name):
+        labelled = _load_crisis_fixtures(name)
+        positives = [f['text'] for f in labelled if f['crisis']]
+        negatives = [f['text'] for f in labelled if not f['crisis']]
+        missed = [text for text in positives if scorer.score(text) < scorer.threshold]
+        recall = 1 - len(missed) / len(positives)
+        false_alarms = sum(scorer.score(text) >= scorer.threshold for text in negatives) / len(negatives)
+        print(f"{name}: {len(positives)} crisis / {len(negatives)} benign")
+        print(f"  pre-filter recall:   {recall:.3f} (threshold {scorer.threshold})")
+        print(f"  benign escalations:  {false_alarms:.3f}")
+        for text in missed:
+            print(f"  missed: {text}")
+        return recall
+
+    evaluate('crisis_fixtures.jsonl')
+    recall = evaluate('crisis_heldout.jsonl')
+
+    # 2% crisis messages, the rest everyday conversation
+    workload = [random.choice(crisis) if random.random() < 0.02 else random.choice(benign)
+                for _ in range(args.messages)]
+    print(f"\n{'threshold':>9} | {'model calls':>11} | {'ms/message':>10}")
+    for threshold in (0.0, args.triage_threshold):
+        tier = triage(threshold)
+        start = time.perf_counter()
+        for text in workload:
+            tier.assess(text)
+        elapsed = time.perf_counter() - start
+        print(f"{threshold:>9} | {tier.stats()['model_calls']:>11} | {elapsed / len(workload) * 1000:>10.3f}")
+
+    if recall < args.min_recall:
+        sys.exit(1)
+
+
+def _legacy_history(length):
+    """History in the legacy layout, with realistic reply lengths and emotion payloads."""
+    reply = ("That sounds really hard, and it makes sense that you feel this way with exams so close. "
+             "Let's try one small thing together: write down the three topics that worry you most, "
+             "and we'll make a short plan for tomorrow. How does that sound? ") * 2
+    emotions = {'anger': 0.02, 'disgust': 0.01, 'fear': 0.31, 'joy': 0.04,
+                'neutral': 0.12, 'sadness': 0.47, 'surprise': 0.03}
+    history = []
+    for i in range(length):
+        if i % 2 == 0:
+            history.append({
+                'role': 'user',
+                'content': f"I'm stressed about my exams, I can't focus at all today ({i})",
+                'timestamp': str(datetime.now()),
+                'emotions': emotions,
+                'dominant_emotion': 'sadness',
+                'crisis_detected': {'is_crisis': False, 'risk_level': 'low'}
+            })
+        else:
+            history.append({'role': 'assistant', 'content': reply, 'timestamp': str(datetime.now())})
+    return history
+
+
+def bench_schema(args):
+    """Document size and write/read time of the legacy vs. compact message layouts."""
+    layouts = [('legacy', None), ('compact', 'none'), ('compact+zlib', 'zlib')]
+    if zstandard is not None:
+        layouts.append(('compact+zstd', 'zstd'))
+    collection = mongomock.MongoClient()['chatbot_benchmark']['chat_histories']
+
+    print(f"{'history':>8} | {'layout':>13} | {'doc KiB':>8} | {'write ms':>8} | {'read ms':>8}")
+    for length in args.lengths:
+        legacy = _legacy_history(length)
+        for name, compression in layouts:
+            collection.drop()
+            start = time.perf_counter()
+            stored = legacy if compression is None else encode_messages(legacy, compression)
+            collection.insert_one({'user_id': 'bench-user', 'chat_history': stored})
+            write = time.perf_counter() - start
+
+            start = time.perf_counter()
+            decode_messages(collection.find_one({'user_id': 'bench-user'})['chat_history'])
+            read = time.perf_counter() - start
+
+            size = len(bson.encode({'user_id': 'bench-user', 'chat_history': stored}))
+            print(f"{length:>8} | {name:>13} | {size / 1024:>8.1f} | {write * 1000:>8.1f} | {read * 1000:>8.1f}")
+
+
+def _print_stage_summary(metrics):
+    print(f"{'stage':>12} | {'count':>6} | {'p50 ms':>8} | {'p95 ms':>8} | {'p99 ms':>8}")
+    for name, stage in sorted(metrics.summary().items()):
+        print(f"{name:>12} | {stage['count']:>6} | {stage['p50'] * 1000:>8.2f} | "
+              f"{stage['p95'] * 1000:>8.2f} | {stage['p99'] * 1000:>8.2f}")
+
+
+def bench_stages(args):
+    """Per-stage latency percentiles of get_response, and the cost of the instrumentation itself."""
+    terminal_chat.emotion_detector = FakeEmotionDetector(args.detector_latency)
+    messages = ["hi", "I'm stressed about my exams", "my parents keep pressuring me", "I can't sleep"]
+
+    timings = {}
+    for enabled in (False, True):
+        llm = StubLLM(latency=args.llm_latency)
+        manager = _bare_manager(mongomock.MongoClient()['chatbot_db']['chat_histories'], llm)
+        manager.crisis_detector = FakeCrisisDetector(args.detector_latency)
+        manager.metrics = StageMetrics(enabled=enabled)
+        manager.get_or_create_user('bench-user')
+
+        start = time.perf_counter()
+        for i in range(args.turns):
+            manager.get_response(messages[i % len(messages)], user_id='bench-user')
+        timings[enabled] = (time.perf_counter() - start) / args.turns
+        if enabled:
+            _print_stage_summary(manager.metrics)
+
+    print(f"\nturn time: {timings[False] * 1000:.3f} ms without metrics, {timings[True] * 1000:.3f} ms with")
+
+
+def bench_writes(args):
+    """Turn latency and MongoDB round trips with synchronous writes vs. the write-behind queue."""
+    crisis_text = "I feel hopeless, everyone would be better off without me"
+    messages = ["hi", "I'm stressed about my exams", "my parents keep pressuring me", "I can't sleep before tests"]
+
+    print(f"db latency {args.db_latency * 1000:.1f} ms, {args.users} users x {args.turns} turns, "
+          f"write-behind interval {terminal_chat.WRITE_BEHIND_INTERVAL_MS:.0f} ms")
+    print(f"{'writes':>12} | {'turns/s':>9} | {'p50 ms':>8} | {'p99 ms':>8} | {'round trips':>11} | "
+          f"{'coalesced':>9} | {'flags lost':>10}")
+    for write_behind in (False, True):
+        terminal_chat.emotion_detector = FakeEmotionDetector(args.detector_latency, ('hopeless',))
+        collection = SlowCollection(mongomock.MongoClient()['chatbot_db']['chat_histories'], args.db_latency)
+        manager = _bare_manager(collection, StubLLM(latency=args.llm_latency))
+        manager.metrics = StageMetrics(enabled=False)
+        manager.crisis_detector = FakeCrisisDetector(args.detector_latency, ('hopeless',))
+        if write_behind:
+            manager.write_queue = WriteBehindQueue(
+                manager._write_user_updates,
+                flush_interval=terminal_chat.WRITE_BEHIND_INTERVAL_MS / 1000,
+                max_pending=terminal_chat.WRITE_BEHIND_MAX_USERS
+            )
+        user_ids = [f"user-{i}" for i in range(args.users)]
+        for user_id in user_ids:
+            manager.get_or_create_user(user_id)
+        collection.round_trips = 0
+
+        latencies = []
+        lost = []
+
+        def play(user_id):
+            for turn in range(args.turns):
+                # Every fifth user reaches a crisis halfway through
+                crisis = turn == args.turns // 2 and user_id.endswith(('0', '5'))
+                start = time.perf_counter()
+                manager.get_response(crisis_text if crisis else random.choice(messages), user_id=user_id)
+                latencies.append(time.perf_counter() - start)
+                if crisis:
+                    # The flag must already be stored when the reply is returned
+                    stored = collection.inner.find_one({'user_id': user_id}, {'needs_immediate_attention': 1})
+                    if not (stored or {}).get('needs_immediate_attention'):
+                        lost.append(user_id)
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            list(pool.map(play, user_ids))
+        wall = time.perf_counter() - start
+        stats = manager.get_write_stats()
+        if manager.write_queue is not None:
+            manager.write_queue.close()
+
+        print(f"{'write-behind' if write_behind else 'sync':>12} | {len(latencies) / wall:>9.1f} | "
+              f"{_percentile(latencies, 50) * 1000:>8.1f} | {_percentile(latencies, 99) * 1000:>8.1f} | "
+              f"{collection.round_trips:>11} | {stats.get('coalesced', 0):>9} | {len(lost):>10}")
+
+
+def _mood_history(length, days, rng):
+    """Compact history spread over the last `days` days, with varied emotions and a few crises."""
+    now = datetime.now()
+    history = []
+    for i in range(length):
+        timestamp = now - timedelta(days=days * (length - i) / length)
+        if i % 2:
+            history.append({'role': 'assistant', 'content': "I'm here with you.", 'timestamp': timestamp})
+            continue
+        scores = [rng.random() for _ in EMOTION_LABELS]
+        total = sum(scores)
+        emotions = {label: score / total for label, score in zip(EMOTION_LABELS, scores)}
+        crisis = rng.random() < 0.01
+        history.append({
+            'role': 'user',
+            'content': "exams again",
+            'timestamp': timestamp,
+            'emotions': emotions,
+            'dominant_emotion': max(emotions, key=emotions.get),
+            'crisis_detected': {'is_crisis': crisis, 'risk_level': 'high' if crisis else 'low'}
+        })
+    return encode_messages(history)
+
+
+def bench_rollups(args):
+    """Cohort mood trend from a scan of every chat history vs. from the daily rollups."""
+    rng = random.Random(args.seed)
+    db = mongomock.MongoClient()['chatbot_benchmark']
+    chats, rollups = db['chat_histories'], db['mood_rollups']
+    cohorts = [f"college-{i}" for i in range(args.cohorts)]
+    length = args.lengths[0]
+    chats.insert_many([
+        {'user_id': f"user-{i}", 'cohort': cohorts[i % len(cohorts)], 'chat_history': _mood_history(length, args.days, rng)}
+        for i in range(args.users)
+    ])
+    print(f"{args.users} users x {length} messages over {args.days} days, {len(cohorts)} cohorts")
+
+    # What a dashboard had to do without rollups: read and decode every history
+    start = time.perf_counter()
+    scanned = {}
+    for doc in chats.find({'cohort': cohorts[0]}, {'chat_history': 1}):
+        for message in decode_messages(doc['chat_history']):
+            counters = mood_rollups.message_counters(message)
+            if counters:
+                day = mood_rollups.message_day(message['timestamp'])
+                scanned[day] = scanned.get(day, 0) + counters['messages']
+    scan = time.perf_counter() - start
+
+    start = time.perf_counter()
+    stats = mood_rollups.backfill(chats, rollups, batch_size=100)
+    rebuild = time.perf_counter() - start
+
+    start = time.perf_counter()
+    trend = mood_rollups.mood_trend(rollups, 'cohort', cohorts[0])
+    read = time.perf_counter() - start
+
+    # Incremental path: the $inc updates of one more day of messages, coalesced as the chat queues them
+    queued = {}
+    start = time.perf_counter()
+    for i in range(args.messages):
+        user_id = f"user-{i % args.users}"
+        message = decode_messages(_mood_history(2, 0, rng))[0]
+        for rollup_id, update in mood_rollups.rollup_updates(user_id, cohorts[i % len(cohorts)], message):
+            queued[rollup_id] = merge_updates(queued[rollup_id], update) if rollup_id in queued else update
+    incremental = (time.perf_counter() - start) / args.messages
+
+    matches = {day['day']: day['messages'] for day in trend} == scanned
+    # A backfill limited to a few users must leave the cohort days alone
+    mood_rollups.backfill(chats, rollups, batch_size=100, limit=1)
+    partial_ok = mood_rollups.mood_trend(rollups, 'cohort', cohorts[0]) == trend
+    print(f"full scan trend:   {scan * 1000:>9.1f} ms ({stats['counted']} messages counted overall)")
+    print(f"backfill:          {rebuild * 1000:>9.1f} ms ({stats['user_days']} user days, {stats['cohort_days']} cohort days)")
+    print(f"rollup trend read: {read * 1000:>9.2f} ms ({len(trend)} days, {'matches' if matches else 'DIFFERS FROM'} the scan)")
+    print(f"incremental:       {incremental * 1e6:>9.1f} us per message, "
+          f"{args.messages} messages -> {len(queued)} rollup writes")
+    print(f"limited backfill:  cohort days {'kept' if partial_ok else 'OVERWRITTEN'}")
+    if not matches or not partial_ok:
+        sys.exit(1)
+
+
+def _load_corpus(path):
+    """Conversations to replay, one JSON object per line: {"id": ..., "turns": [user messages]}."""
+    with open(path, encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def _rss_mb():
+    """Current resident set size in MiB (peak RSS where /proc is unavailable)."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize() / 1024 / 1024
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _replay_manager(args, corpus, length):
+    """
+    UserChatManager() with its configured queues and caches, on mongomock and the stub LLM.
+
+    Every replayed user is stored with `length` messages beforehand.
+    """
+    manager = UserChatManager()
+    manager.sessions = SessionRegistry(
+        max_sessions=args.max_sessions,
+        ttl_seconds=args.session_ttl,
+        max_bytes=terminal_chat.SESSION_MAX_BYTES,
+        on_evict=manager._on_session_evicted
+    )
+    _install_offline_backends(manager, real_models=args.real_models)
+    manager.llm = StubLLM(latency=args.llm_latency).runnable
+    manager.metrics = StageMetrics(enabled=True)
+    if not args.real_models:
+        crisis_words = ('hopeless', 'better off without me')
+        terminal_chat.emotion_detector = FakeEmotionDetector(args.detector_latency, crisis_words)
+        manager.crisis_detector = FakeCrisisDetector(args.detector_latency, crisis_words)
+
+    history = terminal_chat.encode_for_storage(_legacy_history(length))
+    manager.collection.insert_many([
+        {'user_id': user_id, 'created_at': str(datetime.now()), 'chat_history': list(history),
+         'message_count': length}
+        for user_id, _ in _replay_jobs(args, corpus)
+    ])
+    return manager
+
+
+def _replay_jobs(args, corpus):
+    return [(f"{conversation['id']}-{replica}", conversation['turns'])
+            for replica in range(args.replicas) for conversation in corpus]
+
+
+def _replay(args, manager, jobs):
+    """Play every conversation turn by turn, `args.concurrency` users at a time; returns turn latencies."""
+    latencies = []
+    lock = threading.Lock()
+
+    def record(start):
+        elapsed = time.perf_counter() - start
+        with lock:
+            latencies.append(elapsed)
+
+    if args.mode == 'async':
+        async def run():
+            semaphore = asyncio.Semaphore(args.concurrency)
+
+            async def play(user_id, turns):
+                async with semaphore:
+                    for text in turns:
+                        start = time.perf_counter()
+                        await manager.aget_response(text, user_id=user_id)
+                        record(start)
+
+            await asyncio.gather(*(play(user_id, turns) for user_id, turns in jobs))
+            await manager.aflush()
+
+        asyncio.run(run())
+    else:
+        def play(job):
+            user_id, turns = job
+            for text in turns:
+                start = time.perf_counter()
+                manager.get_response(text, user_id=user_id)
+                record(start)
+
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            list(pool.map(play, jobs))
+        if manager.write_queue is not None:
+            manager.write_queue.flush()
+    return latencies
+
+
+def bench_replay(args):
+    """Replay a conversation corpus through the full turn; throughput, per-stage percentiles and memory growth."""
+    random.seed(args.seed)
+    corpus = _load_corpus(args.corpus)
+    jobs = _replay_jobs(args, corpus)
+    results = []
+
+    print(f"corpus={os.path.basename(args.corpus)} conversations={len(corpus)} users={len(jobs)} "
+          f"mode={args.mode} concurrency={args.concurrency} detectors={'real' if args.real_models else 'fake'}")
+    for length in args.lengths:
+        manager = _replay_manager(args, corpus, length)
+        rss_before = _rss_mb()
+        start = time.perf_counter()
+        latencies = _replay(args, manager, jobs)
+        wall = time.perf_counter() - start
+        result = {
+            'history_length': length,
+            'turns': len(latencies),
+            'throughput': len(latencies) / wall,
+            'turn_p50_ms': _percentile(latencies, 50) * 1000,
+            'turn_p99_ms': _percentile(latencies, 99) * 1000,
+            'rss_growth_mb': _rss_mb() - rss_before,
+            'stages': {
+                name: {key: value * 1000 if key.startswith('p') or key == 'mean' else value
+                       for key, value in stage.items()}
+                for name, stage in manager.metrics.summary().items()
+            }
+        }
+        results.append(result)
+        for queue in (manager.write_queue, manager.rollup_queue):
+            if queue is not None:
+                queue.close()
+
+        print(f"\nhistory={length}: {result['throughput']:.1f} turns/s, turn p50/p99 "
+              f"{result['turn_p50_ms']:.1f} / {result['turn_p99_ms']:.1f} ms, RSS +{result['rss_growth_mb']:.1f} MiB")
+        _print_stage_summary(manager.metrics)
+
+    report = {
+        'commit': _git_commit(),
+        'created_at': datetime.now().isoformat(timespec='seconds'),
+        'params': {key: getattr(args, key) for key in (
+            'corpus', 'replicas', 'mode', 'concurrency', 'llm_latency', 'detector_latency',
+            'real_models', 'max_sessions', 'seed'
+        )},
+        'history_window': terminal_chat.HISTORY_WINDOW_MESSAGES,
+        'results': results
+    }
+    if args.json_out:
+        with open(args.json_out, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+        print(f"\nwrote {args.json_out}")
+    if args.compare:
+        _compare_replay(report, args.compare)
+
+
+def _compare_replay(report, baseline_path):
+    """Print throughput and p99 changes against a report written by an earlier --json-out."""
+    with open(baseline_path, encoding='utf-8') as f:
+        baseline = json.load(f)
+    previous = {result['history_length']: result for result in baseline['results']}
+    print(f"\ncompared with {baseline.get('commit') or baseline_path}:")
+    print(f"{'history':>8} | {'turns/s':>16} | {'turn p99 ms':>20}")
+    for result in report['results']:
+        old = previous.get(result['history_length'])
+        if old is None:
+            continue
+        print(f"{result['history_length']:>8} | {old['throughput']:>6.1f} -> {result['throughput']:<6.1f} | "
+              f"{old['turn_p99_ms']:>8.1f} -> {result['turn_p99_ms']:<8.1f}")
+
+
+BENCHMARKS = {
+    'backends': bench_backends,
+    'batching': bench_batching,
+    'cache': bench_cache,
+    'context': bench_context,
+    'write-bytes': bench_write_bytes,
+    'hydration': bench_hydration,
+    'lookups': bench_lookups,
+    'pages': bench_pages,
+    'replay': bench_replay,
+    'rollups': bench_rollups,
+    'schema': bench_schema,
+    'sessions': bench_sessions,
+    'stages': bench_stages,
+    'startup': bench_startup,
+    'async': bench_async,
+    'streaming': bench_streaming,
+    'topics': bench_topics,
+    'triage': bench_triage,
+    'writes': bench_writes,
+}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Offline chat backend benchmarks")
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS))
+    parser.add_argument('--lengths', type=int, nargs='+', default=[10, 100, 1000, 10000],
+                        help="Stored history lengths to benchmark against")
+    parser.add_argument('--turns', type=int, default=20, help="Chat turns per measurement")
+    parser.add_argument('--llm-latency', type=float, default=0.0,
+                        help="Simulated LLM seconds per 1000 prompt characters")
+    parser.add_argument('--users', type=int, default=1000, help="Simulated users for the load test")
+    parser.add_argument('--concurrency', type=int, default=32, help="Worker threads for the load test")
+    parser.add_argument('--max-sessions', type=int, default=200, help="Session registry cap")
+    parser.add_argument('--session-ttl', type=float, default=1800, help="Session idle TTL in seconds")
+    parser.add_argument('--detector-latency', type=float, default=0.0,
+                        help="Simulated seconds per crisis/emotion detector call")
+    parser.add_argument('--messages', type=int, default=512, help="Messages for the batching benchmark")
+    parser.add_argument('--batch-size', type=int, default=terminal_chat.EMOTION_BATCH_SIZE or 16,
+                        help="Micro-batch size")
+    parser.add_argument('--batch-wait-ms', type=float, default=terminal_chat.EMOTION_BATCH_WAIT_MS,
+                        help="Micro-batch collection window in milliseconds")
+    parser.add_argument('--first-token-latency', type=float, default=0.5,
+                        help="Simulated LLM time to first token in seconds")
+    parser.add_argument('--token-latency', type=float, default=0.02,
+                        help="Simulated LLM seconds between streamed tokens")
+    parser.add_argument('--user-counts', type=int, nargs='+', default=[1000, 10000, 100000],
+                        help="Stored users for the lookup benchmark")
+    parser.add_argument('--mongo-uri', default=None,
+                        help="mongod for the lookup benchmark (default MONGO_CONNECTION_STRING)")
+    parser.add_argument('--startup-runs', type=int, default=5, help="Fresh processes per startup mode")
+    parser.add_argument('--real-models', action='store_true',
+                        help="Load the real emotion/crisis models (startup, replay and batching benchmarks)")
+    parser.add_argument('--parity-threshold', type=float, default=0.9,
+                        help="Minimum dominant-emotion agreement with torch for the backends benchmark")
+    parser.add_argument('--triage-threshold', type=float, default=terminal_chat.CRISIS_TRIAGE_THRESHOLD or 0.3,
+                        help="Crisis pre-filter threshold to evaluate")
+    parser.add_argument('--min-recall', type=float, default=1.0,
+                        help="Fail the triage benchmark below this pre-filter recall on the held-out crisis fixtures")
+    parser.add_argument('--db-latency', type=float, default=0.002,
+                        help="Simulated MongoDB round-trip time in seconds for the writes benchmark")
+    parser.add_argument('--cohorts', type=int, default=5, help="Cohorts for the rollups benchmark")
+    parser.add_argument('--days', type=int, default=90, help="Days of history for the rollups benchmark")
+    parser.add_argument('--corpus', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'replay_corpus.jsonl'),
+                        help="Conversation corpus for the replay benchmark (JSON lines)")
+    parser.add_argument('--replicas', type=int, default=4, help="Simulated users replaying each conversation")
+    parser.add_argument('--mode', choices=('sync', 'async'), default='sync',
+                        help="Replay through get_response on threads or aget_response on one event loop")
+    parser.add_argument('--seed', type=int, default=0, help="Random seed, for comparable runs")
+    parser.add_argument('--json-out', default=None, help="Write the replay results to this JSON file")
+    parser.add_argument('--compare', default=None, help="Compare the replay results with an earlier --json-out file")
+    args = parser.parse_args(argv)
+    BENCHMARKS[args.benchmark](args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,76 @@
+"""
+Two-tier crisis detection.
+
+A weighted keyword scorer looks at every message first. Only messages scoring at
+or above the threshold go to the transformer crisis model, plus every
+Nth benign-looking message as a sample that keeps an eye on the pre-filter's
+misses. Everything else is reported as low risk without running the model.
+"""
+import threading
+from typing import Any, Callable, Dict, Iterable
+
+from keyword_matcher import KeywordMatcher
+
+
+class CrisisTriage:
+    """Lexical pre-filter in front of a `detect_crisis(text)` model."""
+
+    def __init__(
+        self,
+        keywords: Dict[str, Iterable[str]],
+        weights: Dict[str, float],
+        detect_crisis: Callable[[str], Dict[str, Any]],
+        threshold: float = 0.3,
+        sample_every: int = 0
+    ):
+        self.matcher = KeywordMatcher(keywords)
+        self.weights = weights
+        self.detect_crisis = detect_crisis
+        self.threshold = threshold
+        self.sample_every = sample_every
+        self.messages = 0
+        self.escalated = 0
+        self.sampled = 0
+        # Sampled messages the model flagged although the pre-filter did not
+        self.missed = 0
+        self._lock = threading.Lock()
+
+    def score(self, text: str) -> float:
+        """Combined cue weight in [0, 1]; every cue found, also several of one tier, adds to it."""
+        remaining = 1.0
+        for tier, hits in self.matcher.count(text).items():
+            remaining *= (1.0 - self.weights.get(tier, 0.0)) ** hits
+        return 1.0 - remaining
+
+    def assess(self, text: str) -> Dict[str, Any]:
+        """Crisis assessment for `text`, running the model only for escalated or sampled messages."""
+        score = self.score(text)
+        escalate = score >= self.threshold
+        with self._lock:
+            self.messages += 1
+            if escalate:
+                self.escalated += 1
+            sample = not escalate and self.sample_every and self.messages % self.sample_every == 0
+            if sample:
+                self.sampled += 1
+
+        if not escalate and not sample:
+            return {'is_crisis': False, 'risk_level': 'low', 'lexical_score': score, 'triage': 'lexical'}
+
+        result = {**self.detect_crisis(text), 'lexical_score': score, 'triage': 'model'}
+        if sample and (result.get('is_crisis') or result.get('risk_level') not in (None, 'low')):
+            with self._lock:
+                self.missed += 1
+            print(f"Crisis pre-filter missed a {result.get('risk_level')} risk message (score {score:.2f})")
+        return result
+
+    def stats(self) -> Dict[str, Any]:
+        model_calls = self.escalated + self.sampled
+        return {
+            'messages': self.messages,
+            'model_calls': model_calls,
+            'skipped_ratio': 1 - model_calls / self.messages if self.messages else 0.0,
+            'escalated': self.escalated,
+            'sampled': self.sampled,
+            'missed': self.missed
+        }
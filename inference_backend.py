@@ -0,0 +1,143 @@
+"""
+Selectable CPU inference backends for the transformer models inside the detectors.
+
+'torch' leaves the models untouched, 'torch-int8' applies dynamic int8
+quantization to their Linear layers, and 'onnx-int8' exports each sequence
+classifier to ONNX, quantizes it with ONNX Runtime and swaps it in behind the same
+call interface. Tokenization and post-processing stay in the detectors, so
+detect_emotion / detect_crisis keep returning the same dictionaries.
+
+batch_pipelines() wraps the text-classification pipelines a detector holds in
+BatchedPipeline, so concurrent single-message calls share a forward pass.
+"""
+import platform
+import tempfile
+from pathlib import Path
+from typing import Any, Callable, Iterator, Tuple
+
+from inference_batcher import BatchedPipeline
+
+BACKENDS = ('torch', 'torch-int8', 'onnx-int8')
+TEXT_CLASSIFICATION_TASKS = ('text-classification', 'sentiment-analysis')
+
+
+def apply_backend(detector: Any, backend: str, cache_dir: str = 'onnx_models') -> int:
+    """Convert the models held by `detector` in place and return how many were converted."""
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown inference backend {backend!r}; expected one of {BACKENDS}")
+    if backend == 'torch':
+        return 0
+
+    converted = 0
+    for name, model, replace in _find_models(detector):
+        try:
+            if backend == 'onnx-int8' and _is_sequence_classifier(model):
+                replace(export_onnx_int8(model, cache_dir))
+            else:
+                if backend == 'onnx-int8':
+                    print(f"{name} is not a sequence classifier, using torch-int8 for it instead of ONNX")
+                replace(quantize_torch_int8(model))
+            converted += 1
+        except Exception as e:
+            print(f"Could not convert {name} to {backend}, keeping the torch model: {e}")
+    if not converted:
+        print(f"No transformer models found on {type(detector).__name__} for the {backend} backend")
+    return converted
+
+
+def batch_pipelines(detector: Any, max_batch_size: int = 16, max_wait_ms: float = 5.0) -> int:
+    """Wrap the detector's text-classification pipelines in BatchedPipeline; returns how many were wrapped."""
+    wrapped = 0
+    for name, pipeline, replace in _find_pipelines(detector):
+        replace(BatchedPipeline(pipeline, max_batch_size, max_wait_ms, name=f"batcher-{name}"))
+        wrapped += 1
+    if not wrapped:
+        print(f"No text-classification pipelines found on {type(detector).__name__}; inference is not batched")
+    return wrapped
+
+
+def quantize_torch_int8(model):
+    """Dynamically quantize a torch model's Linear layers to int8 (weights only, activations at runtime)."""
+    import torch
+
+    model.eval()
+    return torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+def export_onnx_int8(model, cache_dir: str = 'onnx_models'):
+    """
+    Export a transformers sequence classifier to int8 ONNX and load it with ONNX Runtime.
+
+    The exported files are cached under `cache_dir`, so only the first start pays
+    for the export. The returned ORTModel is called like the torch model and
+    returns logits as torch tensors.
+    """
+    from optimum.onnxruntime import ORTModelForSequenceClassification, ORTQuantizer
+    from optimum.onnxruntime.configuration import AutoQuantizationConfig
+
+    name = (model.config._name_or_path or type(model).__name__).strip('/').replace('/', '--')
+    target = Path(cache_dir) / name
+    quantized = target / 'int8'
+    if not (quantized / 'model_quantized.onnx').exists():
+        with tempfile.TemporaryDirectory() as tmp:
+            model.save_pretrained(tmp)
+            ORTModelForSequenceClassification.from_pretrained(tmp, export=True).save_pretrained(target / 'fp32')
+        if platform.machine().lower() in ('arm64', 'aarch64'):
+            config = AutoQuantizationConfig.arm64(is_static=False, per_channel=False)
+        else:
+            config = AutoQuantizationConfig.avx2(is_static=False, per_channel=False)
+        ORTQuantizer.from_pretrained(target / 'fp32').quantize(save_dir=quantized, quantization_config=config)
+    return ORTModelForSequenceClassification.from_pretrained(quantized, file_name='model_quantized.onnx')
+
+
+def _is_sequence_classifier(model) -> bool:
+    return type(model).__name__.endswith('ForSequenceClassification')
+
+
+def _is_transformer(value) -> bool:
+    try:
+        import torch
+    except ImportError:
+        return False
+    return isinstance(value, torch.nn.Module) and hasattr(value, 'config')
+
+
+def _setter(owner, key) -> Callable[[Any], None]:
+    if isinstance(owner, dict):
+        return lambda value: owner.__setitem__(key, value)
+    return lambda value: setattr(owner, key, value)
+
+
+def _members(detector: Any) -> Iterator[Tuple[Any, Any, Any, str]]:
+    """(owner, key, value, name) for the detector's attributes and one level into dicts."""
+    for attr, value in list(vars(detector).items()):
+        name = f"{type(detector).__name__}.{attr}"
+        if isinstance(value, dict):
+            for key, item in list(value.items()):
+                yield value, key, item, f"{name}[{key!r}]"
+        else:
+            yield detector, attr, value, name
+
+
+def _find_models(detector: Any) -> Iterator[Tuple[str, Any, Callable[[Any], None]]]:
+    """
+    Yield (name, model, replace) for the transformer models a detector holds.
+
+    Models are looked for in the detector's attributes, in transformers pipelines
+    (their `.model`) and one level into dicts, which covers how detectors
+    usually keep their models and classifiers.
+    """
+    for owner, key, value, name in _members(detector):
+        if _is_transformer(value):
+            yield name, value, _setter(owner, key)
+        elif _is_transformer(getattr(value, 'model', None)):
+            # transformers Pipeline
+            yield f"{name}.model", value.model, _setter(value, 'model')
+
+
+def _find_pipelines(detector: Any) -> Iterator[Tuple[str, Any, Callable[[Any], None]]]:
+    """Yield (name, pipeline, replace) for the text-classification pipelines a detector holds."""
+    for owner, key, value, name in _members(detector):
+        if callable(value) and getattr(value, 'task', None) in TEXT_CLASSIFICATION_TASKS \
+                and not isinstance(value, BatchedPipeline):
+            yield name, value, _setter(owner, key)
@@ -0,0 +1,167 @@
+"""
+Micro-batching for model inference.
+
+Requests from concurrent chat sessions are queued and handed to a batch function
+together, so the model runs one forward pass over several messages instead of
+many single-message passes competing for the CPU.
+
+BatchedPipeline applies this inside a detector: it replaces a transformers
+text-classification pipeline, so the detector's own detect_emotion code (and its
+post-processing) stays as it is while its pipeline calls are batched.
+"""
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, List, Sequence
+
+
+class MicroBatcher:
+    """Collects items for up to `max_wait_ms` or `max_batch_size` items and runs them as one batch."""
+
+    def __init__(
+        self,
+        batch_fn: Callable[[List[Any]], Sequence[Any]],
+        max_batch_size: int = 16,
+        max_wait_ms: float = 5.0,
+        name: str = 'micro-batcher'
+    ):
+        self.batch_fn = batch_fn
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max_wait_ms / 1000
+        self.batches = 0
+        self.items = 0
+        self._queue: "queue.Queue" = queue.Queue()
+        self._closed = False
+        self._worker = threading.Thread(target=self._run, name=name, daemon=True)
+        self._worker.start()
+
+    @property
+    def average_batch_size(self) -> float:
+        return self.items / self.batches if self.batches else 0.0
+
+    def submit(self, item: Any) -> Future:
+        """Queue an item; the returned future resolves to its result."""
+        if self._closed:
+            raise RuntimeError("MicroBatcher is closed")
+        future = Future()
+        self._queue.put((item, future))
+        return future
+
+    def __call__(self, item: Any) -> Any:
+        """Submit an item and block until its result is ready."""
+        return self.submit(item).result()
+
+    def close(self, timeout: float = 5.0):
+        """Stop accepting items and let the worker finish what is queued."""
+        self._closed = True
+        self._queue.put(None)
+        self._worker.join(timeout)
+
+    def _collect(self):
+        first = self._queue.get()
+        if first is None:
+            return None
+        batch = [first]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                entry = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if entry is None:
+                # Shut down after this batch
+                self._queue.put(None)
+                break
+            batch.append(entry)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            if batch is None:
+                return
+            items = [item for item, _ in batch]
+            try:
+                results = self.batch_fn(items)
+                if len(results) != len(items):
+                    raise RuntimeError(f"batch_fn returned {len(results)} results for {len(items)} items")
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            self.batches += 1
+            self.items += len(items)
+            for (_, future), result in zip(batch, results):
+                future.set_result(result)
+
+
+def _shape(value) -> Any:
+    """Structure of a pipeline result (nesting, lengths and keys), without the scores."""
+    if isinstance(value, dict):
+        return tuple(sorted(value))
+    if isinstance(value, (list, tuple)):
+        return [_shape(item) for item in value]
+    return type(value).__name__
+
+
+class BatchedPipeline:
+    """
+    Stands in for a text-classification pipeline and batches single-text calls.
+
+    Concurrent `pipeline(text, **kwargs)` calls are queued in a MicroBatcher and
+    run as one `pipeline([texts], **kwargs)` call, which pads the texts into one
+    forward pass; calls with other arguments go straight to the pipeline. The
+    first batch for each set of keyword arguments is checked against a
+    single-text call, and if their results are shaped differently those calls
+    are not batched.
+    """
+
+    def __init__(self, pipeline, max_batch_size: int = 16, max_wait_ms: float = 5.0,
+                 name: str = 'pipeline-batcher'):
+        self.pipeline = pipeline
+        self.name = name
+        self.batcher = MicroBatcher(self._run_batch, max_batch_size, max_wait_ms, name)
+        # repr of keyword arguments -> whether batched results match single-text calls
+        self._batchable: Dict[str, bool] = {}
+
+    def __call__(self, inputs, *args, **kwargs):
+        if args or not isinstance(inputs, str) or self._batchable.get(self._key(kwargs)) is False:
+            return self.pipeline(inputs, *args, **kwargs)
+        return self.batcher((inputs, kwargs))
+
+    def __getattr__(self, name):
+        return getattr(self.pipeline, name)
+
+    @staticmethod
+    def _key(kwargs) -> str:
+        return repr(sorted(kwargs.items()))
+
+    def _run_batch(self, items):
+        # Calls with different options cannot share a forward pass
+        groups: Dict[str, List[int]] = {}
+        for i, (_, kwargs) in enumerate(items):
+            groups.setdefault(self._key(kwargs), []).append(i)
+        results = [None] * len(items)
+        for key, positions in groups.items():
+            kwargs = items[positions[0]][1]
+            texts = [items[i][0] for i in positions]
+            outputs = [
+                # A single text gets a list of label dicts, also with the default top_k=1
+                [output] if isinstance(output, dict) else output
+                for output in self.pipeline(texts, **{'batch_size': len(texts), **kwargs})
+            ]
+            if key not in self._batchable:
+                single = self.pipeline(texts[0], **kwargs)
+                self._batchable[key] = _shape(single) == _shape(outputs[0])
+                if not self._batchable[key]:
+                    print(f"Batched results of {self.name} differ in shape from single calls; "
+                          f"not batching calls with {key}")
+            if not self._batchable[key]:
+                outputs = [self.pipeline(text, **kwargs) for text in texts]
+            for i, output in zip(positions, outputs):
+                results[i] = output
+        return results
@@ -0,0 +1,118 @@
+"""
+Precompiled multi-keyword matching.
+
+All keywords of a table are compiled into one trie-shaped regex, so a message is
+scanned once regardless of how many labels or keywords there are. ASCII keywords
+match whole words plus an inflection suffix ("exam" matches "exams", "die"
+matches "died"; "ill" matches neither "will" nor "illness", "mom" not "moment").
+Other forms ("suicidal", "hopelessness") have to be listed as keywords.
+Non-ASCII keywords (Devanagari) may start anywhere but must not be followed by
+another Devanagari letter or vowel sign ("माँ" does not match "माँग"); Python's
+word characters do not include vowel signs, so that boundary is spelt out.
+
+Hindi and Hinglish verbs inflect in ways a suffix list does not cover, so a
+keyword ending in "*" is a stem: its last word may continue with any letters
+("mar jaa*" matches "mar jaana", "mar jaane" and "mar jaaun", "मर जा*" matches
+"मर जाना" and "मर जाने"). Results are cached per message text.
+"""
+import re
+from functools import lru_cache
+from typing import Dict, FrozenSet, Iterable, List
+
+# Inflections an ASCII keyword may carry
+ASCII_SUFFIXES = ('s', 'es', 'd', 'ed', 'ing')
+# Devanagari letters, signs and digits; the danda and double danda end a word
+DEVANAGARI_WORD = '\u0900-\u0963\u0966-\u097f'
+
+
+class KeywordMatcher:
+    """Maps text to the set of labels whose keywords occur in it."""
+
+    def __init__(self, table: Dict[str, Iterable[str]], cache_size: int = 4096):
+        self.table: Dict[str, List[str]] = {label: list(keywords) for label, keywords in table.items()}
+        self._cache_size = cache_size
+        self._compile()
+
+    def add(self, label: str, keywords: Iterable[str]):
+        """Add keywords (e.g. Hindi/Hinglish variants) to a label and recompile."""
+        self.table.setdefault(label, []).extend(keywords)
+        self._compile()
+
+    def match(self, text: str) -> FrozenSet[str]:
+        """Labels with at least one keyword in `text` (case-insensitive)."""
+        if not text:
+            return frozenset()
+        return self._match_cached(text)
+
+    def count(self, text: str) -> Dict[str, int]:
+        """Number of keyword hits per label in `text`."""
+        counts: Dict[str, int] = {}
+        for m in self._pattern.finditer((text or '').lower()):
+            for label in self._hit(m):
+                counts[label] = counts.get(label, 0) + 1
+        return counts
+
+    def _compile(self):
+        # keyword -> labels, used to map each hit back to its topics
+        self._labels: Dict[str, FrozenSet[str]] = {}
+        for label, keywords in self.table.items():
+            for keyword in keywords:
+                key = keyword.lower()
+                self._labels[key] = self._labels.get(key, frozenset()) | {label}
+        
+        # A trie-shaped pattern lets the regex engine reject most positions after one
+        # character instead of trying every keyword in turn
+        words = [k for k in self._labels if not k.endswith('*')]
+        stems = [k[:-1] for k in self._labels if k.endswith('*')]
+        ascii_keys = [k for k in words if k.isascii()]
+        other_keys = [k for k in words if not k.isascii()]
+        ascii_stems = [k for k in stems if k.isascii()]
+        other_stems = [k for k in stems if not k.isascii()]
+        parts = []
+        # The keyword itself is captured (without the suffix) to look up its labels
+        if ascii_keys:
+            suffixes = "|".join(ASCII_SUFFIXES)
+            parts.append(rf"\b(?P<a>{self._trie_pattern(ascii_keys)})(?:{suffixes})?(?!\w)")
+        if ascii_stems:
+            parts.append(rf"\b(?P<as>{self._trie_pattern(ascii_stems)})\w*")
+        if other_keys:
+            parts.append(rf"(?P<o>{self._trie_pattern(other_keys)})(?![\w{DEVANAGARI_WORD}])")
+        if other_stems:
+            parts.append(rf"(?P<os>{self._trie_pattern(other_stems)})[\w{DEVANAGARI_WORD}]*")
+        # Keywords are stored lowercased and text is lowercased before scanning,
+        # which is noticeably faster than re.IGNORECASE
+        self._pattern = re.compile("|".join(parts) or r"(?!)")
+        self._match_cached = lru_cache(maxsize=self._cache_size)(self._match)
+
+    @classmethod
+    def _trie_pattern(cls, keywords: List[str]) -> str:
+        """Build a regex equivalent to `kw1|kw2|...` with shared prefixes factored out."""
+        trie: Dict = {}
+        for keyword in keywords:
+            node = trie
+            for char in keyword:
+                node = node.setdefault(char, {})
+            node[''] = True
+        return cls._node_pattern(trie)
+
+    @classmethod
+    def _node_pattern(cls, node: Dict) -> str:
+        # Longer continuations first so "can't sleep" wins over "can't" at the same position
+        branches = [re.escape(char) + cls._node_pattern(child) for char, child in sorted(node.items()) if char]
+        if not branches:
+            return ''
+        body = branches[0] if len(branches) == 1 else "(?:" + "|".join(branches) + ")"
+        if '' in node:
+            return "(?:" + body + ")?"
+        return body
+
+    def _hit(self, m) -> FrozenSet[str]:
+        """Labels of the keyword (or stem) behind a match."""
+        key = m.group(m.lastgroup)
+        return self._labels[key + '*' if m.lastgroup in ('as', 'os') else key]
+
+    def _match(self, text: str) -> FrozenSet[str]:
+        labels = frozenset()
+        for m in self._pattern.finditer(text.lower()):
+            labels |= self._hit(m)
+        return labels
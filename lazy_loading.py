@@ -0,0 +1,37 @@
+"""
+Deferred initialization for expensive dependencies.
+
+The torch-backed detectors, the Gemini client and the MongoDB connection are only
+built when first used, so importing terminal_chat and constructing a manager is
+cheap and a process can start accepting connections before the models are ready.
+"""
+import threading
+from typing import Any, Callable
+
+
+class lazy_attribute:
+    """
+    Instance attribute computed by the decorated method on first access.
+
+    Works like functools.cached_property, but the first computation is serialized
+    so concurrent requests do not load the same model twice. Assigning the
+    attribute (e.g. a fake in benchmarks) replaces it without building it.
+    """
+
+    def __init__(self, factory: Callable[[Any], Any]):
+        self.factory = factory
+        self.name = factory.__name__
+        self.__doc__ = factory.__doc__
+        self._lock = threading.RLock()
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, instance, owner=None):
+        if instance is None:
+            return self
+        with self._lock:
+            if self.name not in instance.__dict__:
+                instance.__dict__[self.name] = self.factory(instance)
+        return instance.__dict__[self.name]
+
@@ -0,0 +1,161 @@
+"""
+Compact storage layout for chat messages.
+
+Legacy messages are stored as
+
+    {'role': 'user', 'content': '...', 'timestamp': '2024-05-01 10:00:00.123456',
+     'emotions': {'anger': 0.01, ...}, 'dominant_emotion': 'sadness',
+     'crisis_detected': {'is_crisis': False, 'risk_level': 'low'}}
+
+and compact ones as
+
+    {'r': 'u', 'c': '...', 't': datetime(...), 'e': [0.01, ...], 'd': 5}
+
+with emotion scores in EMOTION_LABELS order, the dominant emotion as an index,
+crisis info only when it is not the low-risk default, and long bodies optionally
+compressed ('z' for zlib, 's' for zstd). Unknown fields are kept as they are.
+decode_message() accepts both layouts, so collections can be migrated gradually.
+"""
+import zlib
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, Optional
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Fixed order of the emotion vector; changing it requires migrating stored messages
+EMOTION_LABELS = ('anger', 'disgust', 'fear', 'joy', 'neutral', 'sadness', 'surprise')
+_EMOTION_INDEX = {label: i for i, label in enumerate(EMOTION_LABELS)}
+
+_ROLES = {'user': 'u', 'assistant': 'a'}
+_ROLE_NAMES = {code: role for role, code in _ROLES.items()}
+_RISK_LEVELS = {'low': 'l', 'medium': 'm', 'high': 'h'}
+_RISK_NAMES = {code: level for level, code in _RISK_LEVELS.items()}
+
+COMPRESSIONS = ('none', 'zlib', 'zstd')
+
+# Fields of a legacy message that the compact layout encodes
+_ENCODED = {'role', 'content', 'timestamp', 'emotions', 'dominant_emotion', 'crisis_detected'}
+_COMPACT_FIELDS = {'r', 'c', 'z', 's', 't', 'e', 'ex', 'd', 'k', 'kc', 'kx'}
+
+
+def is_compact(message: Dict[str, Any]) -> bool:
+    return 'r' in message
+
+
+def encode_message(message: Dict[str, Any], compression: str = 'zlib', compress_min_bytes: int = 256) -> Dict[str, Any]:
+    """Convert a message to the compact layout (compact messages are returned unchanged)."""
+    if is_compact(message):
+        return message
+
+    role = message.get('role')
+    doc: Dict[str, Any] = {'r': _ROLES.get(role, role)}
+    doc.update(_encode_content(message.get('content', ''), compression, compress_min_bytes))
+
+    timestamp = message.get('timestamp')
+    if isinstance(timestamp, str):
+        # Older messages hold str(datetime.now()); unparseable values are kept as they are
+        timestamp = _parse_timestamp(timestamp) or timestamp
+    if timestamp is not None:
+        doc['t'] = timestamp
+
+    emotions = message.get('emotions')
+    if emotions:
+        doc['e'] = [emotions.get(label) for label in EMOTION_LABELS]
+        extra = {label: score for label, score in emotions.items() if label not in _EMOTION_INDEX}
+        if extra:
+            doc['ex'] = extra
+    dominant = message.get('dominant_emotion')
+    if dominant is not None:
+        doc['d'] = _EMOTION_INDEX.get(dominant, dominant)
+
+    crisis = message.get('crisis_detected')
+    if crisis:
+        if crisis.get('is_crisis'):
+            doc['kc'] = True
+        risk = crisis.get('risk_level')
+        if risk not in (None, 'low'):
+            doc['k'] = _RISK_LEVELS.get(risk, risk)
+        extra = {key: value for key, value in crisis.items() if key not in ('is_crisis', 'risk_level')}
+        if extra:
+            doc['kx'] = extra
+        if 'k' not in doc and 'kc' not in doc and 'kx' not in doc:
+            # Keeps "crisis checked, low risk" distinguishable from "not checked"
+            doc['k'] = 'l'
+
+    for key, value in message.items():
+        if key not in _ENCODED:
+            doc[key] = value
+    return doc
+
+
+def decode_message(doc: Dict[str, Any]) -> Dict[str, Any]:
+    """Convert a stored message of either layout to the legacy in-memory shape."""
+    if not is_compact(doc):
+        return doc
+
+    message: Dict[str, Any] = {
+        'role': _ROLE_NAMES.get(doc['r'], doc['r']),
+        'content': _decode_content(doc)
+    }
+    if 't' in doc:
+        message['timestamp'] = doc['t']
+    if 'e' in doc:
+        emotions = {label: score for label, score in zip(EMOTION_LABELS, doc['e']) if score is not None}
+        emotions.update(doc.get('ex', {}))
+        message['emotions'] = emotions
+    if 'd' in doc:
+        dominant = doc['d']
+        message['dominant_emotion'] = EMOTION_LABELS[dominant] if isinstance(dominant, int) else dominant
+    if 'k' in doc or 'kc' in doc or 'kx' in doc:
+        risk = doc.get('k', 'l')
+        message['crisis_detected'] = {
+            'is_crisis': doc.get('kc', False),
+            'risk_level': _RISK_NAMES.get(risk, risk),
+            **doc.get('kx', {})
+        }
+
+    for key, value in doc.items():
+        if key not in _COMPACT_FIELDS:
+            message[key] = value
+    return message
+
+
+def encode_messages(messages: Iterable[Dict[str, Any]], compression: str = 'zlib',
+                    compress_min_bytes: int = 256) -> List[Dict[str, Any]]:
+    return [encode_message(message, compression, compress_min_bytes) for message in messages]
+
+
+def decode_messages(docs: Optional[Iterable[Dict[str, Any]]]) -> List[Dict[str, Any]]:
+    return [decode_message(doc) for doc in docs or []]
+
+
+def _encode_content(content: str, compression: str, compress_min_bytes: int) -> Dict[str, Any]:
+    raw = content.encode('utf-8')
+    if compression == 'none' or len(raw) < compress_min_bytes:
+        return {'c': content}
+    if compression == 'zstd' and zstandard is not None:
+        packed, key = zstandard.ZstdCompressor(level=3).compress(raw), 's'
+    else:
+        packed, key = zlib.compress(raw, 6), 'z'
+    # Short or already dense text can grow when compressed
+    return {key: packed} if len(packed) < len(raw) else {'c': content}
+
+
+def _decode_content(doc: Dict[str, Any]) -> str:
+    if 'z' in doc:
+        return zlib.decompress(doc['z']).decode('utf-8')
+    if 's' in doc:
+        if zstandard is None:
+            raise RuntimeError("Message is zstd-compressed but the zstandard package is not installed")
+        return zstandard.ZstdDecompressor().decompress(doc['s']).decode('utf-8')
+    return doc.get('c', '')
+
+
+def _parse_timestamp(value: str) -> Optional[datetime]:
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        return None
@@ -0,0 +1,92 @@
+"""
+Rewrite stored chat histories into the compact message layout (or back).
+
+    python migrate_messages.py [--to compact|legacy] [--batch-size 100] [--dry-run]
+
+Each document is rewritten with a $set that only applies while its history still
+has the length that was read, so messages appended by a live chat in the meantime
+are never lost; such documents are skipped and picked up by the next run.
+"""
+import argparse
+
+import bson
+from pymongo import UpdateOne
+
+import terminal_chat
+from message_codec import COMPRESSIONS, decode_messages, encode_messages, is_compact
+
+
+def convert(history, target, compression, compress_min_bytes):
+    if target == 'compact':
+        return encode_messages(history, compression, compress_min_bytes)
+    return decode_messages(history)
+
+
+def migrate(collection, target='compact', compression='zlib', compress_min_bytes=256,
+            batch_size=100, dry_run=False, limit=0):
+    """Convert every document with messages in the other layout; returns counters for reporting."""
+    # Documents holding at least one message in the layout being migrated away from
+    other_field = 'chat_history.role' if target == 'compact' else 'chat_history.r'
+    cursor = collection.find({other_field: {'$exists': True}}, {'chat_history': 1}).batch_size(batch_size)
+    if limit:
+        cursor = cursor.limit(limit)
+
+    stats = {'documents': 0, 'messages': 0, 'updated': 0, 'skipped': 0, 'bytes_before': 0, 'bytes_after': 0}
+    batch = []
+
+    def flush():
+        if batch and not dry_run:
+            result = collection.bulk_write(batch, ordered=False)
+            stats['updated'] += result.modified_count
+            stats['skipped'] += len(batch) - result.matched_count
+        batch.clear()
+
+    for doc in cursor:
+        history = doc.get('chat_history') or []
+        converted = convert(history, target, compression, compress_min_bytes)
+        stats['documents'] += 1
+        stats['messages'] += sum(is_compact(msg) != (target == 'compact') for msg in history)
+        stats['bytes_before'] += len(bson.encode({'chat_history': history}))
+        stats['bytes_after'] += len(bson.encode({'chat_history': converted}))
+        batch.append(UpdateOne(
+            {'_id': doc['_id'], 'chat_history': {'$size': len(history)}},
+            {'$set': {'chat_history': converted}}
+        ))
+        if len(batch) >= batch_size:
+            flush()
+    flush()
+    return stats
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Migrate chat_histories between message layouts")
+    parser.add_argument('--to', dest='target', choices=('compact', 'legacy'), default='compact')
+    parser.add_argument('--compression', choices=COMPRESSIONS, default=terminal_chat.MESSAGE_COMPRESSION)
+    parser.add_argument('--compress-min-bytes', type=int, default=terminal_chat.MESSAGE_COMPRESS_MIN_BYTES)
+    parser.add_argument('--batch-size', type=int, default=100, help="Documents per bulk write")
+    parser.add_argument('--limit', type=int, default=0, help="Stop after this many documents (0 for all)")
+    parser.add_argument('--dry-run', action='store_true', help="Report the size change without writing")
+    parser.add_argument('--uri', default=None, help="MongoDB URI (defaults to MONGO_CONNECTION_STRING)")
+    args = parser.parse_args(argv)
+
+    collection = terminal_chat.get_mongo_client(args.uri)['chatbot_db'].get_collection(
+        'chat_histories', write_concern=terminal_chat.chat_write_concern()
+    )
+    stats = migrate(
+        collection, args.target, args.compression, args.compress_min_bytes,
+        batch_size=args.batch_size, dry_run=args.dry_run, limit=args.limit
+    )
+
+    before, after = stats['bytes_before'], stats['bytes_after']
+    print(f"documents:  {stats['documents']} ({stats['messages']} messages converted)")
+    print(f"history:    {before / 1024:.0f} KiB -> {after / 1024:.0f} KiB"
+          f" ({(1 - after / before) * 100 if before else 0:.0f}% smaller)")
+    if args.dry_run:
+        print("dry run: nothing written")
+    else:
+        print(f"updated:    {stats['updated']}")
+        print(f"skipped:    {stats['skipped']} (changed while migrating; run again)")
+
+
+if __name__ == "__main__":
+    main()
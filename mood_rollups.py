@@ -0,0 +1,201 @@
+"""
+Daily mood rollups for institutional dashboards.
+
+Emotion scores and crisis results are only stored inside each user's
+chat_history array, so every trend query would have to read every message. This
+module keeps one small document per user per day and one per cohort per day:
+
+    {'_id': 'cohort|iit-b|2024-05-01', 'scope': 'cohort', 'key': 'iit-b',
+     'cohort': 'iit-b', 'day': '2024-05-01', 'messages': 212,
+     'emotion_sums': {'sadness': 81.4, ...}, 'dominant': {'sadness': 97, ...},
+     'crisis': 2, 'risk': {'medium': 5, 'high': 2}}
+
+Only user messages with emotion scores are counted, and the mean score of an
+emotion is emotion_sums / messages. rollup_updates() returns the `$inc`
+updates for one saved message. backfill() rebuilds whole days from the stored
+histories, so trend reads cost O(days), not O(messages).
+"""
+from datetime import date, datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+from message_codec import decode_messages
+
+ROLLUP_INDEXES = [
+    ([('scope', 1), ('key', 1), ('day', 1)], {'name': 'scope_key_day'}),
+    ([('scope', 1), ('cohort', 1), ('day', 1)], {'name': 'scope_cohort_day'}),
+]
+
+
+def message_day(timestamp) -> Optional[str]:
+    """Day of a message timestamp as YYYY-MM-DD; older messages hold str(datetime)."""
+    if isinstance(timestamp, str):
+        try:
+            timestamp = datetime.fromisoformat(timestamp)
+        except ValueError:
+            return None
+    if isinstance(timestamp, (datetime, date)):
+        return timestamp.strftime('%Y-%m-%d')
+    return None
+
+
+def rollup_id(scope: str, key: str, day: str) -> str:
+    return f"{scope}|{key}|{day}"
+
+
+def message_counters(message: Dict[str, Any]) -> Optional[Dict[str, float]]:
+    """Counters a (decoded) message adds to its day, in dotted form; None for messages that do not count."""
+    emotions = message.get('emotions')
+    if message.get('role') != 'user' or not emotions:
+        return None
+    counters = {'messages': 1}
+    for label, score in emotions.items():
+        counters[f'emotion_sums.{label}'] = float(score)
+    dominant = message.get('dominant_emotion')
+    if dominant:
+        counters[f'dominant.{dominant}'] = 1
+    crisis = message.get('crisis_detected') or {}
+    if crisis.get('is_crisis'):
+        counters['crisis'] = 1
+    risk = crisis.get('risk_level')
+    if risk and risk != 'low':
+        counters[f'risk.{risk}'] = 1
+    return counters
+
+
+def rollup_updates(user_id: str, cohort: str, message: Dict[str, Any]) -> List[Tuple[str, Dict[str, Any]]]:
+    """(rollup _id, upsert update) for the user's and the cohort's day of a newly saved message."""
+    counters = message_counters(message)
+    day = message_day(message.get('timestamp'))
+    if counters is None or day is None:
+        return []
+    return [
+        (rollup_id(scope, key, day), {
+            '$inc': dict(counters),
+            '$setOnInsert': {'scope': scope, 'key': key, 'cohort': cohort, 'day': day}
+        })
+        for scope, key in (('user', user_id), ('cohort', cohort))
+    ]
+
+
+def _nest(counters: Dict[str, float]) -> Dict[str, Any]:
+    doc: Dict[str, Any] = {}
+    for name, value in counters.items():
+        field, _, sub = name.partition('.')
+        if sub:
+            doc.setdefault(field, {})[sub] = value
+        else:
+            doc[field] = value
+    return doc
+
+
+def _accumulate(totals: Dict[Tuple[str, str, str], Dict[str, float]], key, counters):
+    target = totals.setdefault(key, {})
+    for name, value in counters.items():
+        target[name] = target.get(name, 0) + value
+
+
+def _replacements(totals, cohorts: Dict[str, str]):
+    from pymongo import ReplaceOne
+
+    return [
+        ReplaceOne(
+            {'_id': rollup_id(scope, key, day)},
+            {'scope': scope, 'key': key, 'cohort': cohorts.get(key, key) if scope == 'user' else key,
+             'day': day, **_nest(counters)},
+            upsert=True
+        )
+        for (scope, key, day), counters in totals.items()
+    ]
+
+
+def backfill(chat_collection, rollup_collection, default_cohort: str = 'unassigned',
+             until: Optional[str] = None, batch_size: int = 100, limit: int = 0,
+             dry_run: bool = False) -> Dict[str, int]:
+    """
+    Rebuild the rollups of every day before `until` (YYYY-MM-DD, all days by default) from chat_histories.
+
+    Users are streamed with a cursor and their days are replaced in batches. Cohort
+    days are summed in memory (one entry per cohort and day) and written at the
+    end. Days from `until` on are left to the incremental updates, so a backfill
+    can run while the chat is live.
+    
+    With `limit` only the first users are read, so cohort sums would be partial:
+    their days are counted but not written (`stats['partial']`).
+    """
+    cursor = chat_collection.find(
+        {}, {'_id': 0, 'user_id': 1, 'cohort': 1, 'chat_history': 1}
+    ).batch_size(batch_size)
+    if limit:
+        cursor = cursor.limit(limit)
+
+    stats = {'users': 0, 'messages': 0, 'counted': 0, 'user_days': 0, 'cohort_days': 0, 'partial': bool(limit)}
+    cohort_totals: Dict[Tuple[str, str, str], Dict[str, float]] = {}
+    cohorts: Dict[str, str] = {}
+    batch = []
+
+    def write(requests):
+        if requests and not dry_run:
+            rollup_collection.bulk_write(requests, ordered=False)
+
+    for doc in cursor:
+        user_id = doc.get('user_id')
+        if not user_id:
+            continue
+        cohort = doc.get('cohort') or default_cohort
+        cohorts[user_id] = cohort
+        user_totals: Dict[Tuple[str, str, str], Dict[str, float]] = {}
+        history = doc.get('chat_history') or []
+        stats['users'] += 1
+        stats['messages'] += len(history)
+        for message in decode_messages(history):
+            counters = message_counters(message)
+            day = message_day(message.get('timestamp'))
+            if counters is None or day is None or (until and day >= until):
+                continue
+            stats['counted'] += 1
+            _accumulate(user_totals, ('user', user_id, day), counters)
+            _accumulate(cohort_totals, ('cohort', cohort, day), counters)
+
+        stats['user_days'] += len(user_totals)
+        batch.extend(_replacements(user_totals, cohorts))
+        if len(batch) >= batch_size:
+            write(batch)
+            batch = []
+    write(batch)
+
+    stats['cohort_days'] = len(cohort_totals)
+    if stats['partial']:
+        return stats
+    requests = _replacements(cohort_totals, cohorts)
+    for start in range(0, len(requests), batch_size):
+        write(requests[start:start + batch_size])
+    return stats
+
+
+def mood_trend(rollup_collection, scope: str, key: str, since: Optional[str] = None,
+               until: Optional[str] = None) -> List[Dict[str, Any]]:
+    """Daily mean emotion scores, dominant-emotion and crisis counts for one user or cohort, oldest first."""
+    day_filter: Dict[str, str] = {}
+    if since:
+        day_filter['$gte'] = since
+    if until:
+        day_filter['$lt'] = until
+    query: Dict[str, Any] = {'scope': scope, 'key': key}
+    if day_filter:
+        query['day'] = day_filter
+
+    trend = []
+    for doc in rollup_collection.find(query, {'_id': 0}).sort('day', 1):
+        messages = doc.get('messages', 0)
+        trend.append({
+            'day': doc['day'],
+            'messages': messages,
+            'emotions': {
+                label: total / messages for label, total in doc.get('emotion_sums', {}).items()
+            } if messages else {},
+            'dominant': doc.get('dominant', {}),
+            'crisis': doc.get('crisis', 0),
+            'risk': doc.get('risk', {})
+        })
+    return trend
+
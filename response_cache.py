@@ -0,0 +1,132 @@
+"""
+Caching layers around the Gemini chain.
+
+ResponseCache is a local LRU/TTL cache for opening messages ("hi", "I'm stressed
+about exams") that many users send almost verbatim. GeminiPrefixCache keeps the
+static system prompt in Gemini's context cache so it is not re-sent and re-billed
+on every call.
+"""
+import re
+import threading
+import time
+from collections import OrderedDict
+from datetime import timedelta
+from typing import Any, Dict, Hashable, Optional
+
+_PUNCTUATION = re.compile(r"[^\w\s']+")
+_WHITESPACE = re.compile(r"\s+")
+
+
+class ResponseCache:
+    """Thread-safe LRU cache with per-entry TTL and hit/miss counters."""
+
+    def __init__(self, max_entries: int = 1024, ttl_seconds: float = 3600):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        """Lowercase, drop punctuation and collapse whitespace so near-identical openers share a key."""
+        text = _PUNCTUATION.sub(' ', text.lower())
+        return _WHITESPACE.sub(' ', text).strip()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.monotonic() - entry[1] <= self.ttl_seconds:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key: Hashable, value: Any):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / lookups if lookups else 0.0,
+            'size': len(self._entries)
+        }
+
+
+class GeminiPrefixCache:
+    """
+    Provider-side context cache holding the system prompt.
+
+    Uses the google-generativeai caching API. Creation fails (and callers fall back
+    to sending the prompt) when the SDK is missing or the prompt is below the
+    model's minimum cacheable size.
+    """
+
+    # Extend the cache when less than this much of its TTL is left
+    REFRESH_MARGIN = timedelta(minutes=5)
+
+    def __init__(self, api_key: str, model: str, system_prompt: str, ttl: timedelta = timedelta(hours=1)):
+        self.api_key = api_key
+        self.model = model
+        self.system_prompt = system_prompt
+        self.ttl = ttl
+        self.name: Optional[str] = None
+        self.refreshes = 0
+        self._cache = None
+        self._expires_at = 0.0
+        self._lock = threading.Lock()
+
+    def create(self) -> bool:
+        try:
+            import google.generativeai as genai
+            from google.generativeai import caching
+
+            genai.configure(api_key=self.api_key)
+            self._cache = caching.CachedContent.create(
+                model=self.model,
+                display_name='mindsahayak-system-prompt',
+                system_instruction=self.system_prompt,
+                ttl=self.ttl
+            )
+        except Exception as e:
+            print(f"Gemini context caching unavailable, sending the system prompt with each call: {e}")
+            return False
+        self.name = self._cache.name
+        self._expires_at = time.monotonic() + self.ttl.total_seconds()
+        return True
+
+    def refresh(self):
+        """Extend the cache's TTL if it is close to expiring; cheap when it is not."""
+        if self._cache is None or self._expires_at - time.monotonic() > self.REFRESH_MARGIN.total_seconds():
+            return
+        with self._lock:
+            if self._expires_at - time.monotonic() > self.REFRESH_MARGIN.total_seconds():
+                return
+            try:
+                self._cache.update(ttl=self.ttl)
+                self._expires_at = time.monotonic() + self.ttl.total_seconds()
+                self.refreshes += 1
+            except Exception as e:
+                print(f"Error refreshing Gemini context cache: {e}")
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'name': self.name,
+            'model': self.model,
+            'refreshes': self.refreshes,
+            'seconds_left': max(0.0, self._expires_at - time.monotonic()) if self.name else 0.0
+        }
@@ -0,0 +1,263 @@
+"""
+Per-user chat session registry.
+
+Lets one process serve many users at once: each user gets a ChatSession with its
+own lock, and idle sessions are evicted by LRU order, TTL and an approximate
+memory cap so state does not accumulate across users.
+"""
+import asyncio
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager, contextmanager
+from typing import Any, Callable, Dict, Optional
+
+# Rough per-message overhead (dict, timestamp, emotion scores, LangChain message)
+MESSAGE_OVERHEAD_BYTES = 600
+
+
+class ChatSession:
+    """Conversation state for a single user."""
+
+    def __init__(self, user_id: str, user_data: Dict[str, Any], message_history=None):
+        self.user_id = user_id
+        self.user_data = user_data
+        self.message_history = message_history
+        # Top-level fields changed since the last write, flushed with the next $push.
+        # Background writes drain them from the event loop, so they have their own lock.
+        self.pending_updates: Dict[str, Any] = {}
+        self._pending_lock = threading.Lock()
+        self.lock = threading.RLock()
+        # Held for a whole turn, sync or async; a plain Lock, since an async turn may
+        # acquire it from a worker thread and release it on the event loop
+        self.turn_lock = threading.Lock()
+        self.async_lock = asyncio.Lock()
+        # Latest background write for this user; the next one waits on it to keep order
+        self.persist_task = None
+        # (felt emotion, topics) for the last messages, kept by UserChatManager as
+        # messages are recorded, and the context block built from them
+        self.context_window = deque(maxlen=10)
+        self.context_text = None
+        # usage_metadata of the last model call, for per-turn prompt token reporting
+        self.last_usage = {}
+        self.last_used = time.monotonic()
+        self.active = 0
+        self.size_bytes = 0
+
+    def set_pending(self, key: str, value: Any) -> None:
+        with self._pending_lock:
+            self.pending_updates[key] = value
+
+    def take_pending(self) -> Dict[str, Any]:
+        """Return the pending fields and clear them in one step."""
+        with self._pending_lock:
+            pending, self.pending_updates = self.pending_updates, {}
+        return pending
+
+    def restore_pending(self, fields: Dict[str, Any]) -> None:
+        """Re-queue fields from a failed write unless they were set again since."""
+        with self._pending_lock:
+            for key, value in fields.items():
+                self.pending_updates.setdefault(key, value)
+
+    def approx_size(self) -> int:
+        """Estimate the memory held by this session from its stored messages."""
+        messages = self.user_data.get('chat_history', [])
+        content = sum(len(msg.get('content', '')) for msg in messages)
+        # Content is held twice: in user_data and in the LangChain message history
+        return 2 * content + MESSAGE_OVERHEAD_BYTES * len(messages)
+
+
+class SessionRegistry:
+    """Thread-safe LRU/TTL cache of ChatSession objects keyed by user_id."""
+
+    def __init__(
+        self,
+        max_sessions: int = 1000,
+        ttl_seconds: float = 1800,
+        max_bytes: int = 256 * 1024 * 1024,
+        on_evict: Optional[Callable[[ChatSession], None]] = None
+    ):
+        self.max_sessions = max_sessions
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self.on_evict = on_evict
+        self._sessions: "OrderedDict[str, ChatSession]" = OrderedDict()
+        self._loading: Dict[str, threading.Lock] = {}
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def __contains__(self, user_id: str) -> bool:
+        return user_id in self._sessions
+
+    @property
+    def total_bytes(self) -> int:
+        return self._total_bytes
+
+    def peek(self, user_id: str) -> Optional[ChatSession]:
+        """Return a session without touching its LRU position."""
+        return self._sessions.get(user_id)
+
+    def get(self, user_id: str) -> Optional[ChatSession]:
+        """Return a live session and mark it as most recently used."""
+        with self._lock:
+            session = self._sessions.get(user_id)
+            if session is not None:
+                if self._expired(session, time.monotonic()) and not session.active:
+                    evicted = [self._pop_locked(user_id)]
+                    session = None
+                else:
+                    session.last_used = time.monotonic()
+                    self._sessions.move_to_end(user_id)
+                    evicted = []
+            else:
+                evicted = []
+        self._notify(evicted)
+        return session
+
+    def get_or_load(self, user_id: str, loader: Callable[[], Optional[ChatSession]]) -> Optional[ChatSession]:
+        """
+        Return the session for `user_id`, calling `loader` if it is not cached.
+
+        Concurrent callers for the same user wait on a per-user lock so the user is
+        only loaded once; loads for different users run in parallel.
+        """
+        session = self.get(user_id)
+        if session is not None:
+            return session
+
+        with self._lock:
+            load_lock = self._loading.setdefault(user_id, threading.Lock())
+        with load_lock:
+            session = self.get(user_id)
+            if session is None:
+                session = loader()
+                if session is not None:
+                    self.put(session)
+            with self._lock:
+                self._loading.pop(user_id, None)
+        return session
+
+    def put(self, session: ChatSession) -> None:
+        """Insert or replace a session, evicting others if limits are exceeded."""
+        session.last_used = time.monotonic()
+        with self._lock:
+            previous = self._sessions.pop(session.user_id, None)
+            if previous is not None:
+                self._total_bytes -= previous.size_bytes
+            session.size_bytes = session.approx_size()
+            self._total_bytes += session.size_bytes
+            self._sessions[session.user_id] = session
+            evicted = self._evict_locked()
+        self._notify(evicted)
+
+    def remove(self, user_id: str) -> Optional[ChatSession]:
+        """Drop a session (e.g. when the user closes the chat) and run the eviction hook."""
+        with self._lock:
+            session = self._pop_locked(user_id) if user_id in self._sessions else None
+        if session is not None:
+            self._notify([session])
+        return session
+
+    def clear(self) -> None:
+        """Evict every session, running the eviction hook for each."""
+        with self._lock:
+            evicted = [self._pop_locked(user_id) for user_id in list(self._sessions)]
+        self._notify(evicted)
+
+    @contextmanager
+    def use(self, session: ChatSession):
+        """
+        Hold a session's locks for the duration of a turn.
+
+        Sessions in use are never evicted; their size is re-measured on release.
+        """
+        with self._lock:
+            session.active += 1
+        try:
+            with session.turn_lock, session.lock:
+                yield session
+        finally:
+            self._release(session)
+
+    @asynccontextmanager
+    async def ause(self, session: ChatSession):
+        """
+        Async counterpart of use().
+
+        Async turns queue on the session's asyncio lock and then take its turn lock,
+        so they are also serialized with sync turns for the same user.
+        """
+        with self._lock:
+            session.active += 1
+        try:
+            async with session.async_lock:
+                await self._acquire_turn(session)
+                try:
+                    yield session
+                finally:
+                    session.turn_lock.release()
+        finally:
+            self._release(session)
+
+    @staticmethod
+    async def _acquire_turn(session: ChatSession):
+        """Wait for a sync turn on the same session without blocking the event loop."""
+        if session.turn_lock.acquire(blocking=False):
+            return
+        acquire = asyncio.get_running_loop().run_in_executor(None, session.turn_lock.acquire)
+        try:
+            await asyncio.shield(acquire)
+        except asyncio.CancelledError:
+            # The worker thread still gets the lock; hand it back once it does
+            acquire.add_done_callback(lambda _: session.turn_lock.release())
+            raise
+
+    def _release(self, session: ChatSession):
+        with self._lock:
+            session.active -= 1
+            session.last_used = time.monotonic()
+            if self._sessions.get(session.user_id) is session:
+                self._sessions.move_to_end(session.user_id)
+                new_size = session.approx_size()
+                self._total_bytes += new_size - session.size_bytes
+                session.size_bytes = new_size
+            evicted = self._evict_locked()
+        self._notify(evicted)
+
+    def _expired(self, session: ChatSession, now: float) -> bool:
+        return bool(self.ttl_seconds) and now - session.last_used > self.ttl_seconds
+
+    def _pop_locked(self, user_id: str) -> ChatSession:
+        session = self._sessions.pop(user_id)
+        self._total_bytes -= session.size_bytes
+        return session
+
+    def _evict_locked(self):
+        """Evict expired sessions, then least recently used ones until within limits."""
+        evicted = []
+        now = time.monotonic()
+        for user_id, session in list(self._sessions.items()):
+            if session.active:
+                continue
+            over_limit = (
+                len(self._sessions) > self.max_sessions
+                or (self.max_bytes and self._total_bytes > self.max_bytes)
+            )
+            if not over_limit and not self._expired(session, now):
+                # Sessions are ordered by last use, so nothing newer can be expired
+                break
+            evicted.append(self._pop_locked(user_id))
+        return evicted
+
+    def _notify(self, evicted):
+        if not self.on_evict:
+            return
+        for session in evicted:
+            try:
+                self.on_evict(session)
+            except Exception as e:
+                print(f"Error evicting session for {session.user_id}: {e}")
@@ -0,0 +1,180 @@
+"""
+Per-stage latency metrics for chat turns.
+
+Each stage of a turn (detectors, context building, the model call, MongoDB
+writes, ...) is timed into a Prometheus-style histogram and, when OpenTelemetry
+is installed and tracing is enabled, also recorded as a span. With metrics
+disabled, stage() returns a shared no-op context manager, so instrumented code
+costs one attribute lookup and a method call.
+"""
+import threading
+import time
+from bisect import bisect_left
+from collections import deque
+from contextlib import nullcontext
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, Optional, Sequence
+
+# Upper bounds in seconds; LLM calls and model inference dominate the high end
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_NOOP = nullcontext()
+
+
+class _Histogram:
+    __slots__ = ('buckets', 'count', 'sum', 'errors', 'samples')
+
+    def __init__(self, bounds: Sequence[float], sample_size: int):
+        self.buckets = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.errors = 0
+        # Most recent durations, for exact percentiles in local reports
+        self.samples = deque(maxlen=sample_size)
+
+
+class _Span:
+    __slots__ = ('metrics', 'name', 'start', 'otel')
+
+    def __init__(self, metrics: 'StageMetrics', name: str):
+        self.metrics = metrics
+        self.name = name
+        self.otel = None
+
+    def __enter__(self):
+        if self.metrics.tracer is not None:
+            self.otel = self.metrics.tracer.start_as_current_span(f"chat.{self.name}")
+            self.otel.__enter__()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.metrics.observe(self.name, time.perf_counter() - self.start, failed=exc_type is not None)
+        if self.otel is not None:
+            self.otel.__exit__(exc_type, exc, tb)
+        return False
+
+
+class StageMetrics:
+    """Latency histograms per named stage, exportable in the Prometheus text format."""
+
+    def __init__(
+        self,
+        enabled: bool = True,
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+        sample_size: int = 1024,
+        tracing: bool = False,
+        prefix: str = 'mindsahayak'
+    ):
+        self.enabled = enabled
+        self.bounds = tuple(buckets)
+        self.sample_size = sample_size
+        self.prefix = prefix
+        self.tracer = _otel_tracer() if enabled and tracing else None
+        self._stages: Dict[str, _Histogram] = {}
+        self._lock = threading.Lock()
+
+    def stage(self, name: str):
+        """Context manager timing one stage; a shared no-op when metrics are disabled."""
+        if not self.enabled:
+            return _NOOP
+        return _Span(self, name)
+
+    def observe(self, name: str, seconds: float, failed: bool = False):
+        """Record a duration measured by the caller (e.g. across a generator's yields)."""
+        if not self.enabled:
+            return
+        index = bisect_left(self.bounds, seconds)
+        with self._lock:
+            histogram = self._stages.get(name)
+            if histogram is None:
+                histogram = self._stages[name] = _Histogram(self.bounds, self.sample_size)
+            histogram.buckets[index] += 1
+            histogram.count += 1
+            histogram.sum += seconds
+            histogram.samples.append(seconds)
+            if failed:
+                histogram.errors += 1
+
+    def reset(self):
+        with self._lock:
+            self._stages.clear()
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        """Count, mean, p50, p95 and p99 (seconds, over recent samples) per stage."""
+        report = {}
+        with self._lock:
+            stages = {name: (h.count, h.sum, h.errors, sorted(h.samples)) for name, h in self._stages.items()}
+        for name, (count, total, errors, samples) in stages.items():
+            report[name] = {
+                'count': count,
+                'errors': errors,
+                'mean': total / count if count else 0.0,
+                'p50': _percentile(samples, 50),
+                'p95': _percentile(samples, 95),
+                'p99': _percentile(samples, 99)
+            }
+        return report
+
+    def to_prometheus(self) -> str:
+        """Render the histograms in the Prometheus text exposition format."""
+        metric = f"{self.prefix}_stage_seconds"
+        errors = f"{self.prefix}_stage_errors_total"
+        lines = [
+            f"# HELP {metric} Latency of chat turn stages in seconds.",
+            f"# TYPE {metric} histogram"
+        ]
+        with self._lock:
+            stages = sorted((name, list(h.buckets), h.count, h.sum, h.errors) for name, h in self._stages.items())
+        for name, buckets, count, total, _ in stages:
+            cumulative = 0
+            for bound, hits in zip(self.bounds, buckets):
+                cumulative += hits
+                lines.append(f'{metric}_bucket{{stage="{name}",le="{bound}"}} {cumulative}')
+            lines.append(f'{metric}_bucket{{stage="{name}",le="+Inf"}} {count}')
+            lines.append(f'{metric}_sum{{stage="{name}"}} {total}')
+            lines.append(f'{metric}_count{{stage="{name}"}} {count}')
+        lines.append(f"# HELP {errors} Chat turn stages that raised an exception.")
+        lines.append(f"# TYPE {errors} counter")
+        for name, _, _, _, failed in stages:
+            lines.append(f'{errors}{{stage="{name}"}} {failed}')
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port: int, host: str = '0.0.0.0') -> ThreadingHTTPServer:
+        """Expose to_prometheus() on http://host:port/metrics from a daemon thread."""
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = metrics.to_prometheus().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True).start()
+        return server
+
+
+def _otel_tracer() -> Optional[Any]:
+    try:
+        from opentelemetry import trace
+    except ImportError:
+        print("opentelemetry is not installed; stage tracing disabled")
+        return None
+    return trace.get_tracer('mindsahayak.chat')
+
+
+def _percentile(sorted_values, pct) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(pct / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
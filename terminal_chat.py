@@ -2,12 +2,17 @@
 import os
 import json
 import uuid
+import asyncio
+import threading
+import time
 import warnings
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 from pathlib import Path
-from typing import Dict, List, Any, Optional
+from typing import Dict, List, Any, Optional, Iterator, AsyncIterator
 from dotenv import load_dotenv
-from pymongo import MongoClient # <-- ADDED: Import the MongoDB client
+# pymongo, motor, the Gemini client and the torch-backed detectors are imported on
+# first use (see lazy_loading) to keep cold starts short
 
 # Suppress PyTorch deprecation warnings
 warnings.filterwarnings(
@@ -16,15 +21,22 @@ warnings.filterwarnings(
     category=FutureWarning,
     module='torch.nn.modules.module'
 )
-from langchain_google_genai import ChatGoogleGenerativeAI
 from langchain_core.messages import SystemMessage, HumanMessage, AIMessage
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder, HumanMessagePromptTemplate
 from langchain_core.runnables.history import RunnableWithMessageHistory
-from langchain_community.chat_message_histories import ChatMessageHistory
+# Same class langchain_community re-exports as ChatMessageHistory, without its import cost
+from langchain_core.chat_history import InMemoryChatMessageHistory as ChatMessageHistory
 
-# Import our emotion detector
-from emotion_detector import emotion_detector
-from advanced_crisis_detector import AdvancedCrisisDetector
+from session_registry import ChatSession, SessionRegistry
+from keyword_matcher import KeywordMatcher
+from response_cache import GeminiPrefixCache, ResponseCache
+from lazy_loading import lazy_attribute
+from inference_backend import apply_backend, batch_pipelines
+from crisis_triage import CrisisTriage
+from message_codec import decode_messages, encode_messages
+from stage_metrics import StageMetrics
+from write_behind import WriteBehindQueue
+from mood_rollups import ROLLUP_INDEXES, mood_trend, rollup_updates
 
 # Suppress LangChain deprecation warnings
 warnings.filterwarnings("ignore", category=UserWarning, module="langchain")
@@ -34,10 +46,117 @@ load_dotenv()
 GEMINI_API_KEY = os.getenv('GOOGLE_API_KEY')
 MONGO_CONNECTION_STRING = os.getenv('MONGO_CONNECTION_STRING') # <-- ADDED: Get MongoDB connection string
 
-if not GEMINI_API_KEY:
-    raise ValueError("GOOGLE_API_KEY is not found in .env")
-if not MONGO_CONNECTION_STRING: # <-- ADDED: Check for the connection string
-    raise ValueError("MONGO_CONNECTION_STRING is not found in .env")
+# Both are checked when the Gemini client / MongoDB connection is first created, so the
+# module can be imported (e.g. by the offline benchmarks) without them
+
+# Number of stored messages replayed into the LLM history; older turns are folded
+# into a rolling summary. 0 replays the full history.
+HISTORY_WINDOW_MESSAGES = int(os.getenv('HISTORY_WINDOW_MESSAGES', '20'))
+# How many messages may overflow the window before they are folded into the summary
+HISTORY_SUMMARY_BATCH = int(os.getenv('HISTORY_SUMMARY_BATCH', '10'))
+# Upper bound on unsummarized messages folded in one go when a user is hydrated
+HISTORY_SUMMARY_MAX_FOLD = 200
+
+# Layout of stored messages: 'compact' (short field codes, emotion vectors, see
+# message_codec) or 'legacy'. Both are always readable. Compact bodies of at least
+# MESSAGE_COMPRESS_MIN_BYTES are compressed with MESSAGE_COMPRESSION (none/zlib/zstd).
+# Compression is opt-in: compressed bodies can no longer be searched or read by other
+# tools on the server, only decoded by message_codec.
+MESSAGE_SCHEMA = os.getenv('MESSAGE_SCHEMA', 'compact')
+MESSAGE_COMPRESSION = os.getenv('MESSAGE_COMPRESSION', 'none')
+MESSAGE_COMPRESS_MIN_BYTES = int(os.getenv('MESSAGE_COMPRESS_MIN_BYTES', '256'))
+
+# Per-stage latency histograms (see stage_metrics); METRICS_PORT > 0 serves them for
+# Prometheus at /metrics, STAGE_TRACING=1 also emits OpenTelemetry spans
+STAGE_METRICS = os.getenv('STAGE_METRICS', '1') == '1'
+STAGE_TRACING = os.getenv('STAGE_TRACING', '0') == '1'
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))
+
+# Chat writes are queued per user and written with one bulk_write every
+# WRITE_BEHIND_INTERVAL_MS, so turns do not wait on MongoDB. Writes carrying
+# URGENT_USER_FLAGS, closing a session and reading a user's stored history write that
+# user's queue first. 0 writes every update synchronously.
+WRITE_BEHIND_INTERVAL_MS = float(os.getenv('WRITE_BEHIND_INTERVAL_MS', '250'))
+WRITE_BEHIND_MAX_USERS = int(os.getenv('WRITE_BEHIND_MAX_USERS', '500'))
+# Updates MongoDB rejects this many times are dropped and logged instead of retried forever
+WRITE_BEHIND_MAX_ATTEMPTS = int(os.getenv('WRITE_BEHIND_MAX_ATTEMPTS', '5'))
+URGENT_USER_FLAGS = ('needs_immediate_attention', 'needs_follow_up')
+
+# Daily per-user and per-cohort emotion and crisis counts in mood_rollups (see
+# mood_rollups), updated from saved messages and written every
+# MOOD_ROLLUP_INTERVAL_MS. Users without a `cohort` field count towards
+# MOOD_DEFAULT_COHORT. backfill_mood_rollups.py rebuilds them from chat_histories.
+MOOD_ROLLUPS = os.getenv('MOOD_ROLLUPS', '1') == '1'
+MOOD_ROLLUP_INTERVAL_MS = float(os.getenv('MOOD_ROLLUP_INTERVAL_MS', '1000'))
+MOOD_DEFAULT_COHORT = os.getenv('MOOD_DEFAULT_COHORT', 'unassigned')
+
+# Messages per page served to the chat screen by get_history_page
+HISTORY_PAGE_SIZE = int(os.getenv('HISTORY_PAGE_SIZE', '30'))
+HISTORY_PAGE_MAX = 200
+
+# Limits for the in-process session registry (one session per active user)
+SESSION_MAX_USERS = int(os.getenv('SESSION_MAX_USERS', '1000'))
+SESSION_TTL_SECONDS = float(os.getenv('SESSION_TTL_SECONDS', '1800'))
+SESSION_MAX_BYTES = int(os.getenv('SESSION_MAX_MB', '256')) * 1024 * 1024
+
+# Threads used by aget_response for the CPU-bound detectors and blocking fallbacks
+DETECTOR_WORKERS = int(os.getenv('DETECTOR_WORKERS', '4'))
+
+# Weight of the newest message in the exponentially-decayed emotion trend
+EMOTION_TREND_ALPHA = float(os.getenv('EMOTION_TREND_ALPHA', '0.3'))
+
+# Micro-batching of emotion inference across concurrent sessions: the emotion
+# detector's text-classification pipelines are wrapped so that single-message calls
+# arriving within EMOTION_BATCH_WAIT_MS share one forward pass (see inference_batcher).
+# Batch size 0 or 1 disables it.
+EMOTION_BATCH_SIZE = int(os.getenv('EMOTION_BATCH_SIZE', '16'))
+EMOTION_BATCH_WAIT_MS = float(os.getenv('EMOTION_BATCH_WAIT_MS', '5'))
+
+# Local cache of replies to opening messages of new conversations; size 0 disables it
+RESPONSE_CACHE_SIZE = int(os.getenv('RESPONSE_CACHE_SIZE', '0'))
+RESPONSE_CACHE_TTL_SECONDS = float(os.getenv('RESPONSE_CACHE_TTL_SECONDS', '3600'))
+
+# Keep SYSTEM_PROMPT in Gemini's context cache instead of sending it with every call.
+# Context caching needs an explicitly versioned model.
+GEMINI_CONTEXT_CACHE = os.getenv('GEMINI_CONTEXT_CACHE', '0') == '1'
+GEMINI_CACHE_MODEL = os.getenv('GEMINI_CACHE_MODEL', 'models/gemini-1.5-flash-001')
+GEMINI_CACHE_TTL_SECONDS = int(os.getenv('GEMINI_CACHE_TTL_SECONDS', '3600'))
+
+# Load the models, Gemini client and MongoDB connection in a background thread as
+# soon as a manager is created, instead of on the first message
+WARMUP_ON_START = os.getenv('WARMUP_ON_START', '0') == '1'
+
+# CPU backend for the emotion and crisis models: torch, torch-int8 or onnx-int8
+INFERENCE_BACKEND = os.getenv('INFERENCE_BACKEND', 'torch')
+ONNX_CACHE_DIR = os.getenv('ONNX_CACHE_DIR', 'onnx_models')
+
+# Connection pool shared by every UserChatManager in the process, and the write
+# concern for chat writes (w=1 acknowledges on the primary; use "majority" for
+# stronger durability at the cost of latency)
+MONGO_MAX_POOL_SIZE = int(os.getenv('MONGO_MAX_POOL_SIZE', '100'))
+MONGO_MIN_POOL_SIZE = int(os.getenv('MONGO_MIN_POOL_SIZE', '0'))
+MONGO_CONNECT_TIMEOUT_MS = int(os.getenv('MONGO_CONNECT_TIMEOUT_MS', '5000'))
+MONGO_SERVER_SELECTION_TIMEOUT_MS = int(os.getenv('MONGO_SERVER_SELECTION_TIMEOUT_MS', '5000'))
+MONGO_SOCKET_TIMEOUT_MS = int(os.getenv('MONGO_SOCKET_TIMEOUT_MS', '10000'))
+MONGO_WRITE_CONCERN = os.getenv('MONGO_WRITE_CONCERN', '1')
+MONGO_WRITE_JOURNAL = os.getenv('MONGO_WRITE_JOURNAL', '0') == '1'
+
+# Indexes on chat_histories, created once at startup. user_id serves every lookup
+# and upsert; the timestamp indexes are for analytics queries.
+CHAT_HISTORY_INDEXES = [
+    ([('user_id', 1)], {'unique': True, 'name': 'user_id_unique'}),
+    ([('created_at', 1)], {'name': 'created_at'}),
+    ([('chat_history.timestamp', 1)], {'name': 'chat_history_timestamp'}),
+    ([('chat_history.t', 1)], {'name': 'chat_history_t'}),
+]
+
+# Top-level fields a session reads, fetched next to a `$slice` of chat_history when
+# the history is windowed. Listed explicitly: a `$slice`-only projection returns every
+# other field on MongoDB but drops them on mongomock. Add new user fields here.
+USER_FIELDS = (
+    'user_id', 'created_at', 'message_count', 'summarized_count', 'history_summary',
+    'emotion_stats', 'cohort', 'needs_immediate_attention', 'needs_follow_up'
+)
 
 # --- REMOVED: These are no longer needed as we are using MongoDB ---
 # CHAT_HISTORY_DIR = Path("user_chat_histories")
@@ -111,6 +230,110 @@ Use this information to:
 - End with an open-ended question to continue the dialogue
 - For crisis situations, prioritize safety and provide immediate resources"""
 
+# Keyword table for _identify_conversation_topics. Keywords match whole words plus a
+# plain inflection ("exam" also matches "exams", "mom" not "moment"), so other forms
+# are listed; add Hindi/Hinglish variants freely, the whole table is compiled into a
+# single pattern.
+TOPIC_KEYWORDS = {
+    'studies': ['exam', 'test', 'study', 'studies', 'studied', 'homework', 'assignment', 'class', 'school', 'college', 'marks',
+                'padhai', 'pariksha', 'tuition', 'coaching', 'backlog', 'result',
+                'पढ़ाई', 'परीक्षा', 'कॉलेज'],
+    'family': ['mom', 'dad', 'parents', 'family', 'sister', 'brother', 'mother', 'father',
+               'mummy', 'mumma', 'papa', 'maa', 'didi', 'bhaiya', 'ghar wale', 'gharwale', 'parivaar',
+               'परिवार', 'माँ', 'पापा'],
+    'relationships': ['friend', 'friendship', 'girlfriend', 'boyfriend', 'partner', 'relationship', 'dating',
+                      'dost', 'dosti', 'doston', 'yaar', 'breakup', 'crush',
+                      'दोस्त', 'दोस्तों', 'दोस्ती'],
+    'career': ['job', 'career', 'future', 'interview', 'resume', 'placement', 'internship',
+               'naukri', 'jee', 'neet', 'upsc',
+               'नौकरी'],
+    'stress': ['stress', 'stressful', 'anxious', 'anxiety', 'worry', 'worries', 'worried', 'overwhelmed',
+               'overwhelming', 'pressure', 'tension', 'pareshan', 'chinta', 'ghabrahat', 'dabav',
+               'तनाव', 'चिंता', 'परेशान', 'परेशानी'],
+    'sleep': ['sleep', 'sleepless', 'tired', 'insomnia', 'can\'t sleep', 'can’t sleep', 'restless',
+              'neend', 'so nahi', 'thakan',
+              'नींद'],
+    'health': ['sick', 'sickness', 'ill', 'pain', 'painful', 'headache', 'stomach', 'doctor', 'hospital',
+               'bimaar', 'dard', 'tabiyat',
+               'बीमार', 'दर्द']
+}
+
+CRISIS_KEYWORDS = [
+    'suicide', 'suicidal', 'end my life', 'kill myself', 'want to die',
+    'no reason to live', 'self harm', 'hurting myself',
+    "can't take it", 'giving up', 'hopeless', 'hopelessness', 'helpless', 'helplessness',
+    'ending my life', 'end it all', 'take my own life', "don't want to live", 'dont want to live',
+    'better off dead', 'better off without me', 'hurt myself', 'cut myself', 'overdose',
+    # Inflected and informal phrasings
+    'killing myself', 'kill my self', 'hang myself', 'hanging myself', 'wanna die', 'want to be dead',
+    'wish i was dead', 'wish i were dead', 'wish i could die', 'kms', 'self-harm', 'self-harming',
+    'self harming', 'selfharm', 'cutting myself', 'hurt myself on purpose', 'no one will miss me',
+    'nobody will miss me', 'gave up on life', 'give up on life', 'giving up on life', 'end things',
+    "don't want to exist", 'dont want to exist', 'not wake up',
+    # Hinglish; "*" marks a stem whose last word may inflect (see keyword_matcher)
+    'marna hai', 'marna chah*', 'mar ja*', 'mar jaa*', 'marne ka man*', 'marne ki soch*',
+    'jeena nahi', 'jina nahi', 'nahi jee sak*', 'nahi ji sak*', 'jee nahi sak*', 'ji nahi sak*',
+    'jeene ka man nahi', 'jeene ka mann nahi',
+    'khudkushi', 'aatmahatya', 'atmahatya', 'suicide kar', 'zindagi khatam', 'khud ko khatam', 'apni jaan',
+    # Hindi
+    'आत्महत्या', 'खुदकुशी', 'ख़ुदकुशी', 'मरना चाह*', 'मरना है', 'मर जा*', 'मरने का मन', 'मरने की सोच*',
+    'जीना नहीं', 'नहीं जी सक*', 'जी नहीं सक*', 'जीने का मन नहीं',
+    'ज़िंदगी खत्म', 'जिंदगी खत्म', 'अपनी जान'
+]
+
+# Weaker cues for the crisis pre-filter. Weights are per cue; several cues in one
+# message, also of the same tier, reinforce each other. The keyword tier alone
+# always reaches the model.
+CRISIS_TRIAGE_KEYWORDS = {
+    'keyword': CRISIS_KEYWORDS,
+    'warning': [
+        'no point', 'point of living', 'worthless', 'worthlessness', "can't go on", 'cant go on', 'no way out',
+        'disappear', 'never wake up', 'sleep forever', 'burden', 'nobody would care',
+        'no one would care', 'nobody would even care', 'if i died', 'hate myself', 'pills',
+        'jumping off', 'jump off', 'trapped', 'kill', 'killing', 'hang', 'die', 'dying', 'died', 'dead',
+        'goodbye letter', 'giving my things away', 'not be around', "wasn't here", 'done with everything',
+        "can't do this anymore", 'cant do this anymore', 'tablets', 'cut my',
+        # Absence from the future, means and places, wanting it to stop for good
+        "won't be around", 'being around', 'see myself being', 'no future', "what's the point", 'whats the point',
+        'point of waking', 'point in waking', 'painless', 'way to go', 'ways to die', 'how to die',
+        'ledge', 'terrace edge', 'roof edge', 'edge of the roof', 'edge of the terrace', 'edge of the bridge',
+        'in front of a train', 'in front of a bus', 'under a train', 'jump in front', 'jumping in front',
+        'all to stop', 'make it stop', 'make it all stop', 'end the pain',
+        'koi fayda nahi', 'sab khatam', 'umeed nahi', 'ummeed nahi', 'jeene ka', 'bojh',
+        'gayab ho*', 'koi nahi samajhta', 'sab kuch chhod*', 'sab chhod*', 'duniya chhod*',
+        'कोई फायदा नहीं', 'सब खत्म', 'उम्मीद नहीं', 'बोझ', 'गायब हो*', 'सब कुछ छोड़*', 'दुनिया छोड़*'
+    ],
+    'distress': [
+        'alone', 'lonely', 'loneliness', 'empty', 'emptiness', 'numb', 'numbness', 'exhausted', 'pointless', 'nothing matters',
+        'crying', 'tired of', 'permanently', 'forever', 'akela', 'akeli', 'akelapan', 'thak gaya', 'thak gayi',
+        'toot*', 'hamesha ke liye',
+        'अकेला', 'अकेली', 'थक गया', 'थक गई', 'हमेशा के लिए'
+    ]
+}
+CRISIS_TRIAGE_WEIGHTS = {'keyword': 1.0, 'warning': 0.6, 'distress': 0.2}
+# Messages scoring below the threshold skip the crisis model. The default 0 sends every
+# message to the model. 0.3 (or up to 0.5) reaches full recall on both fixture sets and
+# sends about one message in six to the model; opt in once `benchmark_chat.py triage`
+# also passes with fixtures from the deployment's own users and languages.
+# Every Nth skipped message is still checked by the model to catch pre-filter misses.
+CRISIS_TRIAGE_THRESHOLD = float(os.getenv('CRISIS_TRIAGE_THRESHOLD', '0'))
+CRISIS_SAMPLE_EVERY = int(os.getenv('CRISIS_SAMPLE_EVERY', '20'))
+
+# Crisis risk levels, lowest first. Unknown levels reported by a detector count as 'high'.
+RISK_LEVELS = ('low', 'medium', 'high', 'critical')
+
+# Compiled once per process and shared by every session
+TOPIC_MATCHER = KeywordMatcher(TOPIC_KEYWORDS)
+CRISIS_MATCHER = KeywordMatcher({'crisis': CRISIS_KEYWORDS})
+
+SUMMARY_PROMPT = """You maintain a running summary of a counseling conversation between a student and Aanya, their counselor.
+Update the summary with the new messages below. Keep it under 150 words and preserve:
+- the student's main concerns, life events and the people involved
+- their emotional state and how it has changed
+- coping strategies suggested and whether they helped
+- any crisis indicators or safety concerns
+Write in the third person and return only the updated summary."""
+
 def get_conversation_context(chat_history, max_messages=5):
     """Extract key context from recent chat history."""
     if not chat_history or len(chat_history) == 0:
@@ -130,38 +353,311 @@ def get_conversation_context(chat_history, max_messages=5):
     
     return "\n".join(["Recent conversation:"] + context[-5:])
 
+# Our emotion detector, loaded by get_emotion_detector(); importing it pulls in torch
+emotion_detector = None
+_emotion_detector_lock = threading.Lock()
+
+def get_emotion_detector():
+    """The shared emotion detector, imported on first use."""
+    global emotion_detector
+    if emotion_detector is None:
+        with _emotion_detector_lock:
+            if emotion_detector is None:
+                from emotion_detector import emotion_detector as detector
+                apply_backend(detector, INFERENCE_BACKEND, ONNX_CACHE_DIR)
+                if EMOTION_BATCH_SIZE > 1:
+                    batch_pipelines(detector, EMOTION_BATCH_SIZE, EMOTION_BATCH_WAIT_MS)
+                emotion_detector = detector
+    return emotion_detector
+
+_mongo_clients: Dict[Any, Any] = {}
+_indexed_collections = set()
+_mongo_lock = threading.Lock()
+
+def _mongo_client_options() -> Dict[str, Any]:
+    return {
+        'maxPoolSize': MONGO_MAX_POOL_SIZE,
+        'minPoolSize': MONGO_MIN_POOL_SIZE,
+        'connectTimeoutMS': MONGO_CONNECT_TIMEOUT_MS,
+        'serverSelectionTimeoutMS': MONGO_SERVER_SELECTION_TIMEOUT_MS,
+        'socketTimeoutMS': MONGO_SOCKET_TIMEOUT_MS
+    }
+
+def get_mongo_client(uri: Optional[str] = None, client_class=None):
+    """Return the process-wide client for `uri`, so all managers share one connection pool."""
+    if client_class is None:
+        from pymongo import MongoClient as client_class
+    uri = uri or MONGO_CONNECTION_STRING
+    if not uri:
+        raise ValueError("MONGO_CONNECTION_STRING is not found in .env")
+    key = (client_class, uri)
+    with _mongo_lock:
+        client = _mongo_clients.get(key)
+        if client is None:
+            client = _mongo_clients[key] = client_class(uri, **_mongo_client_options())
+    return client
+
+def chat_write_concern():
+    """Write concern for the chat path, from MONGO_WRITE_CONCERN / MONGO_WRITE_JOURNAL."""
+    from pymongo.write_concern import WriteConcern
+    
+    w = int(MONGO_WRITE_CONCERN) if MONGO_WRITE_CONCERN.isdigit() else MONGO_WRITE_CONCERN
+    return WriteConcern(w=w, j=True) if MONGO_WRITE_JOURNAL else WriteConcern(w=w)
+
+def encode_for_storage(messages) -> List[Dict[str, Any]]:
+    """Messages in the configured storage layout (MESSAGE_SCHEMA)."""
+    if MESSAGE_SCHEMA == 'compact':
+        return encode_messages(messages, MESSAGE_COMPRESSION, MESSAGE_COMPRESS_MIN_BYTES)
+    return list(messages)
+
+def ensure_indexes(collection, indexes=CHAT_HISTORY_INDEXES):
+    """Create `indexes` (CHAT_HISTORY_INDEXES by default) once per process; existing indexes are left as they are."""
+    from pymongo.errors import PyMongoError
+    
+    with _mongo_lock:
+        if collection.full_name in _indexed_collections:
+            return
+        _indexed_collections.add(collection.full_name)
+    # One at a time, so duplicate user_ids in old data only block the unique index
+    for keys, options in indexes:
+        try:
+            collection.create_index(keys, **options)
+        except PyMongoError as e:
+            print(f"Could not create index {options['name']} on {collection.full_name}: {e}")
+
+def combine_crisis(*results: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    One crisis verdict from several detectors, never lower than any of them.
+    
+    is_crisis is set if any detector set it and risk_level is the highest one
+    reported. Only these two fields are kept, so the stored verdict does not mix
+    details of detectors that disagree.
+    """
+    def rank(level):
+        return RISK_LEVELS.index(level) if level in RISK_LEVELS else RISK_LEVELS.index('high')
+    
+    results = [result for result in results if result]
+    levels = [result['risk_level'] for result in results if result.get('risk_level')]
+    return {
+        'is_crisis': any(result.get('is_crisis') for result in results),
+        'risk_level': max(levels, key=rank) if levels else 'low'
+    }
+
 class UserChatManager:
     def __init__(self):
-        """Initialize the chat manager with LLM, crisis detector, and conversation handlers."""
-        self.llm = ChatGoogleGenerativeAI(
+        """
+        Initialize the chat manager and its conversation handlers.
+        
+        The LLM, crisis detector and MongoDB connection are created on first use
+        (or by warm_up()), so construction does not wait on models or the network.
+        """
+        # Set when the llm is created with Gemini context caching
+        self.prefix_cache = None
+        self.response_cache = None
+        if RESPONSE_CACHE_SIZE > 0:
+            self.response_cache = ResponseCache(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL_SECONDS)
+        self.history_window = HISTORY_WINDOW_MESSAGES
+        self.sessions = SessionRegistry(
+            max_sessions=SESSION_MAX_USERS,
+            ttl_seconds=SESSION_TTL_SECONDS,
+            max_bytes=SESSION_MAX_BYTES,
+            on_evict=self._on_session_evicted
+        )
+        # User opened by get_or_create_user/initialize_conversation on each thread
+        self._local = threading.local()
+        self._executor = ThreadPoolExecutor(max_workers=DETECTOR_WORKERS, thread_name_prefix='detector')
+        # Persistence tasks scheduled by aget_response, kept so they are not garbage collected
+        self._background_tasks = set()
+        # Prompt/response token counts reported by the model, for verifying payload size
+        self.token_usage = {'turns': 0, 'input_tokens': 0, 'output_tokens': 0}
+        self._usage_lock = threading.Lock()
+        self.write_queue = None
+        if WRITE_BEHIND_INTERVAL_MS > 0:
+            self.write_queue = WriteBehindQueue(
+                self._write_user_updates,
+                flush_interval=WRITE_BEHIND_INTERVAL_MS / 1000,
+                max_pending=WRITE_BEHIND_MAX_USERS,
+                max_attempts=WRITE_BEHIND_MAX_ATTEMPTS,
+                name='chat-write-behind'
+            )
+        self.rollup_queue = None
+        if MOOD_ROLLUPS:
+            self.rollup_queue = WriteBehindQueue(
+                self._write_rollups,
+                flush_interval=MOOD_ROLLUP_INTERVAL_MS / 1000,
+                max_attempts=WRITE_BEHIND_MAX_ATTEMPTS,
+                name='mood-rollups'
+            )
+        
+        self._warmup_thread = self.warm_up() if WARMUP_ON_START else None
+        self._metrics_server = self.metrics.serve(METRICS_PORT) if METRICS_PORT and STAGE_METRICS else None
+
+    @lazy_attribute
+    def metrics(self):
+        """Latency histograms for the stages of a turn (detectors, context, model call, MongoDB)."""
+        return StageMetrics(enabled=STAGE_METRICS, tracing=STAGE_TRACING)
+
+    def get_metrics_text(self) -> str:
+        """Stage latency histograms in the Prometheus text format, for a /metrics endpoint."""
+        return self.metrics.to_prometheus()
+
+    @lazy_attribute
+    def llm(self):
+        """Gemini chat model, using the context-cached system prompt when enabled."""
+        from langchain_google_genai import ChatGoogleGenerativeAI
+        
+        if not GEMINI_API_KEY:
+            raise ValueError("GOOGLE_API_KEY is not found in .env")
+        if GEMINI_CONTEXT_CACHE:
+            prefix_cache = GeminiPrefixCache(
+                GEMINI_API_KEY, GEMINI_CACHE_MODEL, SYSTEM_PROMPT,
+                ttl=timedelta(seconds=GEMINI_CACHE_TTL_SECONDS)
+            )
+            if prefix_cache.create():
+                self.prefix_cache = prefix_cache
+                return ChatGoogleGenerativeAI(
+                    model=GEMINI_CACHE_MODEL,
+                    temperature=0.7,
+                    api_key=GEMINI_API_KEY,
+                    cached_content=prefix_cache.name
+                )
+        return ChatGoogleGenerativeAI(
             model='gemini-1.5-flash',
             temperature=0.7,
             api_key=GEMINI_API_KEY
         )
-        self.crisis_detector = AdvancedCrisisDetector()
-        self.current_user = None
-        self.conversation_chain = None
-        self.histories = {}
+
+    @lazy_attribute
+    def summary_llm(self):
+        """
+        Model for the rolling conversation summary.
         
+        The chat model itself unless it is bound to the context-cached counselor
+        prompt: Gemini rejects a system instruction together with cached content,
+        and summaries should not be written in Aanya's voice.
+        """
+        llm = self.llm
+        if self.prefix_cache is None:
+            return llm
+        from langchain_google_genai import ChatGoogleGenerativeAI
+        
+        return ChatGoogleGenerativeAI(
+            model='gemini-1.5-flash',
+            temperature=0.7,
+            api_key=GEMINI_API_KEY
+        )
+
+    @lazy_attribute
+    def crisis_detector(self):
+        from advanced_crisis_detector import AdvancedCrisisDetector
+        detector = AdvancedCrisisDetector()
+        apply_backend(detector, INFERENCE_BACKEND, ONNX_CACHE_DIR)
+        return detector
+
+    @lazy_attribute
+    def crisis_triage(self):
+        """Lexical pre-filter deciding which messages reach the crisis model."""
+        return CrisisTriage(
+            CRISIS_TRIAGE_KEYWORDS,
+            CRISIS_TRIAGE_WEIGHTS,
+            lambda text: self.crisis_detector.detect_crisis(text),
+            threshold=CRISIS_TRIAGE_THRESHOLD,
+            sample_every=CRISIS_SAMPLE_EVERY
+        )
+
+    @lazy_attribute
+    def conversation_chain(self):
+        """Chain with per-user history, built (with the llm) on first use."""
+        self._build_chain()
+        return self.__dict__['conversation_chain']
+
+    @lazy_attribute
+    def collection(self):
+        """chat_histories on the shared client; indexes are ensured on first use."""
         # --- ADDED: MongoDB Connection ---
         try:
-            self.client = MongoClient(MONGO_CONNECTION_STRING)
+            self.client = get_mongo_client()
             self.db = self.client['chatbot_db'] # You can name your database
-            self.collection = self.db['chat_histories'] # You can name your collection
+            collection = self.db.get_collection('chat_histories', write_concern=chat_write_concern())
+            ensure_indexes(collection)
             print("Successfully connected to MongoDB.")
+            return collection
         except Exception as e:
             print(f"Error connecting to MongoDB: {e}")
             raise
 
-        # Define the chat prompt template
-        self.prompt = ChatPromptTemplate.from_messages([
-            ("system", SYSTEM_PROMPT),
+    @lazy_attribute
+    def rollup_collection(self):
+        """mood_rollups, next to chat_histories."""
+        collection = get_mongo_client()['chatbot_db']['mood_rollups']
+        ensure_indexes(collection, ROLLUP_INDEXES)
+        return collection
+
+    @lazy_attribute
+    def async_collection(self):
+        """motor view of chat_histories, or None without motor (writes then run in a thread)."""
+        try:
+            from motor.motor_asyncio import AsyncIOMotorClient
+        except ImportError:
+            return None
+        return get_mongo_client(client_class=AsyncIOMotorClient)['chatbot_db'].get_collection(
+            'chat_histories', write_concern=chat_write_concern()
+        )
+
+    def warm_up(self, background: bool = True) -> Optional[threading.Thread]:
+        """
+        Load the detectors, the Gemini client and the MongoDB connection ahead of the first message.
+        
+        With `background` this runs in a daemon thread that is returned, so the
+        process can accept connections meanwhile; a request that arrives first
+        waits only for the pieces it needs.
+        """
+        steps = [
+            ('emotion detector', get_emotion_detector),
+            ('crisis detector', lambda: self.crisis_detector),
+            ('Gemini client', lambda: self.conversation_chain),
+            ('MongoDB', lambda: self.collection),
+        ]
+        
+        def load():
+            for name, step in steps:
+                try:
+                    step()
+                except Exception as e:
+                    print(f"Warm-up of {name} failed: {e}")
+        
+        if not background:
+            load()
+            return None
+        thread = threading.Thread(target=load, name='warm-up', daemon=True)
+        thread.start()
+        return thread
+
+    def _build_chain(self):
+        """Build the prompt template and base chain around `self.llm`."""
+        # Define the chat prompt template. The system prompt only lives here (never in
+        # the history), and the context block is rendered into the current turn only:
+        # RunnableWithMessageHistory stores just the raw `input` as the human message.
+        # With Gemini context caching the system prompt is already held by the provider.
+        llm = self.llm
+        messages = [
             MessagesPlaceholder(variable_name="history"),
-            ("human", "{input}")
-        ])
+            ("human", "{context}\n\nUser: {input}")
+        ]
+        if not getattr(self, 'prefix_cache', None):
+            messages.insert(0, ("system", SYSTEM_PROMPT))
+        self.prompt = ChatPromptTemplate.from_messages(messages)
         
         # Create the base chain
-        self.chain = self.prompt | self.llm
+        self.chain = self.prompt | llm
+        
+        # One chain serves every user; the session_id in the config selects the history
+        self.conversation_chain = RunnableWithMessageHistory(
+            self.chain,
+            self._get_session_history,
+            input_messages_key="input",
+            history_messages_key="history"
+        )
 
     # --- REMOVED: No longer needed ---
     # def generate_user_id(self):
@@ -173,54 +669,368 @@ class UserChatManager:
     #     """Get the path to a user's chat history file"""
     #     return CHAT_HISTORY_DIR / f"user_{user_id}.json"
 
-    def load_user_history(self, user_id):
-        """ --- UPDATED: Load chat history for a specific user from MongoDB --- """
+    def load_user_history(self, user_id, last_n=None):
+        """ --- UPDATED: Load chat history for a specific user from MongoDB --- 
+        
+        If `last_n` is given only the newest `last_n` messages are fetched, using a
+        `$slice` projection so the server never sends the full array.
+        """
         try:
+            self._sync_user_writes(user_id)
             # Find a document in the collection where the 'user_id' matches
-            user_data = self.collection.find_one({'user_id': user_id})
+            projection = None
+            if last_n:
+                projection = {**dict.fromkeys(USER_FIELDS, 1), 'chat_history': {'$slice': -last_n}}
+            with self.metrics.stage('load'):
+                user_data = self.collection.find_one({'user_id': user_id}, projection)
             # The _id field from MongoDB is not needed and can cause issues
             if user_data:
                 user_data.pop('_id', None)
+                user_data['chat_history'] = decode_messages(user_data.get('chat_history'))
             return user_data
         except Exception as e:
             print(f"Error loading user history from MongoDB: {e}")
             return None
 
+    def _count_stored_messages(self, user_id: str) -> Optional[int]:
+        """Count a stored user's messages on the server and save the counter (documents that predate it)."""
+        result = list(self.collection.aggregate([
+            {'$match': {'user_id': user_id}},
+            {'$project': {'n': {'$size': {'$ifNull': ['$chat_history', []]}}}}
+        ]))
+        if not result:
+            return None
+        total = result[0]['n']
+        self.collection.update_one({'user_id': user_id}, {'$set': {'message_count': total}})
+        return total
+
+    def _stored_message_count(self, user_id: str) -> Optional[int]:
+        """Number of stored messages for a user without reading any of them, or None for unknown users."""
+        user_data = self.collection.find_one({'user_id': user_id}, {'_id': 0, 'message_count': 1})
+        if user_data is None:
+            return None
+        if 'message_count' in user_data:
+            return user_data['message_count']
+        return self._count_stored_messages(user_id)
+
+    def _count_messages_before(self, user_id: str, before: datetime) -> Optional[int]:
+        """How many stored messages are older than `before`, counted on the server."""
+        # Compact messages keep the date in `t`. Older messages carry str(datetime)
+        # timestamps, which sort like the dates they hold. Strings sort below every
+        # date in BSON, so each type is compared with its own cutoff and dates are
+        # told apart by being at least datetime.min (no $type, which mongomock lacks).
+        timestamp = {'$ifNull': ['$$m.t', '$$m.timestamp']}
+        older = {'$or': [
+            {'$lt': [timestamp, str(before)]},
+            {'$and': [{'$gte': [timestamp, datetime.min]}, {'$lt': [timestamp, before]}]}
+        ]}
+        result = list(self.collection.aggregate([
+            {'$match': {'user_id': user_id}},
+            {'$project': {'n': {'$size': {'$filter': {
+                'input': {'$ifNull': ['$chat_history', []]},
+                'as': 'm',
+                'cond': older
+            }}}}}
+        ]))
+        return result[0]['n'] if result else None
+
+    def get_history_page(
+        self,
+        user_id: str,
+        limit: int = HISTORY_PAGE_SIZE,
+        before_seq: Optional[int] = None,
+        before: Optional[datetime] = None,
+        if_none_match: Optional[str] = None
+    ) -> Optional[Dict[str, Any]]:
+        """
+        One page of a user's stored messages for the chat screen, oldest first.
+        
+        Without a cursor the newest `limit` messages are returned; `before_seq` (the
+        `next_cursor` of a previous page) or `before` (a datetime) page further back.
+        Messages are numbered by their position in the stored history (`seq`) and
+        only the requested slice is read from MongoDB.
+        
+        Stored messages are append-only, so a page is identified by its seq range,
+        which is used as its ETag. When `if_none_match` equals the current ETag the
+        messages are omitted and `not_modified` is True. Returns None for unknown users.
+        """
+        limit = max(1, min(limit, HISTORY_PAGE_MAX))
+        try:
+            self._sync_user_writes(user_id)
+            total = self._stored_message_count(user_id)
+            if total is None:
+                return None
+            end = total
+            if before is not None:
+                end = self._count_messages_before(user_id, before) or 0
+            elif before_seq is not None:
+                end = max(0, min(before_seq, total))
+            start = max(0, end - limit)
+            
+            page = {
+                'etag': f'"{start}-{end}"',
+                'not_modified': False,
+                'messages': [],
+                'next_cursor': start if start > 0 else None,
+                'total': total
+            }
+            if if_none_match == page['etag']:
+                page['not_modified'] = True
+                return page
+            if end > start:
+                user_data = self.collection.find_one(
+                    {'user_id': user_id},
+                    {'_id': 0, 'chat_history': {'$slice': [start, end - start]}}
+                ) or {}
+                page['messages'] = [
+                    {**msg, 'seq': start + i} for i, msg in enumerate(decode_messages(user_data.get('chat_history')))
+                ]
+            return page
+        except Exception as e:
+            print(f"Error loading history page from MongoDB: {e}")
+            return None
+
     def save_user_history(self, user_id, history):
-        """ --- UPDATED: Save chat history for a specific user to MongoDB --- """
+        """ --- UPDATED: Save chat history for a specific user to MongoDB --- 
+        
+        Top-level fields are set on the stored document. chat_history and
+        message_count are only written when the document is created: a loaded
+        session holds just the newest messages (see `current_user`), and messages
+        are otherwise appended with `$push`, so saving a session's user_data must
+        not replace the stored array with that window.
+        """
         try:
+            fields = dict(history)
+            chat_history = fields.pop('chat_history', None)
+            message_count = fields.pop('message_count', None)
             # This command will find a document with the matching user_id and update it.
             # If it doesn't find one, `upsert=True` will create a new document.
-            self.collection.update_one(
-                {'user_id': user_id},
-                {'$set': history},
-                upsert=True
-            )
+            update = {'$set': fields} if fields else {}
+            if chat_history is not None:
+                update['$setOnInsert'] = {
+                    'chat_history': encode_for_storage(chat_history),
+                    'message_count': len(chat_history) if message_count is None else message_count
+                }
+            if not update:
+                return True
+            self._sync_user_writes(user_id)
+            with self.metrics.stage('save'):
+                self.collection.update_one(
+                    {'user_id': user_id},
+                    update,
+                    upsert=True
+                )
             return True
         except Exception as e:
             print(f"Error saving user history to MongoDB: {e}")
             return False
 
-    def get_or_create_user(self, user_id: str):
+    def _append_update(self, session: ChatSession, messages):
+        """Build the `$push` update for new messages, taking any pending top-level fields along."""
+        update = {
+            '$push': {'chat_history': {'$each': encode_for_storage(messages)}},
+            '$inc': {'message_count': len(messages)}
+        }
+        pending = session.take_pending()
+        if pending:
+            update['$set'] = pending
+        session.user_data['message_count'] = session.user_data.get('message_count', 0) + len(messages)
+        self._roll_up_moods(session, messages)
+        return update
+
+    @staticmethod
+    def _is_urgent(update) -> bool:
+        return any(flag in update.get('$set', {}) for flag in URGENT_USER_FLAGS)
+
+    def _write_update(self, session: ChatSession, update, stage: str = 'save') -> bool:
+        """Queue an update for the user's document, or write it now if it is urgent or write-behind is off."""
+        if self.write_queue is None:
+            with self.metrics.stage(stage):
+                self.collection.update_one({'user_id': session.user_id}, update, upsert=True)
+            return True
+        self.write_queue.enqueue(session.user_id, update)
+        if self._is_urgent(update):
+            # Crisis flags are durable before the turn returns, together with anything queued before them
+            with self.metrics.stage(stage):
+                return self.write_queue.flush(session.user_id)
+        return True
+
+    def _write_user_updates(self, batch):
+        """Write queued (user_id, update) pairs in one bulk_write; returns the positions that failed."""
+        from pymongo import UpdateOne
+        from pymongo.errors import BulkWriteError
+        
+        requests = [UpdateOne({'user_id': user_id}, update, upsert=True) for user_id, update in batch]
+        try:
+            with self.metrics.stage('bulk_write'):
+                self.collection.bulk_write(requests, ordered=False)
+        except BulkWriteError as e:
+            errors = e.details.get('writeErrors', [])
+            for error in errors[:3]:
+                print(f"Error writing queued update for {batch[error['index']][0]}: {error.get('errmsg')}")
+            return [error['index'] for error in errors]
+        return []
+
+    def _roll_up_moods(self, session: ChatSession, messages):
+        """Queue the daily mood rollup increments for messages being saved."""
+        if self.rollup_queue is None:
+            return
+        cohort = session.user_data.get('cohort') or MOOD_DEFAULT_COHORT
+        for message in messages:
+            for rollup_id, update in rollup_updates(session.user_id, cohort, message):
+                self.rollup_queue.enqueue(rollup_id, update)
+
+    def _write_rollups(self, batch):
+        """Write queued rollup increments in one bulk_write; returns the positions that failed."""
+        from pymongo import UpdateOne
+        from pymongo.errors import BulkWriteError
+        
+        requests = [UpdateOne({'_id': rollup_id}, update, upsert=True) for rollup_id, update in batch]
+        try:
+            with self.metrics.stage('rollups'):
+                self.rollup_collection.bulk_write(requests, ordered=False)
+        except BulkWriteError as e:
+            return [error['index'] for error in e.details.get('writeErrors', [])]
+        return []
+
+    def get_mood_trend(self, cohort: Optional[str] = None, user_id: Optional[str] = None,
+                       since: Optional[str] = None, until: Optional[str] = None) -> List[Dict[str, Any]]:
         """
-        --- ADDED: Loads a user's data from MongoDB if it exists, 
-        otherwise creates a new user with the provided user_id.
+        Daily mood of a cohort (or of one user) between `since` and `until` (YYYY-MM-DD).
+        
+        Each day has the mean score per emotion, dominant-emotion counts and crisis
+        counts, read from the rollups instead of the chat histories.
         """
-        user_data = self.load_user_history(user_id)
+        if self.rollup_queue is not None:
+            self.rollup_queue.flush()
+        scope, key = ('user', user_id) if user_id else ('cohort', cohort or MOOD_DEFAULT_COHORT)
+        try:
+            return mood_trend(self.rollup_collection, scope, key, since, until)
+        except Exception as e:
+            print(f"Error loading mood trend from MongoDB: {e}")
+            return []
+
+    def _sync_user_writes(self, user_id: str):
+        """Write a user's queued updates before their document is read back or replaced."""
+        if self.write_queue is not None:
+            self.write_queue.flush(user_id)
+
+    def append_message(self, session: ChatSession, message):
+        """Append a single message to the stored history with `$push` instead of rewriting the document."""
+        update = self._append_update(session, [message])
+        try:
+            return self._write_update(session, update)
+        except Exception as e:
+            print(f"Error appending message to MongoDB: {e}")
+            session.restore_pending(update.get('$set', {}))
+            return False
+
+    async def aappend_messages(self, session: ChatSession, messages):
+        """Async variant of append_message that writes several messages in one update."""
+        update = self._append_update(session, messages)
+        try:
+            if self.write_queue is not None:
+                if not self._is_urgent(update):
+                    self.write_queue.enqueue(session.user_id, update)
+                    return True
+                return await asyncio.get_running_loop().run_in_executor(
+                    self._executor, self._write_update, session, update
+                )
+            with self.metrics.stage('save'):
+                if self.async_collection is not None:
+                    await self.async_collection.update_one({'user_id': session.user_id}, update, upsert=True)
+                else:
+                    await asyncio.get_running_loop().run_in_executor(
+                        self._executor,
+                        lambda: self.collection.update_one({'user_id': session.user_id}, update, upsert=True)
+                    )
+            return True
+        except Exception as e:
+            print(f"Error appending messages to MongoDB: {e}")
+            session.restore_pending(update.get('$set', {}))
+            return False
+
+    def set_user_flag(self, session: ChatSession, key, value):
+        """Set a top-level field on the user document; it is persisted with the next write."""
+        session.user_data[key] = value
+        session.set_pending(key, value)
+        session.context_text = None
+
+    def flush_user_updates(self, session: ChatSession):
+        """Persist any pending top-level fields that have not ridden along with a message write."""
+        pending = session.take_pending()
+        if not pending:
+            return True
+        update = {'$set': pending}
+        try:
+            return self._write_update(session, update, stage='flush')
+        except Exception as e:
+            print(f"Error flushing user updates to MongoDB: {e}")
+            session.restore_pending(pending)
+            return False
+
+    def _load_session(self, user_id: str, create: bool = False) -> Optional[ChatSession]:
+        """Load a user from MongoDB (optionally creating them) and hydrate their message history."""
+        user_data = self.load_user_history(user_id, last_n=self.history_window)
         if user_data:
-            self.current_user = user_data
             print(f"Existing user loaded: {user_id}")
-            return user_data
+        elif create:
+            # If user does not exist, create a new one with the provided ID
+            print(f"Creating new user with provided ID: {user_id}")
+            user_data = {
+                'user_id': user_id,
+                'created_at': str(datetime.now()),
+                'chat_history': [],
+                'message_count': 0
+            }
+            self.save_user_history(user_id, user_data)
+        else:
+            return None
+        
+        session = ChatSession(user_id, user_data)
+        self._reset_context_window(session)
+        if 'message_count' not in user_data:
+            self._seed_message_count(session)
+        if 'emotion_stats' not in user_data:
+            self._seed_emotion_stats(session)
+        if self.history_window:
+            self._catch_up_summary(session)
+        session.message_history = self._build_message_history(session.user_data)
+        return session
 
-        # If user does not exist, create a new one with the provided ID
-        print(f"Creating new user with provided ID: {user_id}")
-        self.current_user = {
-            'user_id': user_id,
-            'created_at': str(datetime.now()),
-            'chat_history': []
-        }
-        self.save_user_history(user_id, self.current_user)
-        return self.current_user
+    def get_session(self, user_id: str, create: bool = False) -> Optional[ChatSession]:
+        """Return the cached session for a user, loading it from MongoDB if needed."""
+        return self.sessions.get_or_load(user_id, lambda: self._load_session(user_id, create))
+
+    def close_session(self, user_id: str):
+        """Flush and drop a user's session, e.g. when they leave the chat."""
+        self.sessions.remove(user_id)
+        self._sync_user_writes(user_id)
+
+    def _on_session_evicted(self, session: ChatSession):
+        with session.lock:
+            self.flush_user_updates(session)
+
+    @property
+    def current_user(self):
+        """
+        User document of the conversation most recently opened on this thread.
+        
+        With HISTORY_WINDOW_MESSAGES set, its chat_history holds only the newest
+        messages (the window), not the full stored history; use get_history_page
+        to read older ones. message_count is the stored total.
+        """
+        session = self._active_session()
+        return session.user_data if session else None
+
+    def get_or_create_user(self, user_id: str):
+        """
+        --- ADDED: Loads a user's data from MongoDB if it exists, 
+        otherwise creates a new user with the provided user_id.
+        """
+        session = self.get_session(user_id, create=True)
+        self._local.user_id = user_id
+        return session.user_data
 
     # --- REMOVED: Replaced by get_or_create_user ---
     # def create_new_user(self):
@@ -236,47 +1046,178 @@ class UserChatManager:
 
     def initialize_conversation(self, user_id):
         """Initialize or load conversation for a user"""
-        user_data = self.load_user_history(user_id)
-        if not user_data:
+        if not self.get_session(user_id):
             return False
+        self._local.user_id = user_id
+        return True
+
+    def _get_session_history(self, session_id):
+        """Message history lookup used by RunnableWithMessageHistory."""
+        session = self.sessions.peek(session_id)
+        return session.message_history if session else ChatMessageHistory()
+
+    def _build_message_history(self, user_data):
+        """
+        Replay the loaded message window into a ChatMessageHistory.
+        
+        The system prompt comes from the prompt template and the rolling summary
+        from the context block, so neither is duplicated here.
+        """
+        history = ChatMessageHistory()
+        
+        # Load previous messages
+        for msg in user_data.get('chat_history', []):
+            if msg['role'] == 'user':
+                history.add_message(HumanMessage(content=msg['content']))
+            else:
+                history.add_message(AIMessage(content=msg['content']))
+        return history
+
+    def _summarize_messages(self, previous_summary, messages):
+        """Fold `messages` into the rolling summary with a single LLM call."""
+        transcript = "\n".join(
+            f"{'Student' if msg['role'] == 'user' else 'Aanya'}: {msg['content']}"
+            for msg in messages
+        )
+        summary_input = (
+            f"Current summary:\n{previous_summary or 'None yet.'}\n\n"
+            f"New messages:\n{transcript}"
+        )
+        with self.metrics.stage('summary'):
+            response = self.summary_llm.invoke([
+                SystemMessage(content=SUMMARY_PROMPT),
+                HumanMessage(content=summary_input)
+            ])
+        return response.content if hasattr(response, 'content') else str(response)
+
+    def _seed_message_count(self, session: ChatSession):
+        """
+        Store message_count on a document that predates it.
+        
+        Appends `$inc` the counter, which would otherwise create it at the number
+        of new messages and make paging treat the oldest messages as the newest.
+        """
+        user_data = session.user_data
+        try:
+            total = self._count_stored_messages(session.user_id)
+        except Exception as e:
+            print(f"Error counting stored messages in MongoDB: {e}")
+            total = None
+        user_data['message_count'] = len(user_data.get('chat_history', [])) if total is None else total
+
+    def _catch_up_summary(self, session: ChatSession):
+        """
+        Fold stored messages that are neither in the loaded window nor in the summary.
+        
+        This covers sessions that ended before their overflow was folded, and older
+        documents that were written before summaries existed.
+        """
+        user_id = session.user_id
+        user_data = session.user_data
+        window = user_data.get('chat_history', [])
+        total = user_data.get('message_count', len(window))
+        try:
+            summarized = user_data.get('summarized_count', 0)
+            unsummarized = total - len(window) - summarized
+            if unsummarized <= 0:
+                return
             
-        self.current_user = user_data
+            # Only the newest part of a very large backlog is folded
+            limit = min(unsummarized, HISTORY_SUMMARY_MAX_FOLD)
+            skip = total - len(window) - limit
+            older = self.collection.find_one(
+                {'user_id': user_id},
+                {'_id': 0, 'chat_history': {'$slice': [skip, limit]}}
+            ) or {}
+            summary = self._summarize_messages(
+                user_data.get('history_summary'),
+                decode_messages(older.get('chat_history'))
+            )
+        except Exception as e:
+            print(f"Error summarizing earlier conversation: {e}")
+            return
+        
+        self.set_user_flag(session, 'history_summary', summary)
+        self.set_user_flag(session, 'summarized_count', total - len(window))
+        self.flush_user_updates(session)
+
+    def _roll_history_window(self, session: ChatSession):
+        """
+        Fold messages that overflowed the window into the summary and trim memory.
         
-        # Create or get message history for this user
-        if user_id not in self.histories:
-            self.histories[user_id] = ChatMessageHistory()
+        Takes the session's threading lock, since async turns run it in a worker thread.
+        """
+        if not self.history_window:
+            return
+        with session.lock:
+            chat_history = session.user_data.get('chat_history', [])
+            overflow = len(chat_history) - self.history_window
+            if overflow < HISTORY_SUMMARY_BATCH:
+                return
             
-            # Add system message as first message
-            self.histories[user_id].add_message(SystemMessage(content=SYSTEM_PROMPT))
+            try:
+                summary = self._summarize_messages(
+                    session.user_data.get('history_summary'),
+                    chat_history[:overflow]
+                )
+            except Exception as e:
+                print(f"Error updating conversation summary: {e}")
+                return
             
-            # Load previous messages
-            for msg in user_data.get('chat_history', []):
-                if msg['role'] == 'user':
-                    self.histories[user_id].add_message(HumanMessage(content=msg['content']))
-                else:
-                    self.histories[user_id].add_message(AIMessage(content=msg['content']))
-        
-        # Create the conversation chain with message history
-        self.conversation_chain = RunnableWithMessageHistory(
-            self.chain,
-            lambda session_id: self.histories.get(user_id, ChatMessageHistory()),
-            input_messages_key="input",
-            history_messages_key="history"
-        )
+            session.user_data['chat_history'] = chat_history[overflow:]
+            self.set_user_flag(session, 'history_summary', summary)
+            self.set_user_flag(
+                session,
+                'summarized_count',
+                session.user_data.get('summarized_count', 0) + overflow
+            )
+            session.message_history = self._build_message_history(session.user_data)
+
+    def analyze_message(self, text: str, user_id: str) -> Dict[str, Any]:
+        """
+        Run emotion and crisis detection for a user message and combine their verdicts.
         
-        return True
+        emotion_detector reports its own crisis check as `crisis_info`; the crisis
+        triage (pre-filter plus AdvancedCrisisDetector) runs as well, and either one
+        can raise the alarm (see combine_crisis). The returned dict has the shape of a
+        `detect_emotion` result and is used both for the crisis response and for the
+        stored message, so the two can no longer disagree.
+        """
+        analysis = dict(self._detect_emotion(text, user_id))
+        with self.metrics.stage('crisis'):
+            assessment = self.crisis_triage.assess(text)
+        analysis['crisis_info'] = combine_crisis(analysis.get('crisis_info'), assessment)
+        return analysis
 
-    def add_to_history(self, role, content):
-        """Add a message to the current user's history and track emotions"""
-        if not self.current_user:
+    def _detect_emotion(self, text: str, user_id: str) -> Dict[str, Any]:
+        """Run emotion detection; concurrent calls share forward passes when batching is enabled."""
+        with self.metrics.stage('emotion'):
+            return get_emotion_detector().detect_emotion(text, user_id)
+
+    def add_to_history(self, role, content, session: Optional[ChatSession] = None, emotion_result=None):
+        """Add a message to a user's history (the current user by default) and track emotions"""
+        session = session or self._active_session()
+        if not session:
             return False
+        
+        message = self._record_message(session, role, content, emotion_result)
+        
+        # Append only the new message; pending flags are written in the same update
+        return self.append_message(session, message)
 
-        timestamp = str(datetime.now())
-        user_id = self.current_user['user_id']
+    def _record_message(self, session: ChatSession, role, content, emotion_result=None):
+        """
+        Build a stored message, run emotion detection for user messages (unless a
+        result is passed in) and add it to the in-memory history.
+        """
+        # Stored as a native BSON date, so it never has to be parsed back from a string
+        timestamp = datetime.now()
+        user_id = session.user_id
         
         # Track emotions and check for crisis
         if role == "user":
-            emotion_result = emotion_detector.detect_emotion(content, user_id)
+            if emotion_result is None:
+                emotion_result = self.analyze_message(content, user_id)
             emotion_data = {
                 'emotions': emotion_result['emotions'],
                 'dominant_emotion': emotion_result['dominant_emotion'],
@@ -285,7 +1226,10 @@ class UserChatManager:
             
             # If crisis detected, add a special marker
             if emotion_result['crisis_info']['is_crisis']:
-                self.current_user['needs_immediate_attention'] = True
+                self.set_user_flag(session, 'needs_immediate_attention', True)
+            
+            stats = self._update_emotion_stats(session.user_data.get('emotion_stats'), emotion_result['emotions'])
+            self.set_user_flag(session, 'emotion_stats', stats)
         else:
             emotion_data = {}
         
@@ -297,53 +1241,100 @@ class UserChatManager:
             **emotion_data
         }
         
-        self.current_user['chat_history'].append(message)
-        
-        # Save the updated history
-        return self.save_user_history(user_id, self.current_user)
+        session.user_data['chat_history'].append(message)
+        session.context_window.append(self._context_entry(message))
+        session.context_text = None
+        return message
+
+    def _active_session(self) -> Optional[ChatSession]:
+        user_id = getattr(self._local, 'user_id', None)
+        return self.get_session(user_id) if user_id else None
 
     # Emotion history is now managed directly in the emotion detector
 
-    def get_emotion_summary(self, user_id: str) -> Dict[str, Any]:
-        """Get a summary of user's emotional state"""
-        history = emotion_detector.get_emotion_history(user_id)
-        if not history:
+    @staticmethod
+    def _update_emotion_stats(stats: Optional[Dict[str, Any]], emotions: Dict[str, float]) -> Dict[str, Any]:
+        """
+        Fold one message's emotion scores into a user's running aggregates in O(1).
+        
+        `sums` gives the long-run average, `ewma` an exponentially-decayed view of
+        recent messages that the trend and intensity are read from.
+        """
+        stats = {
+            'count': (stats or {}).get('count', 0),
+            'sums': dict((stats or {}).get('sums', {})),
+            'ewma': dict((stats or {}).get('ewma', {}))
+        }
+        stats['count'] += 1
+        for emotion, score in emotions.items():
+            try:
+                score = float(score)
+            except (ValueError, TypeError):
+                continue
+            stats['sums'][emotion] = stats['sums'].get(emotion, 0.0) + score
+            previous = stats['ewma'].get(emotion)
+            stats['ewma'][emotion] = score if previous is None else (
+                EMOTION_TREND_ALPHA * score + (1 - EMOTION_TREND_ALPHA) * previous
+            )
+        return stats
+
+    def _seed_emotion_stats(self, session: ChatSession):
+        """Build aggregates for users stored before they existed, from the loaded messages."""
+        stats = None
+        for msg in session.user_data.get('chat_history', []):
+            if msg.get('role') == 'user' and msg.get('emotions'):
+                stats = self._update_emotion_stats(stats, msg['emotions'])
+        if stats:
+            self.set_user_flag(session, 'emotion_stats', stats)
+
+    @staticmethod
+    def _summarize_emotion_stats(stats: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+        """Turn running emotion aggregates into the summary used for context."""
+        if not stats or not stats.get('count'):
             return {"status": "No emotion data available"}
         
-        # Calculate average emotion scores
-        emotion_totals = {}
-        for entry in history:
-            for emotion, score in entry['emotions'].items():
-                if emotion not in emotion_totals:
-                    emotion_totals[emotion] = 0
-                emotion_totals[emotion] += score
+        count = stats['count']
+        avg_emotions = {e: s / count for e, s in stats['sums'].items()}
+        dominant = max(avg_emotions.items(), key=lambda x: x[1])[0] if avg_emotions else 'neutral'
         
-        avg_emotions = {e: s/len(history) for e, s in emotion_totals.items()}
+        # Recent weight of the dominant emotion compared with its long-run average
+        recent = stats['ewma'].get(dominant, 0.0)
+        shift = recent - avg_emotions.get(dominant, 0.0)
+        if shift > 0.1:
+            trend = 'increasing'
+        elif shift < -0.1:
+            trend = 'decreasing'
+        else:
+            trend = 'stable'
+        
+        if recent >= 0.6:
+            intensity = 'high'
+        elif recent >= 0.3:
+            intensity = 'medium'
+        else:
+            intensity = 'low'
         
-        # Convert scores to percentages, ensuring they're numbers first
-        emotion_percentages = {}
-        for k, v in avg_emotions.items():
-            try:
-                # Ensure the value is a number that can be formatted
-                score = float(v) * 100
-                emotion_percentages[k] = f"{score:.1f}%"
-            except (ValueError, TypeError):
-                # If conversion fails, use the raw value
-                emotion_percentages[k] = f"{v}"
-                
         return {
-            'emotion_summary': emotion_percentages,
-            'dominant_emotion': max(avg_emotions.items(), key=lambda x: x[1])[0] if avg_emotions else 'neutral',
-            'total_messages_analyzed': len(history)
+            'emotion_summary': {e: f"{s * 100:.1f}%" for e, s in avg_emotions.items()},
+            'emotion_scores': avg_emotions,
+            'dominant_emotion': dominant,
+            'intensity': intensity,
+            'trend': trend,
+            'total_messages_analyzed': count
         }
 
+    def get_emotion_summary(self, user_id: str) -> Dict[str, Any]:
+        """Get a summary of user's emotional state"""
+        session = self.get_session(user_id)
+        return self._summarize_emotion_stats(session.user_data.get('emotion_stats') if session else None)
+
     def _get_emotional_context(self, user_id: str) -> str:
         """Generate context about user's emotional state for the AI."""
-        if not hasattr(self, 'emotion_history') or not emotion_detector.emotion_history.get(user_id):
+        if not hasattr(self, 'emotion_history') or not get_emotion_detector().emotion_history.get(user_id):
             return ""
             
         # Get recent emotions (last 5 messages)
-        recent_emotions = emotion_detector.emotion_history[user_id][-5:]
+        recent_emotions = get_emotion_detector().emotion_history[user_id][-5:]
         if not recent_emotions:
             return ""
             
@@ -362,28 +1353,45 @@ class UserChatManager:
 
     def _detect_crisis_keywords(self, text: str) -> bool:
         """Check for crisis-related keywords in the text."""
-        crisis_keywords = [
-            'suicide', 'end my life', 'kill myself', 'want to die',
-            'no reason to live', 'self harm', 'hurting myself',
-            "can't take it", 'giving up', 'hopeless', 'helpless'
-        ]
-        return any(keyword in text.lower() for keyword in crisis_keywords)
+        return bool(CRISIS_MATCHER.match(text))
+
+    def _context_entry(self, msg):
+        """The felt emotion (user messages only) and topics of a message, computed once per message."""
+        felt = msg.get('dominant_emotion') if msg['role'] == 'user' else None
+        return felt, TOPIC_MATCHER.match(msg.get('content', ''))
+
+    def _reset_context_window(self, session: ChatSession):
+        """Rebuild the per-session context entries from the loaded messages."""
+        session.context_window.clear()
+        for msg in session.user_data.get('chat_history', [])[-session.context_window.maxlen:]:
+            session.context_window.append(self._context_entry(msg))
+        session.context_text = None
 
-    def _get_conversation_context(self, user_id: str) -> str:
+    def _get_conversation_context(self, session: ChatSession) -> str:
         """
         Generate comprehensive context about the conversation history and emotional state.
         
         Returns a structured string containing:
         1. Current emotional state and trends
-        2. Summary of recent conversation
+        2. Summary of earlier conversation and recent topics
         3. Important topics and concerns
-        4. Recent messages with emotional context
+        
+        The recent messages themselves are not repeated here: they are already in
+        the chat history sent with the prompt. This block only goes into the
+        current turn's prompt and is never stored in the history.
+        
+        The block is cached on the session until a message is recorded or a user
+        field changes, and it is built from per-message entries that were computed
+        once, when the message was added.
         """
-        # Get recent messages (last 10 messages for better context)
-        recent_messages = self.current_user.get('chat_history', [])[-10:]
+        if session.context_text is not None:
+            return session.context_text
+        
+        # Entries for the recent messages (last 10 messages for better context)
+        recent_entries = list(session.context_window)
         
         # Get enhanced emotion analysis
-        emotion_summary = self.get_emotion_summary(user_id)
+        emotion_summary = self._summarize_emotion_stats(session.user_data.get('emotion_stats'))
         
         context_parts = ["[CONVERSATION CONTEXT]"]
         
@@ -402,151 +1410,126 @@ class UserChatManager:
             if emotion_summary.get('trend') and emotion_summary['trend'] != 'stable':
                 trend = emotion_summary['trend']
                 context_parts.append(
-                    f"Emotional Trend: The user has been {trend}ly {emotion} in recent messages."
+                    f"Emotional Trend: {emotion.capitalize()} has been {trend} in recent messages."
                 )
             
             # Add top emotions if available
-            if emotion_summary.get('emotion_summary'):
+            if emotion_summary.get('emotion_scores'):
                 top_emotions = sorted(
-                    emotion_summary['emotion_summary'].items(),
-                    key=lambda x: float(x[1].rstrip('%')),
+                    emotion_summary['emotion_scores'],
+                    key=emotion_summary['emotion_scores'].get,
                     reverse=True
                 )[:3]
                 
                 if top_emotions:
                     context_parts.append(
                         "Recent Emotional Mix: " + 
-                        ", ".join(f"{e[0].capitalize()} ({e[1]})" for e in top_emotions)
+                        ", ".join(f"{e.capitalize()} ({emotion_summary['emotion_summary'][e]})" for e in top_emotions)
                     )
         
         # 2. Conversation Summary
-        if recent_messages:
-            # Identify key topics or themes from recent messages
-            topics = self._identify_conversation_topics(recent_messages)
+        if session.user_data.get('history_summary'):
+            context_parts.append(
+                "\n[EARLIER CONVERSATION SUMMARY]\n" + session.user_data['history_summary']
+            )
+        
+        if recent_entries:
+            # Key topics are those mentioned in at least two of the recent messages
+            topic_counts = {topic: 0 for topic in TOPIC_MATCHER.table}
+            for _, message_topics in recent_entries:
+                for topic in message_topics:
+                    topic_counts[topic] += 1
+            topics = [topic for topic, count in topic_counts.items() if count >= 2]
             if topics:
                 context_parts.append(
                     "\nKey Topics Discussed: " + 
                     ", ".join(f"{t.capitalize()}" for t in topics)
                 )
             
-            # Add recent conversation context
-            context_parts.append("\n[RECENT MESSAGES]")
-            for msg in recent_messages[-5:]:  # Show last 5 messages for context
-                role = "You" if msg['role'] == 'user' else "Aanya"
-                timestamp = msg.get('timestamp', '')
-                
-                # Add emotion info if available
-                emotion_info = ''
-                if msg['role'] == 'user' and 'dominant_emotion' in msg:
-                    emotion_info = f" [Felt: {msg['dominant_emotion'].capitalize()}]"
-                
-                if timestamp:
-                    try:
-                        dt = datetime.fromisoformat(timestamp.replace('Z', '+00:00'))
-                        time_str = dt.strftime('%I:%M %p')
-                        context_parts.append(f"{time_str} - {role}: {msg['content']}{emotion_info}")
-                        continue
-                    except (ValueError, AttributeError):
-                        pass
-                context_parts.append(f"{role}: {msg['content']}{emotion_info}")
+            # How the user felt in their recent messages (the messages are in the history)
+            felt = [emotion.capitalize() for emotion, _ in recent_entries[-5:] if emotion]
+            if felt:
+                context_parts.append("Recently Felt: " + " → ".join(felt))
         
         # 3. Previous Concerns or Issues
-        if self.current_user.get('needs_follow_up', False):
+        if session.user_data.get('needs_follow_up', False):
             context_parts.append(
                 "\n[IMPORTANT] This user was previously in crisis and may need follow-up care. "
                 "Be especially attentive to their emotional state and needs."
             )
         
-        return "\n".join(context_parts)
+        session.context_text = "\n".join(context_parts)
+        return session.context_text
         
     def _identify_conversation_topics(self, messages: List[Dict]) -> List[str]:
         """
         Identify key topics or themes from recent messages.
         This is a simple implementation that can be enhanced with NLP.
         """
-        # Simple keyword-based topic detection
-        topic_keywords = {
-            'studies': ['exam', 'test', 'study', 'homework', 'assignment', 'class', 'school', 'college', 'marks'],
-            'family': ['mom', 'dad', 'parents', 'family', 'sister', 'brother', 'mother', 'father'],
-            'relationships': ['friend', 'girlfriend', 'boyfriend', 'partner', 'relationship', 'dating'],
-            'career': ['job', 'career', 'future', 'interview', 'resume', 'placement', 'internship'],
-            'stress': ['stress', 'anxious', 'anxiety', 'worried', 'overwhelmed', 'pressure'],
-            'sleep': ['sleep', 'tired', 'insomnia', 'can\'t sleep', 'restless'],
-            'health': ['sick', 'ill', 'pain', 'headache', 'stomach', 'doctor', 'hospital']
-        }
-        
-        # Count occurrences of each topic
-        topic_counts = {topic: 0 for topic in topic_keywords}
+        # Count occurrences of each topic; matches are cached per message text,
+        # so messages already seen in earlier turns are not rescanned
+        topic_counts = {topic: 0 for topic in TOPIC_MATCHER.table}
         
         for msg in messages:
-            content = msg.get('content', '').lower()
-            for topic, keywords in topic_keywords.items():
-                if any(keyword in content for keyword in keywords):
-                    topic_counts[topic] += 1
+            for topic in TOPIC_MATCHER.match(msg.get('content', '')):
+                topic_counts[topic] += 1
         
         # Return topics that were mentioned at least twice
         return [topic for topic, count in topic_counts.items() if count >= 2]
 
-    def get_response(self, user_input: str) -> str:
-        """Get response from the AI model with enhanced emotional intelligence and crisis handling."""
-        if not self.current_user or not self.conversation_chain:
+    def get_response(self, user_input: str, user_id: Optional[str] = None) -> str:
+        """
+        Get response from the AI model with enhanced emotional intelligence and crisis handling.
+        
+        `user_id` selects the conversation; without it the user last opened on this
+        thread is used. Turns for different users run concurrently, turns for the
+        same user are serialized by the session lock.
+        """
+        session = self.get_session(user_id) if user_id else self._active_session()
+        if not session:
             return "Error: No active conversation. Please start or load a chat first."
-            
+        
+        with self.metrics.stage('turn'), self.sessions.use(session):
+            return self._get_response(session, user_input)
+
+    def _get_response(self, session: ChatSession, user_input: str) -> str:
         try:
-            user_id = self.current_user['user_id']
+            user_id = session.user_id
             
-            # Check for crisis first (before adding to history to avoid saving crisis messages)
-            crisis_result = self.crisis_detector.detect_crisis(user_input)
+            # Emotion and crisis detection run once; the result drives both the reply and storage
+            analysis = self.analyze_message(user_input, user_id)
+            crisis_result = analysis['crisis_info']
             
             # Add user message to history
-            self.add_to_history("user", user_input)
+            self.add_to_history("user", user_input, session, analysis)
             
             # Get conversation context
-            context_str = self._get_conversation_context(user_id)
-            
-            # Format the user input with context
-            formatted_input = f"{context_str}\n\nUser: {user_input}"
+            with self.metrics.stage('context'):
+                context_str = self._get_conversation_context(session)
             
-            # Get AI response using the conversation chain
-            response = self.conversation_chain.invoke(
-                {"input": formatted_input},
-                {"configurable": {"session_id": user_id}}
-            )
-            
-            # Extract the response content
-            response_text = response.content if hasattr(response, 'content') else str(response)
+            cache_key = self._response_cache_key(session, user_input, analysis)
+            response_text = self._cached_reply(session, cache_key, user_input)
+            if response_text is None:
+                # Get AI response using the conversation chain; only the raw input is kept in history
+                self._refresh_prefix_cache()
+                with self.metrics.stage('llm'):
+                    response = self.conversation_chain.invoke(
+                        {"input": user_input, "context": context_str},
+                        {"configurable": {"session_id": user_id}}
+                    )
+                self._record_usage(session, response)
+                
+                # Extract the response content
+                response_text = response.content if hasattr(response, 'content') else str(response)
+                self._store_reply(cache_key, response_text)
             
             # Handle crisis situations with appropriate escalation
-            if crisis_result['is_crisis']:
-                # Format crisis response with emergency contacts and support
-                crisis_response = (
-                    "🚨 [URGENT] 🚨\n"
-                    "I'm really concerned about what you're sharing. Your safety is the most important thing right now.\n\n"
-                    "Please reach out to these 24/7 helplines immediately:\n"
-                    "• Vandrevala Foundation: 1860-2662-345 or 1800-2333-330 (24/7, free from all phones)\n"
-                    "• iCall: +91-9152987821 (Mon-Sat, 10am-8pm, WhatsApp available)\n"
-                    "• AASRA: +91-9820466726 (24/7, English/Hindi)\n\n"
-                    "You don't have to go through this alone. These trained counselors can help.\n\n"
-                    f"{response_text}"
-                )
-                response_text = crisis_response
-                
-                # Set a flag for follow-up in future sessions
-                self.current_user['needs_follow_up'] = True
-                
-            elif crisis_result['risk_level'] == 'medium':
-                # For medium risk, show concern and offer resources
-                response_text = (
-                    "🤗 I hear how much you're struggling right now, and I want you to know I'm here for you.\n\n"
-                    "Sometimes talking to someone can help. These free, confidential services are available:\n"
-                    "• Vandrevala: 1860-2662-345 (24/7)\n"
-                    "• iCall: 9152987821 (Mon-Sat, 10am-8pm)\n\n"
-                    f"{response_text}"
-                )
+            response_text = self._apply_crisis_escalation(session, crisis_result, response_text)
             
-            # Add to history and save
-            self.add_to_history("assistant", response_text)
-            self.save_user_history(user_id, self.current_user)
+            # Add to history; flags set above are written together with this message
+            self.add_to_history("assistant", response_text, session)
+            self._roll_history_window(session)
+            self.flush_user_updates(session)
             
             return response_text
             
@@ -554,6 +1537,328 @@ class UserChatManager:
             print(f"Error in get_response: {str(e)}")
             return "I'm sorry, I'm having trouble processing that right now. Could you try again?"
 
+    def _response_cache_key(self, session: ChatSession, user_input: str, analysis: Dict[str, Any]):
+        """
+        Response cache key for the opening message of a new conversation, or None.
+        
+        Only low-risk first turns are cacheable: later replies depend on the history,
+        and anything the crisis check flags always goes to the model.
+        """
+        if self.response_cache is None:
+            return None
+        crisis_result = analysis['crisis_info']
+        if crisis_result['is_crisis'] or crisis_result['risk_level'] != 'low':
+            return None
+        if session.message_history.messages or session.user_data.get('history_summary'):
+            return None
+        text = ResponseCache.normalize(user_input)
+        if not text:
+            return None
+        # The context block depends on the detected emotion, so it is part of the key
+        return (text, analysis.get('dominant_emotion'))
+
+    def _cached_reply(self, session: ChatSession, cache_key, user_input: str) -> Optional[str]:
+        """Serve a cached reply and add the turn to the model history, as the chain would have."""
+        if cache_key is None:
+            return None
+        reply = self.response_cache.get(cache_key)
+        if reply is not None:
+            session.message_history.add_user_message(user_input)
+            session.message_history.add_ai_message(reply)
+        return reply
+
+    def _store_reply(self, cache_key, response_text: str):
+        if cache_key is not None and response_text:
+            self.response_cache.put(cache_key, response_text)
+
+    def _refresh_prefix_cache(self):
+        if self.prefix_cache is not None:
+            self.prefix_cache.refresh()
+
+    def get_cache_stats(self) -> Dict[str, Any]:
+        """Hit/miss counts of the response cache and the state of the Gemini context cache."""
+        return {
+            'response_cache': self.response_cache.stats() if self.response_cache else None,
+            'prefix_cache': self.prefix_cache.stats() if self.prefix_cache else None
+        }
+
+    def _record_usage(self, session: ChatSession, response):
+        """Track the per-turn prompt token count reported by the model (LangChain usage_metadata)."""
+        usage = getattr(response, 'usage_metadata', None) or {}
+        session.last_usage = usage
+        with self._usage_lock:
+            self.token_usage['turns'] += 1
+            self.token_usage['input_tokens'] += usage.get('input_tokens', 0)
+            self.token_usage['output_tokens'] += usage.get('output_tokens', 0)
+
+    def get_token_usage(self) -> Dict[str, Any]:
+        """Totals and per-turn averages of model token usage since startup."""
+        with self._usage_lock:
+            usage = dict(self.token_usage)
+        turns = usage['turns'] or 1
+        usage['avg_input_tokens'] = usage['input_tokens'] / turns
+        usage['avg_output_tokens'] = usage['output_tokens'] / turns
+        return usage
+
+    def _apply_crisis_escalation(self, session: ChatSession, crisis_result, response_text: str) -> str:
+        """Prefix helpline information for high/medium risk messages and flag the user for follow-up."""
+        return self._crisis_prefix(session, crisis_result) + response_text
+
+    def _crisis_prefix(self, session: ChatSession, crisis_result) -> str:
+        """Helpline text shown ahead of the model's reply, or an empty string for low risk."""
+        if crisis_result['is_crisis']:
+            # Set a flag for follow-up in future sessions
+            self.set_user_flag(session, 'needs_follow_up', True)
+            
+            # Format crisis response with emergency contacts and support
+            return (
+                "🚨 [URGENT] 🚨\n"
+                "I'm really concerned about what you're sharing. Your safety is the most important thing right now.\n\n"
+                "Please reach out to these 24/7 helplines immediately:\n"
+                "• Vandrevala Foundation: 1860-2662-345 or 1800-2333-330 (24/7, free from all phones)\n"
+                "• iCall: +91-9152987821 (Mon-Sat, 10am-8pm, WhatsApp available)\n"
+                "• AASRA: +91-9820466726 (24/7, English/Hindi)\n\n"
+                "You don't have to go through this alone. These trained counselors can help.\n\n"
+            )
+            
+        if crisis_result['risk_level'] == 'medium':
+            # For medium risk, show concern and offer resources
+            return (
+                "🤗 I hear how much you're struggling right now, and I want you to know I'm here for you.\n\n"
+                "Sometimes talking to someone can help. These free, confidential services are available:\n"
+                "• Vandrevala: 1860-2662-345 (24/7)\n"
+                "• iCall: 9152987821 (Mon-Sat, 10am-8pm)\n\n"
+            )
+        return ""
+
+    def stream_response(self, user_input: str, user_id: Optional[str] = None) -> Iterator[str]:
+        """
+        Streaming variant of get_response that yields text as soon as it is available.
+        
+        Helpline information for risky messages is yielded before the model is
+        called; model tokens follow as they arrive. The user message and any crisis
+        flags are stored before the first yield, and the reply (as far as it was
+        streamed) is saved when the stream ends or the client goes away.
+        
+        The session lock is only held while session state changes, never across a
+        yield, so the iterator may be advanced from different threads.
+        """
+        session = self.get_session(user_id) if user_id else self._active_session()
+        if not session:
+            yield "Error: No active conversation. Please start or load a chat first."
+            return
+        
+        try:
+            with self.sessions.use(session):
+                analysis = self.analyze_message(user_input, session.user_id)
+                prefix = self._crisis_prefix(session, analysis['crisis_info'])
+                self.add_to_history("user", user_input, session, analysis)
+                with self.metrics.stage('context'):
+                    context_str = self._get_conversation_context(session)
+                
+                cache_key = self._response_cache_key(session, user_input, analysis)
+                cached = self._cached_reply(session, cache_key, user_input)
+                if cached is None:
+                    self._refresh_prefix_cache()
+        except Exception as e:
+            print(f"Error in stream_response: {str(e)}")
+            yield "I'm sorry, I'm having trouble processing that right now. Could you try again?"
+            return
+        
+        chunks = []
+        try:
+            if prefix:
+                yield prefix
+            if cached is not None:
+                chunks.append(cached)
+                yield cached
+            else:
+                usage_chunk = None
+                # Timed by hand: a span cannot stay open across the generator's yields
+                llm_start = time.perf_counter()
+                for chunk in self.conversation_chain.stream(
+                    {"input": user_input, "context": context_str},
+                    {"configurable": {"session_id": session.user_id}}
+                ):
+                    if getattr(chunk, 'usage_metadata', None):
+                        usage_chunk = chunk
+                    text = chunk.content if hasattr(chunk, 'content') else str(chunk)
+                    if text:
+                        chunks.append(text)
+                        yield text
+                self.metrics.observe('llm_stream', time.perf_counter() - llm_start)
+                self._record_usage(session, usage_chunk)
+                self._store_reply(cache_key, "".join(chunks))
+        
+        except Exception as e:
+            print(f"Error in stream_response: {str(e)}")
+            yield "I'm sorry, I'm having trouble processing that right now. Could you try again?"
+        
+        finally:
+            # Also runs when the client disconnects mid-stream (GeneratorExit)
+            if prefix or chunks:
+                with self.sessions.use(session):
+                    self.add_to_history("assistant", prefix + "".join(chunks), session)
+                    self._roll_history_window(session)
+                    self.flush_user_updates(session)
+
+    async def astream_response(self, user_input: str, user_id: Optional[str] = None) -> AsyncIterator[str]:
+        """Async streaming variant combining astream with the aget_response pipeline."""
+        loop = asyncio.get_running_loop()
+        user_id = user_id or getattr(self._local, 'user_id', None)
+        if not user_id:
+            yield "Error: No active conversation. Please start or load a chat first."
+            return
+        
+        analysis_future = loop.run_in_executor(self._executor, self.analyze_message, user_input, user_id)
+        session = await loop.run_in_executor(self._executor, self.get_session, user_id)
+        if not session:
+            analysis_future.cancel()
+            yield "Error: No active conversation. Please start or load a chat first."
+            return
+        
+        async with self.sessions.ause(session):
+            chunks = []
+            prefix = ""
+            try:
+                analysis = await analysis_future
+                prefix = self._crisis_prefix(session, analysis['crisis_info'])
+                user_message = self._record_message(session, "user", user_input, analysis)
+                # Scheduled before anything is yielded, so a disconnect cannot lose it
+                await self._persist(session, [user_message])
+                if prefix:
+                    yield prefix
+                
+                with self.metrics.stage('context'):
+                    context_str = self._get_conversation_context(session)
+                
+                cache_key = self._response_cache_key(session, user_input, analysis)
+                cached = self._cached_reply(session, cache_key, user_input)
+                if cached is not None:
+                    chunks.append(cached)
+                    yield cached
+                else:
+                    self._refresh_prefix_cache()
+                    usage_chunk = None
+                    llm_start = time.perf_counter()
+                    async for chunk in self.conversation_chain.astream(
+                        {"input": user_input, "context": context_str},
+                        {"configurable": {"session_id": user_id}}
+                    ):
+                        if getattr(chunk, 'usage_metadata', None):
+                            usage_chunk = chunk
+                        text = chunk.content if hasattr(chunk, 'content') else str(chunk)
+                        if text:
+                            chunks.append(text)
+                            yield text
+                    self.metrics.observe('llm_stream', time.perf_counter() - llm_start)
+                    self._record_usage(session, usage_chunk)
+                    self._store_reply(cache_key, "".join(chunks))
+                
+            except Exception as e:
+                print(f"Error in astream_response: {str(e)}")
+                yield "I'm sorry, I'm having trouble processing that right now. Could you try again?"
+            
+            finally:
+                # Also runs when the client disconnects mid-stream (aclose)
+                if prefix or chunks:
+                    assistant_message = self._record_message(session, "assistant", prefix + "".join(chunks))
+                    await self._persist(session, [assistant_message])
+                    
+                    overflow = len(session.user_data.get('chat_history', [])) - self.history_window
+                    if self.history_window and overflow >= HISTORY_SUMMARY_BATCH:
+                        await loop.run_in_executor(self._executor, self._roll_history_window, session)
+
+    async def aget_response(self, user_input: str, user_id: Optional[str] = None) -> str:
+        """
+        Async variant of get_response.
+        
+        Crisis and emotion detection run in the detector thread pool while the
+        session is fetched, the model is called with `ainvoke`, and the MongoDB
+        writes for the turn are scheduled in the background instead of awaited,
+        except for turns that set crisis flags.
+        """
+        loop = asyncio.get_running_loop()
+        user_id = user_id or getattr(self._local, 'user_id', None)
+        if not user_id:
+            return "Error: No active conversation. Please start or load a chat first."
+        
+        analysis_future = loop.run_in_executor(self._executor, self.analyze_message, user_input, user_id)
+        session = await loop.run_in_executor(self._executor, self.get_session, user_id)
+        if not session:
+            analysis_future.cancel()
+            return "Error: No active conversation. Please start or load a chat first."
+        
+        with self.metrics.stage('turn'):
+            async with self.sessions.ause(session):
+                try:
+                    analysis = await analysis_future
+                    crisis_result = analysis['crisis_info']
+                
+                    user_message = self._record_message(session, "user", user_input, analysis)
+                    with self.metrics.stage('context'):
+                        context_str = self._get_conversation_context(session)
+                
+                    cache_key = self._response_cache_key(session, user_input, analysis)
+                    response_text = self._cached_reply(session, cache_key, user_input)
+                    if response_text is None:
+                        self._refresh_prefix_cache()
+                        with self.metrics.stage('llm'):
+                            response = await self.conversation_chain.ainvoke(
+                                {"input": user_input, "context": context_str},
+                                {"configurable": {"session_id": user_id}}
+                            )
+                        self._record_usage(session, response)
+                        response_text = response.content if hasattr(response, 'content') else str(response)
+                        self._store_reply(cache_key, response_text)
+                    response_text = self._apply_crisis_escalation(session, crisis_result, response_text)
+                
+                    assistant_message = self._record_message(session, "assistant", response_text)
+                    await self._persist(session, [user_message, assistant_message])
+                
+                    overflow = len(session.user_data.get('chat_history', [])) - self.history_window
+                    if self.history_window and overflow >= HISTORY_SUMMARY_BATCH:
+                        await loop.run_in_executor(self._executor, self._roll_history_window, session)
+                
+                    return response_text
+                
+                except Exception as e:
+                    print(f"Error in aget_response: {str(e)}")
+                    return "I'm sorry, I'm having trouble processing that right now. Could you try again?"
+
+    async def _persist(self, session: ChatSession, messages):
+        """Schedule a turn's writes; writes carrying crisis flags are awaited, so they are stored before the reply."""
+        urgent = any(flag in session.pending_updates for flag in URGENT_USER_FLAGS)
+        task = self._schedule_persist(session, messages)
+        if urgent:
+            await asyncio.shield(task)
+
+    def _schedule_persist(self, session: ChatSession, messages) -> asyncio.Task:
+        """Write a turn's messages in the background, after any earlier writes for the same user."""
+        previous = session.persist_task
+        
+        async def persist():
+            if previous is not None:
+                await asyncio.gather(previous, return_exceptions=True)
+            await self.aappend_messages(session, messages)
+        
+        task = asyncio.create_task(persist())
+        session.persist_task = task
+        self._background_tasks.add(task)
+        task.add_done_callback(self._background_tasks.discard)
+        return task
+
+    async def aflush(self):
+        """Wait for all background persistence scheduled by aget_response, including queued writes."""
+        if self._background_tasks:
+            await asyncio.gather(*list(self._background_tasks), return_exceptions=True)
+        if self.write_queue is not None:
+            await asyncio.get_running_loop().run_in_executor(self._executor, self.write_queue.flush)
+
+    def get_write_stats(self) -> Dict[str, Any]:
+        """Counters of the write-behind queue (empty when writes are synchronous)."""
+        return self.write_queue.stats() if self.write_queue is not None else {}
+
 # --- This part is for running the chatbot in the terminal, it's not used by the API ---
 def main():
     chat_manager = UserChatManager()
@@ -0,0 +1,217 @@
+"""
+Write-behind queue for per-user MongoDB updates.
+
+Updates for the same user are merged while they wait: $push lists are
+concatenated, $inc amounts added and later $set values win. A background thread
+hands everything queued to a bulk writer every `flush_interval` seconds. flush()
+writes synchronously. It is used for updates that must be durable before a turn
+returns (crisis flags) and before a user's document is read back.
+
+An update the database rejects is kept apart from newer updates for the same
+key, retried first on later flushes (newer updates for the key wait behind it,
+so order is kept) and dropped after `max_attempts` rejections. When the whole
+batch fails (e.g. the server is unreachable) nothing is counted against the
+updates; they are retried until the database is back.
+"""
+import atexit
+import threading
+from collections import deque
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+Update = Dict[str, Dict[str, Any]]
+
+
+def merge_updates(older: Update, newer: Update) -> Update:
+    """Combine two updates of the same document into one with the same effect."""
+    merged = {op: dict(fields) for op, fields in older.items()}
+    for op, fields in newer.items():
+        target = merged.setdefault(op, {})
+        for key, value in fields.items():
+            if key not in target:
+                target[key] = value
+            elif op == '$push':
+                target[key] = {'$each': _each(target[key]) + _each(value)}
+            elif op == '$inc':
+                target[key] += value
+            elif op != '$setOnInsert':
+                target[key] = value
+    return merged
+
+
+def _each(value) -> List[Any]:
+    if isinstance(value, dict) and '$each' in value:
+        return list(value['$each'])
+    return [value]
+
+
+def describe_update(update: Update) -> str:
+    """Short description of an update for logs (field names and pushed counts, not contents)."""
+    parts = []
+    for op, fields in update.items():
+        names = [f"{name}[{len(_each(value))}]" if op == '$push' else name for name, value in fields.items()]
+        parts.append(f"{op} {', '.join(names)}")
+    return "; ".join(parts)
+
+
+class WriteBehindQueue:
+    """Coalesces updates per key and writes them with `write_batch` from a background thread."""
+
+    def __init__(
+        self,
+        write_batch: Callable[[List[Tuple[str, Update]]], Sequence[int]],
+        flush_interval: float = 0.25,
+        max_pending: int = 500,
+        max_attempts: int = 5,
+        on_drop: Optional[Callable[[str, Update], None]] = None,
+        name: str = 'write-behind'
+    ):
+        # write_batch returns the positions of the updates the database rejected
+        self.write_batch = write_batch
+        self.flush_interval = flush_interval
+        self.max_pending = max(1, max_pending)
+        self.max_attempts = max(1, max_attempts)
+        self.on_drop = on_drop
+        self.flushes = 0
+        self.enqueued = 0
+        # Updates merged into one already waiting for the same key
+        self.coalesced = 0
+        self.written = 0
+        self.failed = 0
+        self.dropped = 0
+        # Most recent dropped (key, update) pairs, for inspection
+        self.dead_letters = deque(maxlen=100)
+        self._pending: Dict[str, Update] = {}
+        # Rejected updates and how often they were rejected, never merged with newer ones
+        self._retry: Dict[str, Tuple[Update, int]] = {}
+        self._lock = threading.Lock()
+        # Held for a whole flush, so a key's updates reach the database in order
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._closed = False
+        self._worker = threading.Thread(target=self._run, name=name, daemon=True)
+        self._worker.start()
+        atexit.register(self.close)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._pending.keys() | self._retry.keys())
+
+    def enqueue(self, key: str, update: Update):
+        """Queue an update, merging it into one already waiting for the same key."""
+        if self._closed:
+            raise RuntimeError("WriteBehindQueue is closed")
+        with self._lock:
+            waiting = self._pending.get(key)
+            if waiting is None:
+                self._pending[key] = update
+            else:
+                self._pending[key] = merge_updates(waiting, update)
+                self.coalesced += 1
+            self.enqueued += 1
+            full = len(self._pending) >= self.max_pending
+        if full:
+            self._wake.set()
+
+    def flush(self, key: Optional[str] = None) -> bool:
+        """
+        Write what is queued for `key` (everything by default) before returning.
+
+        Also waits for a background flush that is writing the key. Returns False
+        if an update could not be written; it stays queued for the next flush
+        unless it has been rejected `max_attempts` times.
+        """
+        with self._flush_lock:
+            with self._lock:
+                keys = [key] if key is not None else list(self._retry)
+                retries = [(k, self._retry.pop(k)) for k in keys if k in self._retry]
+
+            # Earlier rejected updates go first; newer updates for their keys wait until they are written
+            blocked = set()
+            if retries:
+                failed = self._write([(k, update) for k, (update, _) in retries])
+                if failed is None:
+                    with self._lock:
+                        self._retry.update(retries)
+                    blocked.update(k for k, _ in retries)
+                else:
+                    for i in failed:
+                        k, (update, attempts) = retries[i]
+                        if self._retry_later(k, update, attempts):
+                            blocked.add(k)
+
+            with self._lock:
+                keys = [key] if key is not None else list(self._pending)
+                batch = [(k, self._pending.pop(k)) for k in keys if k in self._pending and k not in blocked]
+            failed = self._write(batch)
+            if failed is None:
+                self._requeue(batch)
+                return False
+            for i in failed:
+                k, update = batch[i]
+                self._retry_later(k, update, 0)
+            return not blocked and not failed
+
+    def _write(self, batch) -> Optional[List[int]]:
+        """Positions in `batch` the database rejected, or None if the batch failed as a whole."""
+        if not batch:
+            return []
+        try:
+            failed = sorted(set(self.write_batch(batch)))
+        except Exception as e:
+            print(f"Error writing {len(batch)} queued updates to MongoDB: {e}")
+            return None
+        self.flushes += 1
+        self.written += len(batch) - len(failed)
+        self.failed += len(failed)
+        return failed
+
+    def _requeue(self, entries):
+        with self._lock:
+            for key, update in entries:
+                newer = self._pending.get(key)
+                self._pending[key] = update if newer is None else merge_updates(update, newer)
+
+    def _retry_later(self, key: str, update: Update, attempts: int) -> bool:
+        """Keep a rejected update for another attempt, or drop it after max_attempts; True if kept."""
+        attempts += 1
+        if attempts < self.max_attempts:
+            with self._lock:
+                self._retry[key] = (update, attempts)
+            return True
+        self.dropped += 1
+        self.dead_letters.append((key, update))
+        print(f"Dropping update for {key} after {attempts} failed attempts: {describe_update(update)}")
+        if self.on_drop is not None:
+            try:
+                self.on_drop(key, update)
+            except Exception as e:
+                print(f"Error handling dropped update for {key}: {e}")
+        return False
+
+    def close(self, timeout: float = 5.0):
+        """Stop the background thread and write whatever is still queued."""
+        if self._closed:
+            return
+        self._closed = True
+        self._wake.set()
+        self._worker.join(timeout)
+        self.flush()
+        atexit.unregister(self.close)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'pending': len(self),
+            'enqueued': self.enqueued,
+            'coalesced': self.coalesced,
+            'written': self.written,
+            'failed': self.failed,
+            'dropped': self.dropped,
+            'flushes': self.flushes
+        }
+
+    def _run(self):
+        while not self._closed:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            if not self._closed and (self._pending or self._retry):
+                self.flush()